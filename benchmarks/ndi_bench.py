@@ -0,0 +1,335 @@
+#
+# Benchmark for the NDI side of the program, run against the in-process fake NDI backend
+# (ndibackend.FakeBackend), so no NDI runtime, network or cameras are needed.
+#
+# Measures:
+#   discovery  - NDISourceList.update() for the first discovery, for a change where 1% of the
+#                sources come and go, and for a wakeup where nothing changed
+#   srclist    - NDISourceList.srclist() and find(), as used by the GUI and the control API
+#   routing    - routing changes/s through NDIRouterList, and the cut/total time of a preset recall
+#                which re-routes every slot (CameraList.recall(), with the VISCA relays on loopback)
+#   relay      - round trip time of a VISCA command through the relay to a loopback camera, with the
+#                relay in this process and in its own process (relayprocess), idle and while another
+#                thread keeps the GIL busy, as the preview image work does
+#   thumbnail  - time per frame for the preview pipeline (capture, decimate, convert for the viewer),
+#                with a pooled and with a transient receiver, for the proxy and full size streams
+#
+# Examples:
+#   python benchmarks/ndi_bench.py
+#   python benchmarks/ndi_bench.py --sources 100 500 2000 --slots 7 64 --json results.json
+#   python benchmarks/ndi_bench.py --compare results.json --tolerance 0.25
+#
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import ndibackend  # noqa: E402
+import ndisources  # noqa: E402
+import ndirouter  # noqa: E402
+import viscarelay  # noqa: E402
+import viscarewrite  # noqa: E402
+import relayprocess  # noqa: E402
+from ndisources import NDISourceList, CameraList, ViscaPort  # noqa: E402
+
+CamName = "@CAM"
+
+# Metrics where bigger is better, everything else is a time
+HigherIsBetter = ("changes_per_s",)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def timed(func, repeat: int) -> list:
+    """ Call func repeat times, returns the time of each call (ms) """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return times
+
+
+def bench_discovery(sources: int, steps: int, seed: int) -> tuple:
+    """ Returns the discovery and srclist results for a network of <sources> sources """
+    backend = ndibackend.FakeBackend(sources=sources, seed=seed)
+    source_list = NDISourceList(CamName, backend=backend)
+    initial = timed(lambda: source_list.update(0, in_use=set()), 1)[0]
+
+    churn = max(1, sources // 100)
+    churn_times = []
+    for _ in range(steps):
+        backend.churn(churn, churn)
+        t0 = time.perf_counter()
+        diff = source_list.update(0, in_use=set())
+        churn_times.append((time.perf_counter() - t0) * 1000.0)
+        assert len(diff.added) == churn and len(diff.removed) == churn, "unexpected discovery diff"
+    steady = timed(lambda: source_list.update(0, in_use=set()), steps)
+
+    names = source_list.srclist()
+    srclist = timed(source_list.srclist, steps * 10)
+    find = timed(lambda: [source_list.find(name) for name in names], steps)
+    source_list.delete()
+
+    discovery = {"test": "discovery", "size": sources,
+                 "initial_ms": initial,
+                 "churn_ms": sum(churn_times) / len(churn_times),
+                 "churn_p99_ms": percentile(churn_times, 0.99),
+                 "steady_ms": sum(steady) / len(steady)}
+    listing = {"test": "srclist", "size": sources,
+               "srclist_us": sum(srclist) / len(srclist) * 1000.0,
+               "find_us": sum(find) / len(find) / len(names) * 1000.0}
+    return discovery, listing
+
+
+def bench_routing(slots: int, base_port: int, duration: float, seed: int) -> dict:
+    backend = ndibackend.FakeBackend(sources=slots * 2, seed=seed)
+    source_list = NDISourceList(CamName, backend=backend)
+    source_list.update(0)
+    names = source_list.srclist()[1:]
+    ndi_list = [source_list.find(name).ndi_source_get() for name in names]
+
+    # Raw routing changes, cycling every slot through the sources
+    routers = ndirouter.NDIRouterList(slots, CamName, backend=backend)
+    changes = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for idx in range(slots):
+            routers.set_routing(idx, ndi_list[(changes + idx) % len(ndi_list)])
+        changes += slots
+    changes_per_s = changes / (time.perf_counter() - start)
+
+    # Preset recall, alternating between two presets which use different sources on every slot
+    relays = viscarelay.ViscaRelayList(slots, None, base_port, ViscaPort)
+    cameras = CameraList(count=slots, cam_name=CamName, routerlist=routers, viscalist=relays)
+    presets = [{str(idx + 1): {"source": names[idx + offset], "ptz": "127.0.0.1"} for idx in range(slots)}
+               for offset in (0, slots)]
+    cut = []
+    total = []
+    for n in range(20):
+        result = cameras.recall(presets[n % 2], source_list)
+        if n > 0:
+            cut.append(result["cut_ms"])
+            total.append(result["total_ms"])
+    relays.close()
+    routers.resize(0)
+    source_list.delete()
+
+    return {"test": "routing", "size": slots,
+            "changes_per_s": changes_per_s,
+            "recall_cut_ms": sum(cut) / len(cut),
+            "recall_total_ms": sum(total) / len(total)}
+
+
+def gil_load(stop: threading.Event):
+    """ Pure Python work, holding the GIL as much as it can """
+    while not stop.is_set():
+        sum(range(10000))
+
+
+def relay_client(conn, port: int):
+    """ Controller and camera, in their own process so only the relay shares the GIL with the load.
+        Sends the camera port, then for each request (a packet count) the round trip times (ms)
+        of VISCA commands, controller -> relay -> camera -> relay -> controller
+    """
+    camera = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    camera.bind(('127.0.0.1', 0))
+    controller = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b'\x81\x01\x06\x01\x10\x10\x03\x03\xff'
+    reply = b'\x90\x41\xff'
+    conn.send(camera.getsockname()[1])
+    while True:
+        (port, packets) = conn.recv()
+        if packets == 0:
+            break
+        times = []
+        for seq in range(packets):
+            t0 = time.perf_counter()
+            controller.sendto(viscarelay.VISCA_HEADER.pack(viscarewrite.VISCA_COMMAND, len(payload), seq)
+                              + payload, ('127.0.0.1', port))
+            (_, address) = camera.recvfrom(64)
+            camera.sendto(viscarelay.VISCA_HEADER.pack(viscarewrite.VISCA_REPLY, len(reply), seq) + reply, address)
+            controller.recvfrom(64)
+            times.append((time.perf_counter() - t0) * 1000.0)
+        conn.send(times)
+    camera.close()
+    controller.close()
+
+
+def bench_relay(port: int, packets: int) -> dict:
+    """ Returns the round trip times through the relay, in this process and in the relay process,
+        idle and while another thread keeps the GIL busy
+    """
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    client = context.Process(target=relay_client, args=(child_conn, port), daemon=True)
+    client.start()
+    camera_port = conn.recv()
+    result = {"test": "relay", "size": packets}
+
+    for name in ("thread", "process"):
+        if name == "process":
+            relays = relayprocess.ViscaRelayProcess(1, port, camera_port)
+        else:
+            relays = viscarelay.ViscaRelayList(1, None, port, camera_port)
+        relays.ptz_set(0, '127.0.0.1')
+        while relays.ptz_state(0) != 'ok':
+            time.sleep(0.01)
+
+        for load in (False, True):
+            stop = threading.Event()
+            loader = threading.Thread(target=gil_load, args=(stop,), daemon=True)
+            if load:
+                loader.start()
+            conn.send((port, packets))
+            times = conn.recv()
+            stop.set()
+            if load:
+                loader.join()
+            key = name + ("_load" if load else "")
+            result[key + "_ms"] = percentile(times, 0.5)
+            result[key + "_p99_ms"] = percentile(times, 0.99)
+        relays.close()
+        if name == "thread":
+            relays.resolver.close()
+        # Don't reuse the port of the previous run
+        port += 1
+
+    conn.send((port, 0))
+    client.join()
+    return result
+
+
+def bench_thumbnail(bandwidth: str, frames: int, seed: int) -> dict:
+    import ndi_image
+    # A new frame is due every ms, so by the time a source is captured again (after the other
+    # sources) one has always arrived, and only the pipeline is timed, not waiting for frames
+    backend = ndibackend.FakeBackend(sources=4, seed=seed, frame_rate=1000.0)
+    ndibackend.use(backend)
+    ndi_image.DefaultProfile = {'bandwidth': bandwidth, 'deadline': 2.5}
+    source_list = NDISourceList(CamName, backend=backend)
+    source_list.update(0)
+    sources = [ndi_src for _, ndi_src in source_list.preview_sources()]
+    imgsize = (480, 270)
+    pool = ndi_image.ReceiverPool(len(sources))
+
+    def frame(pooled: bool):
+        for ndi_src in sources:
+            img = ndi_image.getframe_ndi(ndi_src, imgsize, pool=pool if pooled else None)
+            ndi_image.viewer_data(img, imgsize)
+
+    result = {"test": "thumbnail", "size": backend.frame_size[1] if bandwidth == ndibackend.BANDWIDTH_HIGHEST
+              else backend.ProxySize[1]}
+    for pooled in (True, False):
+        frame(pooled)
+        cpu_start = time.process_time()
+        times = timed(lambda: frame(pooled), frames)
+        cpu = time.process_time() - cpu_start
+        key = "pooled" if pooled else "transient"
+        result[key + "_ms"] = sum(times) / len(times) / len(sources)
+        result[key + "_cpu_ms"] = cpu * 1000.0 / frames / len(sources)
+    pool.clear()
+    source_list.delete()
+    return result
+
+
+def compare(results: list, baseline_file: str, tolerance: float) -> bool:
+    """ Compare results against a previous run, returns False if anything regressed """
+    with open(baseline_file) as f:
+        baseline = {(r["test"], r["size"]): r for r in json.load(f)["results"]}
+
+    ok = True
+    for r in results:
+        b = baseline.get((r["test"], r["size"]))
+        if b is None:
+            continue
+        for metric, value in r.items():
+            if metric in ("test", "size") or metric not in b:
+                continue
+            if metric in HigherIsBetter:
+                regressed = value < b[metric] * (1 - tolerance)
+            else:
+                regressed = value > b[metric] * (1 + tolerance)
+            if regressed:
+                print(f"REGRESSION {r['test']} size={r['size']} {metric}: {b[metric]:.3f} -> {value:.3f}")
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NDI discovery/routing/preview benchmark, on a fake NDI backend")
+    parser.add_argument("--sources", type=int, nargs="+", default=[100, 500, 2000],
+                        help="numbers of NDI sources on the simulated network")
+    parser.add_argument("--slots", type=int, nargs="+", default=[7, 64],
+                        help="slot counts for the routing benchmark")
+    parser.add_argument("--steps", type=int, default=50, help="discovery changes per run")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds of routing changes per run")
+    parser.add_argument("--packets", type=int, default=500, help="VISCA commands per relay benchmark run")
+    parser.add_argument("--frames", type=int, default=20, help="frames per source for the thumbnail benchmark")
+    parser.add_argument("--base-port", type=int, default=31001, help="first VISCA relay port")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the fake backend")
+    parser.add_argument("--skip-thumbnails", action="store_true",
+                        help="don't run the thumbnail benchmark (needs PIL, numpy and PySimpleGUI)")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression against the baseline (fraction)")
+    args = parser.parse_args()
+
+    # Sources which have gone away are removed straight away, so each change is measured in full
+    ndisources.StaleAge = 0.0
+
+    results = []
+    print(f"{'sources':>7} {'initial ms':>10} {'churn ms':>9} {'p99 ms':>8} {'steady ms':>9} "
+          f"{'srclist us':>10} {'find us':>8}")
+    for sources in args.sources:
+        discovery, listing = bench_discovery(sources, args.steps, args.seed)
+        results.extend((discovery, listing))
+        print(f"{sources:>7} {discovery['initial_ms']:>10.2f} {discovery['churn_ms']:>9.3f} "
+              f"{discovery['churn_p99_ms']:>8.3f} {discovery['steady_ms']:>9.3f} "
+              f"{listing['srclist_us']:>10.2f} {listing['find_us']:>8.3f}")
+
+    print(f"\n{'slots':>7} {'changes/s':>10} {'cut ms':>9} {'recall ms':>9}")
+    for slots in args.slots:
+        r = bench_routing(slots, args.base_port, args.duration, args.seed)
+        results.append(r)
+        print(f"{slots:>7} {r['changes_per_s']:>10.0f} {r['recall_cut_ms']:>9.3f} {r['recall_total_ms']:>9.3f}")
+        # Don't reuse the ports of the previous run
+        args.base_port += slots
+
+    r = bench_relay(args.base_port, args.packets)
+    results.append(r)
+    args.base_port += 2
+    print(f"\n{'relay':>7} {'idle ms':>8} {'p99 ms':>8} {'load ms':>8} {'p99 ms':>8}")
+    for name in ("thread", "process"):
+        print(f"{name:>7} {r[name + '_ms']:>8.3f} {r[name + '_p99_ms']:>8.3f} "
+              f"{r[name + '_load_ms']:>8.3f} {r[name + '_load_p99_ms']:>8.3f}")
+
+    if not args.skip_thumbnails:
+        print(f"\n{'lines':>7} {'pooled ms':>10} {'cpu ms':>8} {'transient ms':>12} {'cpu ms':>8}")
+        for bandwidth in (ndibackend.BANDWIDTH_LOWEST, ndibackend.BANDWIDTH_HIGHEST):
+            r = bench_thumbnail(bandwidth, args.frames, args.seed)
+            results.append(r)
+            print(f"{r['size']:>7} {r['pooled_ms']:>10.2f} {r['pooled_cpu_ms']:>8.2f} "
+                  f"{r['transient_ms']:>12.2f} {r['transient_cpu_ms']:>8.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
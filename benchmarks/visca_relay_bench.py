@@ -0,0 +1,263 @@
+#
+# Benchmark for the VISCA relay (viscarelay.py)
+#
+# Runs a ViscaRelayList on loopback in this process, with a simulated UDP camera and a
+# load-generating controller each running in their own process, so that the CPU time
+# measured here is the cost of the relay alone.
+#
+# Reports round trip latency (controller send -> COMPLETION/INQUIRY reply received),
+# packets/s through the relay, and relay CPU time per packet, for each slot count.
+#
+# Examples:
+#   python benchmarks/visca_relay_bench.py
+#   python benchmarks/visca_relay_bench.py --slots 1 7 64 --duration 10 --json results.json
+#   python benchmarks/visca_relay_bench.py --compare results.json --tolerance 0.25
+#
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import viscarelay  # noqa: E402
+
+VISCA_HEADER = struct.Struct("!HHL")
+VISCA_COMMAND = 0x0100
+VISCA_INQUIRY = 0x0110
+VISCA_REPLY = 0x0111
+
+# Pan-tiltDrive up-left at speed 0x18, and CAM_PowerInq
+DRIVE_CMD = bytes.fromhex("8101060118180101ff")
+POWER_INQ = bytes.fromhex("81090400ff")
+
+ACK = bytes.fromhex("9041ff")
+COMPLETION = bytes.fromhex("9051ff")
+POWER_REPLY = bytes.fromhex("905002ff")
+
+
+def camera_process(port_pipe, stop_event):
+    """ Stand-in camera. Answers commands with ACK+COMPLETION and inquiries with a reply """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    s.settimeout(0.2)
+    port_pipe.send(s.getsockname()[1])
+    port_pipe.close()
+
+    while not stop_event.is_set():
+        try:
+            buffer, address = s.recvfrom(1024)
+        except socket.timeout:
+            continue
+        except ConnectionResetError:
+            continue
+        if len(buffer) < VISCA_HEADER.size:
+            continue
+        (vtype, _, seq) = VISCA_HEADER.unpack_from(buffer)
+        if vtype == VISCA_INQUIRY:
+            replies = (POWER_REPLY,)
+        else:
+            replies = (ACK, COMPLETION)
+        for reply in replies:
+            s.sendto(VISCA_HEADER.pack(VISCA_REPLY, len(reply), seq) + reply, address)
+    s.close()
+
+
+def controller_process(base_port: int, slots: int, window: int, duration: float,
+                       inquiry_ratio: float, start_event, result_pipe):
+    """ Load generating controller. Keeps <window> requests outstanding on every slot
+        and records the round trip time of each one
+    """
+    sel = selectors.DefaultSelector()
+    socks = []
+    for slot in range(slots):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, slot)
+        socks.append(s)
+
+    inquiry_every = int(1 / inquiry_ratio) if inquiry_ratio > 0 else 0
+    outstanding = [dict() for _ in range(slots)]
+    next_seq = [0] * slots
+    latencies = []
+    sent = 0
+    received = 0
+    timeouts = 0
+
+    def send(slot):
+        nonlocal sent
+        seq = next_seq[slot]
+        next_seq[slot] = seq + 1
+        if inquiry_every and seq % inquiry_every == 0:
+            packet = VISCA_HEADER.pack(VISCA_INQUIRY, len(POWER_INQ), seq) + POWER_INQ
+        else:
+            packet = VISCA_HEADER.pack(VISCA_COMMAND, len(DRIVE_CMD), seq) + DRIVE_CMD
+        outstanding[slot][seq] = time.perf_counter()
+        socks[slot].sendto(packet, ("127.0.0.1", base_port + slot))
+        sent += 1
+
+    start_event.wait()
+    start = time.perf_counter()
+    end = start + duration
+    for slot in range(slots):
+        for _ in range(window):
+            send(slot)
+
+    last_check = start
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        for key, _ in sel.select(timeout=0.1):
+            slot = key.data
+            s = socks[slot]
+            while True:
+                try:
+                    buffer, _ = s.recvfrom(1024)
+                except (BlockingIOError, ConnectionResetError):
+                    break
+                received += 1
+                (vtype, _, seq) = VISCA_HEADER.unpack_from(buffer)
+                # ACKs don't complete a request, COMPLETION and INQUIRY replies do
+                if (buffer[VISCA_HEADER.size + 1] & 0xf0) != 0x50:
+                    continue
+                t0 = outstanding[slot].pop(seq, None)
+                if t0 is not None:
+                    latencies.append(time.perf_counter() - t0)
+                    send(slot)
+
+        # Resend for requests which were lost, so a slot never stalls
+        now = time.perf_counter()
+        if now - last_check > 0.5:
+            last_check = now
+            for slot in range(slots):
+                for seq, t0 in list(outstanding[slot].items()):
+                    if now - t0 > 1.0:
+                        del outstanding[slot][seq]
+                        timeouts += 1
+                        send(slot)
+
+    elapsed = time.perf_counter() - start
+    for s in socks:
+        s.close()
+    result_pipe.send({"latencies": latencies, "sent": sent, "received": received,
+                      "timeouts": timeouts, "elapsed": elapsed})
+    result_pipe.close()
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(slots: int, base_port: int, window: int, duration: float, inquiry_ratio: float) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    start_event = ctx.Event()
+
+    port_recv, port_send = ctx.Pipe(duplex=False)
+    camera = ctx.Process(target=camera_process, args=(port_send, stop_event), daemon=True)
+    camera.start()
+    camera_port = port_recv.recv()
+
+    relays = viscarelay.ViscaRelayList(slots, None, base_port, camera_port)
+    for slot in range(slots):
+        relays.ptz_set(slot, "127.0.0.1")
+
+    result_recv, result_send = ctx.Pipe(duplex=False)
+    controller = ctx.Process(target=controller_process,
+                             args=(base_port, slots, window, duration, inquiry_ratio,
+                                   start_event, result_send),
+                             daemon=True)
+    controller.start()
+    time.sleep(0.5)
+
+    cpu_start = time.process_time()
+    start_event.set()
+    result = result_recv.recv()
+    cpu = time.process_time() - cpu_start
+
+    controller.join()
+    stop_event.set()
+    camera.join()
+    relays.close()
+
+    latencies = sorted(result["latencies"])
+    relayed = result["sent"] + result["received"]
+    return {
+        "slots": slots,
+        "window": window,
+        "requests": len(latencies),
+        "timeouts": result["timeouts"],
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "p999_us": percentile(latencies, 0.999) * 1e6,
+        "packets_per_s": relayed / result["elapsed"],
+        "cpu_us_per_packet": (cpu / relayed * 1e6) if relayed else float('nan'),
+    }
+
+
+def compare(results: list, baseline_file: str, tolerance: float) -> bool:
+    """ Compare results against a previous run, returns False if anything regressed """
+    with open(baseline_file) as f:
+        baseline = {r["slots"]: r for r in json.load(f)["results"]}
+
+    ok = True
+    for r in results:
+        b = baseline.get(r["slots"])
+        if b is None:
+            continue
+        for metric in ("p50_us", "p99_us", "cpu_us_per_packet"):
+            if r[metric] > b[metric] * (1 + tolerance):
+                print(f"REGRESSION slots={r['slots']} {metric}: {b[metric]:.1f} -> {r[metric]:.1f}")
+                ok = False
+        if r["packets_per_s"] < b["packets_per_s"] * (1 - tolerance):
+            print(f"REGRESSION slots={r['slots']} packets_per_s: "
+                  f"{b['packets_per_s']:.0f} -> {r['packets_per_s']:.0f}")
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VISCA relay latency/throughput benchmark")
+    parser.add_argument("--slots", type=int, nargs="+", default=[1, 7, 64],
+                        help="slot counts to benchmark")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per run")
+    parser.add_argument("--window", type=int, default=1,
+                        help="requests kept outstanding per slot")
+    parser.add_argument("--inquiry-ratio", type=float, default=0.2,
+                        help="fraction of requests which are inquiries")
+    parser.add_argument("--base-port", type=int, default=30001, help="first relay port")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed regression against the baseline (fraction)")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'slots':>5} {'requests':>9} {'p50 us':>8} {'p99 us':>8} {'p999 us':>8} "
+          f"{'pkts/s':>9} {'cpu us/pkt':>10}")
+    for slots in args.slots:
+        r = run(slots, args.base_port, args.window, args.duration, args.inquiry_ratio)
+        results.append(r)
+        print(f"{r['slots']:>5} {r['requests']:>9} {r['p50_us']:>8.1f} {r['p99_us']:>8.1f} "
+              f"{r['p999_us']:>8.1f} {r['packets_per_s']:>9.0f} {r['cpu_us_per_packet']:>10.1f}")
+        # Don't reuse the ports of the previous run
+        args.base_port += slots
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,18 @@
 # - Companion is running on the local machine - 127.0.0.1
 # - The UDP API is configured on the default port (16759)
 #
+# on_error is called with a message for errors the user should see (the GUI passes Sg.popup_error),
+# by default they are printed, so this module can be used without a GUI
+#
+# The VISCA relay doesn't call Companion directly, it goes through a CompanionNotifier
+#
 import socket
-import PySimpleGUI as Sg
+import threading
+import time
+from collections import deque
 
 class Companion:
-    def __init__(self, target:str="127.0.0.1", port:int=16759, page='0', row:int=0):
+    def __init__(self, target:str="127.0.0.1", port:int=16759, page='0', row:int=0, on_error=print):
         self.page = page
         self.row = row
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -17,7 +24,7 @@ class Companion:
         try:
             self.socket.connect(address)
         except socket.gaierror:
-            Sg.popup_error(f'BitFocus Companion connect: Bad address "{target}"')
+            on_error(f'BitFocus Companion connect: Bad address "{target}"')
 
     def pushbutton(self, page=None, row=None, column:int=0):
         if page is None:
@@ -27,4 +34,69 @@ class Companion:
             row = self.row
 
         buffer = f"LOCATION {page}/{row}/{column} PRESS"
-        self.socket.send(buffer.encode('utf-8'))
\ No newline at end of file
+        self.socket.send(buffer.encode('utf-8'))
+
+class CompanionNotifier:
+    """ Sends camera switches to Companion from its own thread, so the VISCA relay never waits
+        on (or sees an error from) Companion. Only the latest switch is kept: switches made
+        while an earlier one is waiting to be sent replace it.
+    """
+    def __init__(self, companion: Companion):
+        self.companion = companion
+        # column of the last switch requested, and the switch waiting to be sent
+        self.last = None
+        self.pending = deque(maxlen=1)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.last_error = None
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.thread = threading.Thread(target=self.run, name="CompanionNotifier")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def switch(self, column: int):
+        """ Ask for a switch to a column. Called from the relay thread, never blocks """
+        if column == self.last:
+            return
+        self.last = column
+        if self.pending:
+            self.coalesced += 1
+        self.pending.append(column)
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            while self.pending:
+                try:
+                    column = self.pending.popleft()
+                except IndexError:
+                    break
+                start = time.perf_counter()
+                try:
+                    self.companion.pushbutton(column=column)
+                    self.sent += 1
+                except Exception as exc:
+                    self.failed += 1
+                    self.last_error = str(exc)
+                latency = time.perf_counter() - start
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stats(self) -> dict:
+        attempts = self.sent + self.failed
+        return {'sent': self.sent, 'failed': self.failed, 'coalesced': self.coalesced,
+                'last_error': self.last_error,
+                'latency_avg_ms': (self.latency_total / attempts * 1000) if attempts else None,
+                'latency_max_ms': self.latency_max * 1000}
+
+    def close(self):
+        self.stopping = True
+        self.wakeup.set()
@@ -1,12 +1,21 @@
 # Python Configuration file for NDISELECTOR
-import PySimpleGUI as Sg
+#
+# PySimpleGUI is only imported when it is needed, the headless service (ndidaemon.py) reads the
+# same settings through JsonSettings without loading any GUI modules
+#
 import os
 import sys
 import gc
+import json
+import threading
+import statestore
 
 ProgName = 'NDI Camera Selector'
 ProgVers = "1.0beta1"
 
+# Largest number of camera slots
+MaxCameraCount = 64
+
 credits_text = """
 Dan Tappan (https://dantappan.net) - (c) 2024, 2025
 
@@ -31,17 +40,94 @@ def restart_program():
     python = sys.executable
     os.execv(python, ['python'] + sys.argv)
 
+def settings_file(name: str = 'ndiselector') -> str:
+    """ Return the path of the settings file Sg.UserSettings uses for a program """
+    if sys.platform.startswith('win'):
+        folder = r'~\AppData\Local\PySimpleGUI\settings'
+    elif sys.platform == 'darwin':
+        folder = '~/Library/Application Support/PySimpleGUI/settings'
+    else:
+        folder = '~/.config/PySimpleGUI/settings'
+    return os.path.join(os.path.expanduser(folder), name + '.json')
+
+
+class JsonSettings:
+    """ Settings file in the same format as Sg.UserSettings, for use without PySimpleGUI """
+    def __init__(self, filename: str = None):
+        self.filename = settings_file() if filename is None else filename
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename, 'r') as f:
+                self.dict = json.load(f)
+        except (OSError, ValueError):
+            self.dict = {}
+
+    def get_filename(self) -> str:
+        return self.filename
+
+    def get(self, key, default=None):
+        return self.dict.get(key, default)
+
+    def __getitem__(self, key):
+        return self.dict.get(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.dict[key] = value
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(self.dict, f, indent=4)
+            os.replace(tmpname, self.filename)
+
+
 class Config:
-    def __init__(self):
-        self.user_settings = Sg.UserSettings()
+    def __init__(self, user_settings=None):
+        if user_settings is None:
+            import PySimpleGUI as Sg
+            user_settings = Sg.UserSettings()
+        self.user_settings = user_settings
+        # saved cameras and PTZ addresses, created when first used
+        self._camera_state = None
+        # pattern for the sources we advertise
+        # TODO: make this configurable
+        self._cam_name = "@CAM"
+        self.load()
+
+    def load(self):
+        """ (Re)read the settings """
         self._camera_count = self.user_settings.get("-CAMERACOUNT-", 7)
         self._relay_port_base = self.user_settings.get("-RELAYPORT-", 10001)
         self._bitfocus_enable = self.user_settings.get('-BITFOCUSENABLE-', False)
         self._bitfocus_target = self.user_settings.get('-BITFOCUSTARGET-', '127.0.0.1')
         self._bitfocus_page = self.user_settings.get('-BITFOCUSPAGE-', '0')
-        # pattern for the sources we advertise
-        # TODO: make this configurable
-        self._cam_name = "@CAM"
+        # camera numbers (1-N) for which VISCA drive commands are coalesced, e.g. "1,3"
+        self._coalesce = self.user_settings.get('-COALESCE-', '')
+        # camera numbers (1-N) for which VISCA inquiries are answered from recent camera replies,
+        # and how long (ms) a reply is reused for
+        self._inquiry_cache = self.user_settings.get('-INQUIRYCACHE-', '')
+        self._inquiry_ttl = self.user_settings.get('-INQUIRYTTL-', 100)
+        # run the VISCA relay in its own process, away from the GUI and the preview image work
+        self._relay_process = self.user_settings.get('-RELAYPROCESS-', False)
+        # number of NDI preview receivers kept connected
+        self._receiver_pool_size = self.user_settings.get('-RECVPOOL-', 4)
+        # frame rate of the live viewer
+        self._live_fps = self.user_settings.get('-LIVEFPS-', 4)
+        # grab thumbnails for every source in the background
+        self._prefetch = self.user_settings.get('-PREFETCH-', True)
+        # NDI source name -> seconds to wait for a preview frame, for sources which are slow to connect
+        self._capture_deadlines = self.user_settings.get('-CAPTUREDEADLINES-', {})
+        # TCP port of the control API, which only listens on 127.0.0.1. Always enabled for the
+        # headless service, and optional for the GUI (for recalling presets from Companion)
+        self._api_port = self.user_settings.get('-APIPORT-', 10080)
+        self._api_enable = self.user_settings.get('-APIENABLE-', False)
+        # preset name -> preset, see CameraList.preset()
+        self._presets = self.user_settings.get('-PRESETS-', {})
+        # NDI discovery: Discovery Server addresses, IP addresses of sources mDNS doesn't reach,
+        # and NDI groups, each comma separated. Empty means the NDI defaults
+        self._ndi_discovery = self.user_settings.get('-NDIDISCOVERY-', '')
+        self._ndi_extra_ips = self.user_settings.get('-NDIEXTRAIPS-', '')
+        self._ndi_groups = self.user_settings.get('-NDIGROUPS-', '')
 
     def cam_name(self):
         return self._cam_name
@@ -49,64 +135,223 @@ class Config:
     def camera_count(self):
         return self._camera_count
 
+    def camera_count_set(self, count: int):
+        self._camera_count = count
+        self.user_settings['-CAMERACOUNT-'] = count
+
     def relay_port_base(self):
         return self._relay_port_base
 
+    def api_port(self):
+        return self._api_port
+
+    def api_enabled(self):
+        return self._api_enable
+
+    def presets(self) -> dict:
+        return self._presets
+
+    def preset_names(self) -> list:
+        return sorted(self._presets, key=str.casefold)
+
+    def preset_set(self, name: str, preset: dict):
+        self._presets[name] = preset
+        self.user_settings['-PRESETS-'] = self._presets
+
+    def preset_delete(self, name: str):
+        if self._presets.pop(name, None) is not None:
+            self.user_settings['-PRESETS-'] = self._presets
+
+    def receiver_pool_size(self):
+        return self._receiver_pool_size
+
+    def capture_deadlines(self) -> dict:
+        return self._capture_deadlines
+
+    def prefetch_enabled(self):
+        return self._prefetch
+
+    def live_fps(self):
+        return self._live_fps
+
+    def live_fps_set(self, fps):
+        self._live_fps = fps
+        self.user_settings['-LIVEFPS-'] = fps
+
+    def _slot_list(self, text: str) -> list:
+        """ Convert a list of camera numbers (1-N), e.g. "1,3", to camera indexes (0-N) """
+        slots = []
+        for camnum in text.replace(',', ' ').split():
+            try:
+                slots.append(int(camnum) - 1)
+            except ValueError:
+                pass
+        return [slot for slot in slots if 0 <= slot < self._camera_count]
+
+    def coalesce_slots(self) -> list:
+        """ Return the list of camera indexes (0-N) for which VISCA drive commands are coalesced """
+        return self._slot_list(self._coalesce)
+
+    def inquiry_cache_slots(self) -> list:
+        """ Return the list of camera indexes (0-N) for which VISCA inquiries are cached """
+        return self._slot_list(self._inquiry_cache)
+
+    def inquiry_ttl(self) -> float:
+        """ Return how long (seconds) a cached inquiry reply is reused for """
+        return self._inquiry_ttl / 1000.0
+
+    def relay_process(self) -> bool:
+        return self._relay_process
+
     def bitfocus_info(self):
         if self._bitfocus_enable:
             return [self._bitfocus_target, self._bitfocus_page]
         else:
             return None
 
-    def save_camera_state(self, statetuple):
-        self.user_settings["-CAMSTATE-"] = statetuple
+    @staticmethod
+    def _address_list(text: str) -> str | None:
+        """ Normalize a comma/space separated list, None if it is empty """
+        items = text.replace(',', ' ').split()
+        return ','.join(items) if items else None
+
+    def discovery_servers(self) -> str | None:
+        """ Return the NDI Discovery Server addresses, comma separated, or None """
+        return self._address_list(self._ndi_discovery)
 
-    def load_camera_state(self):
-        statetuple = self.user_settings.get("-CAMSTATE-", (None, None))
-        return statetuple
+    def discovery_finders(self) -> list:
+        """ Return the NDI finders to run, as (label, groups, extra IPs) tuples. Sources found by
+            any of them are merged into one list """
+        groups = self._address_list(self._ndi_groups)
+        finders = [('discovery server' if self.discovery_servers() is not None else 'mDNS', groups, None)]
+        extra_ips = self._address_list(self._ndi_extra_ips)
+        if extra_ips is not None:
+            finders.append(('extra IPs', groups, extra_ips))
+        return finders
+
+    def settings_dir(self) -> str:
+        return os.path.dirname(os.path.abspath(self.user_settings.get_filename()))
+
+    def camera_state(self) -> statestore.CameraStateStore:
+        """ Return the store for the saved cameras and PTZ addresses, which is kept in a file
+            next to the settings file """
+        if self._camera_state is None:
+            filename = os.path.splitext(self.user_settings.get_filename())[0] + '-cameras.json'
+            self._camera_state = statestore.CameraStateStore(filename, legacy_settings=self.user_settings)
+        return self._camera_state
+
+    def save_camera_state(self, ptz: dict, cameras: list):
+        """ Save (in the background) the PTZ addresses which aren't the default, and the camera source names """
+        self.camera_state().save(ptz, cameras)
+
+    def load_camera_state(self) -> tuple:
+        """ Return (source name -> PTZ address, list of camera source names) """
+        return self.camera_state().load()
+
+    def close(self):
+        """ Write out any state waiting to be saved """
+        if self._camera_state is not None:
+            self._camera_state.close()
 
     @property
     def credits_text(self):
         return f"{ProgName} {ProgVers}\n" + credits_text
 
-    def configure(self):
+    def configure(self) -> bool:
         # Run dialog to set configuration parameters
-        # this will restart the program if parameters change
+        # returns True if they were saved, the caller applies the new settings
+        import PySimpleGUI as Sg
 
         layout = [
                   [Sg.Text(f"{ProgName} version {ProgVers}")],
                   [Sg.Text('Camera Count '), Sg.Input(default_text=str(self._camera_count),
-                                                      key='CAMERACOUNT', size=4),],
+                                                      key='CAMERACOUNT', size=4,
+                                                      tooltip=f'1 to {MaxCameraCount}'),],
+                  [Sg.Text('Coalesce PTZ drive commands for cameras'),
+                   Sg.Input(default_text=self._coalesce, key='COALESCE', size=10,
+                            tooltip='Camera numbers, e.g. "1,3". For PTZ heads which lag behind the joystick')],
+                  [Sg.Text('Cache VISCA inquiries for cameras'),
+                   Sg.Input(default_text=self._inquiry_cache, key='INQUIRYCACHE', size=10,
+                            tooltip='Camera numbers, e.g. "1,3". Answers controllers which keep polling '
+                                    'the camera from its recent replies'),
+                   Sg.Text('for ms'),
+                   Sg.Input(default_text=str(self._inquiry_ttl), key='INQUIRYTTL', size=5)],
+                  [Sg.Checkbox('Run the VISCA relay in its own process', default=self._relay_process,
+                               key='RELAYPROCESS',
+                               tooltip='Keeps PTZ control responsive while the previews are busy. '
+                                       'Takes effect when the program is restarted')],
+                  [Sg.Text('Preview receivers kept open'),
+                   Sg.Input(default_text=str(self._receiver_pool_size), key='RECVPOOL', size=4,
+                            tooltip='Number of recently previewed NDI sources to stay connected to')],
+                  [Sg.Checkbox('Prefetch source thumbnails', default=self._prefetch, key='PREFETCH',
+                               tooltip='Grab a frame from every NDI source in the background')],
+                  [Sg.Text('NDI Discovery Servers'),
+                   Sg.Input(default_text=self._ndi_discovery, key='NDIDISCOVERY', size=30,
+                            tooltip='Addresses of NDI Discovery Servers, e.g. "192.168.1.10". '
+                                    'Takes effect when the program is restarted')],
+                  [Sg.Text('NDI extra IPs'),
+                   Sg.Input(default_text=self._ndi_extra_ips, key='NDIEXTRAIPS', size=30,
+                            tooltip='Addresses of NDI sources on other subnets, which mDNS doesn\'t reach')],
+                  [Sg.Text('NDI groups'),
+                   Sg.Input(default_text=self._ndi_groups, key='NDIGROUPS', size=30,
+                            tooltip='NDI groups to list sources from, empty for the default (public)')],
+                  [Sg.Checkbox('Enable control API', default=self._api_enable, key='APIENABLE',
+                               tooltip='JSON API on 127.0.0.1, e.g. for recalling presets from Companion'),
+                   Sg.Text('Port'),
+                   Sg.Input(default_text=str(self._api_port), key='APIPORT', size=6)],
                   [Sg.Checkbox('Enable Bitfocus Companion Interface',
                                default=self._bitfocus_enable, key='BITFOCUSENABLE'), ],
                   [Sg.Text('Bitfocus Companion Address'),
                    Sg.Input(default_text=self._bitfocus_target, key='BITFOCUSTARGET', size=15)],
                    [Sg.Text('Bitfocus Companion Page'),
                    Sg.Input(default_text=self._bitfocus_page, key='BITFOCUSPAGE', size=4)],
-                  [Sg.Button('Save&Exit'), Sg.Button('Cancel')]
+                  [Sg.Button('Save'), Sg.Button('Cancel')]
                   ]
         window = Sg.Window(title='Configure', layout=layout, finalize=True, keep_on_top=True)
+        saved = False
         while True:
             event, values = window.read()
 
             if event == 'Cancel' or event == Sg.WINDOW_CLOSED:
                 break
 
-            elif event == 'Save&Exit':
-                self.user_settings['-CAMERACOUNT-'] = int(values['CAMERACOUNT'])
+            elif event == 'Save':
+                try:
+                    camera_count = int(values['CAMERACOUNT'])
+                    receiver_pool_size = int(values['RECVPOOL'])
+                    inquiry_ttl = int(values['INQUIRYTTL'])
+                    api_port = int(values['APIPORT'])
+                    bitfocus_page = int(values['BITFOCUSPAGE']) if values['BITFOCUSENABLE'] else None
+                except ValueError as exc:
+                    Sg.popup_error(f"Bad value: {exc}", keep_on_top=True)
+                    continue
+                if not 1 <= camera_count <= MaxCameraCount:
+                    Sg.popup_error(f"Camera Count must be 1 to {MaxCameraCount}", keep_on_top=True)
+                    continue
+
+                self.user_settings['-CAMERACOUNT-'] = camera_count
+                self.user_settings['-COALESCE-'] = values['COALESCE']
+                self.user_settings['-INQUIRYCACHE-'] = values['INQUIRYCACHE']
+                self.user_settings['-INQUIRYTTL-'] = inquiry_ttl
+                self.user_settings['-RELAYPROCESS-'] = values['RELAYPROCESS']
+                self.user_settings['-RECVPOOL-'] = receiver_pool_size
+                self.user_settings['-PREFETCH-'] = values['PREFETCH']
+                self.user_settings['-APIENABLE-'] = values['APIENABLE']
+                self.user_settings['-APIPORT-'] = api_port
+                self.user_settings['-NDIDISCOVERY-'] = values['NDIDISCOVERY']
+                self.user_settings['-NDIEXTRAIPS-'] = values['NDIEXTRAIPS']
+                self.user_settings['-NDIGROUPS-'] = values['NDIGROUPS']
                 if values['BITFOCUSENABLE']:
-                    self.user_settings['-BITFOCUSPAGE-'] = int(values['BITFOCUSPAGE'])
+                    self.user_settings['-BITFOCUSPAGE-'] = bitfocus_page
                     self.user_settings['-BITFOCUSTARGET-'] = values['BITFOCUSTARGET']
                 self.user_settings['-BITFOCUSENABLE-'] = values['BITFOCUSENABLE']
-
-                window.close()
-                sys.exit(0)
+                self.load()
+                saved = True
+                break
 
         window.close()
         # 'fix' for PySimpleGUI/Tkintr issue with threading
         del layout
         del window
         gc.collect()
-
-
-
+        return saved
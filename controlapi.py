@@ -0,0 +1,100 @@
+#
+# Local control API, JSON over HTTP
+#
+# The server only listens on the loopback interface. Each route is a (method, path pattern, handler)
+# tuple, the handler is called with the path match and the decoded JSON body (or None) and returns
+# the object to send back as JSON. See ndidaemon.py for the routes of the headless service.
+#
+import json
+import re
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Largest request body accepted
+MaxBodySize = 65536
+
+
+class ApiError(Exception):
+    """ Raised by a route handler to return an error status """
+    def __init__(self, status: int, message: str):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    server_version = "NDISelector"
+
+    def send_json(self, status: int, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return None
+        if length > MaxBodySize:
+            raise ApiError(413, "request too large")
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "bad JSON")
+
+    def dispatch(self, method: str):
+        path = unquote(self.path.split('?', 1)[0]).rstrip('/') or '/'
+        try:
+            allowed = False
+            for route_method, pattern, handler in self.server.routes:
+                match = pattern.fullmatch(path)
+                if match is None:
+                    continue
+                allowed = True
+                if route_method == method:
+                    self.send_json(200, handler(match, self.read_json()))
+                    return
+            if allowed:
+                raise ApiError(405, f"{method} not allowed for {path}")
+            raise ApiError(404, f"no such resource: {path}")
+        except ApiError as exc:
+            self.send_json(exc.status, {"error": exc.message})
+        except Exception as exc:
+            print("ControlServer: exception ", exc)
+            self.send_json(500, {"error": str(exc)})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ControlServer:
+    """ Serve the routes on 127.0.0.1:port from a background thread """
+    def __init__(self, routes: list, port: int, host: str = "127.0.0.1"):
+        self.httpd = ThreadingHTTPServer((host, port), ControlRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="ControlServer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def address(self) -> tuple:
+        return self.httpd.server_address
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,69 +1,438 @@
-import NDIlib as Ndi
+import ndibackend
+from ndibackend import Source
 from PIL import Image
+import numpy as np
 import io
 import PySimpleGUI as Sg
 import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
+# Default number of preview receivers kept connected
+ReceiverPoolSize = 4
 
-def getframe_ndi(ndi_src: Ndi.Source):
-    """ Get one video frame as PNG data """
+# Format of the data sent to the viewer. PPM is uncompressed, so much cheaper to produce than PNG,
+# and Tk can load it directly
+ViewerFormat = "PPM"
 
-    if ndi_src is None:
-        return None
+# Per-camera quirks for previews, matched against the NDI source name
+#   bandwidth - receiver bandwidth. Kludge - AVKANS cameras don't support "BANDWIDTH_LOWEST"
+#   deadline - how long to wait for a frame (seconds)
+DefaultProfile = {'bandwidth': ndibackend.BANDWIDTH_LOWEST, 'deadline': 2.5}
+SourceProfiles = {
+    'BIRDDOG': {'bandwidth': ndibackend.BANDWIDTH_LOWEST, 'deadline': 2.5},
+    'AVKANS': {'bandwidth': ndibackend.BANDWIDTH_HIGHEST, 'deadline': 5.0},
+}
+# source name -> deadline (seconds), overriding the profile
+capture_deadlines = {}
+
+
+def source_profile(name: str) -> dict:
+    for model, profile in SourceProfiles.items():
+        if model in name:
+            return profile
+    return DefaultProfile
+
+
+def capture_deadline(name: str) -> float:
+    """ How long to wait for a frame from a source """
+    deadline = capture_deadlines.get(name)
+    if deadline is None:
+        deadline = source_profile(name)['deadline']
+    return deadline
+
+
+def recv_create(ndi_src: Source, backend: ndibackend.NDIBackend):
+    """ Create a low bandwidth receiver for previewing a source """
+    return backend.recv_create(ndi_src, source_profile(ndi_src.ndi_name)['bandwidth'])
+
+
+class CaptureMetrics:
+    """ Preview timings for each source:
+        - connect: receiver creation to the first frame of any kind (status change, metadata...)
+        - first_frame: receiver creation to the first video frame
+        - timeouts: captures which gave up before a video frame arrived
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}
+
+    def _entry(self, name: str) -> dict:
+        entry = self.sources.get(name)
+        if entry is None:
+            entry = {'connect_ms': None, 'first_frame_ms': None, 'receivers': 0,
+                     'frames': 0, 'timeouts': 0}
+            self.sources[name] = entry
+        return entry
+
+    def connected(self, name: str, seconds: float):
+        with self.lock:
+            entry = self._entry(name)
+            entry['connect_ms'] = seconds * 1000.0
+            entry['receivers'] += 1
+
+    def first_frame(self, name: str, seconds: float):
+        with self.lock:
+            self._entry(name)['first_frame_ms'] = seconds * 1000.0
+
+    def frame(self, name: str):
+        with self.lock:
+            self._entry(name)['frames'] += 1
+
+    def timeout(self, name: str):
+        with self.lock:
+            self._entry(name)['timeouts'] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: dict(entry) for name, entry in self.sources.items()}
+
+
+capture_metrics = CaptureMetrics()
+
+
+class PooledReceiver:
+    """ A connected receiver in the ReceiverPool. The lock is held while capturing """
+    def __init__(self, name: str, ndi_recv, backend: ndibackend.NDIBackend):
+        self.name = name
+        self.ndi_recv = ndi_recv
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.created = time.monotonic()
+        self.connected = False
+        self.first_frame = False
+        # Set once the receiver has left the pool, it is destroyed as soon as no capture is using it
+        self.dead = False
+
+    def _destroy(self):
+        if self.ndi_recv is not None:
+            self.backend.recv_destroy(self.ndi_recv)
+            self.ndi_recv = None
+
+    def destroy(self):
+        """ Destroy the receiver, waiting for any capture in progress """
+        with self.lock:
+            self._destroy()
+
+    def retire(self):
+        """ Destroy the receiver, without waiting: if a capture is using it, the capture destroys
+            it when it is done (see ReceiverPool.receiver)
+        """
+        self.dead = True
+        if self.lock.acquire(blocking=False):
+            try:
+                self._destroy()
+            finally:
+                self.lock.release()
+
+
+class ReceiverPool:
+    """ Keep the receivers for recently previewed sources connected, so that previewing
+        the same source again doesn't pay the NDI connection setup cost.
+        Receivers are keyed by NDI source name, the least recently used receiver is
+        destroyed when there are more than <size>.
+        Receivers leaving the pool are retired, so the caller (often the GUI) never waits for a capture
+    """
+    def __init__(self, size: int = ReceiverPoolSize):
+        self.size = size
+        self.lock = threading.Lock()
+        self.receivers = OrderedDict()
+
+    def resize(self, size: int):
+        self.size = max(size, 1)
+        self._evict()
+
+    def _evict(self, keep: int = None):
+        if keep is None:
+            keep = self.size
+        evicted = []
+        with self.lock:
+            while len(self.receivers) > keep:
+                _, receiver = self.receivers.popitem(last=False)
+                evicted.append(receiver)
+        # Outside the pool lock. A receiver in use is destroyed by its capture
+        for receiver in evicted:
+            receiver.retire()
+
+    @contextmanager
+    def receiver(self, ndi_src: Source):
+        """ Context manager, returns a PooledReceiver for the source (or None), which is
+            reserved for the caller until the context exits
+        """
+        name = ndi_src.ndi_name
+        with self.lock:
+            receiver = self.receivers.get(name)
+            if receiver is not None:
+                self.receivers.move_to_end(name)
+
+        if receiver is None:
+            backend = ndibackend.get()
+            ndi_recv = recv_create(ndi_src, backend)
+            if ndi_recv is None:
+                yield None
+                return
+            receiver = PooledReceiver(name, ndi_recv, backend)
+            with self.lock:
+                old = self.receivers.pop(name, None)
+                self.receivers[name] = receiver
+            if old is not None:
+                old.retire()
+            self._evict()
+
+        try:
+            with receiver.lock:
+                # May have been evicted while waiting for the lock
+                yield receiver if not receiver.dead else None
+        finally:
+            # Evicted during the capture: now the lock is released, destroy it, unless another
+            # capture has the lock, which will do it instead
+            if receiver.dead:
+                receiver.retire()
+
+    def discard(self, name: str):
+        """ Drop the receiver for a source, e.g. after an error """
+        with self.lock:
+            receiver = self.receivers.pop(name, None)
+        if receiver is not None:
+            receiver.retire()
 
-    ndi_recv_create = Ndi.RecvCreateV3(source_to_connect_to=ndi_src)
-    ndi_recv_create.color_format = Ndi.RECV_COLOR_FORMAT_BGRX_BGRA
-    # Kludge - AVKANS cameras don't support "BANDWIDTH_LOWEST"
-    # TODO: figure out a cleaner way to do this
-    if 'BIRDDOG' in ndi_src.ndi_name:
-        ndi_recv_create.bandwidth = Ndi.RECV_BANDWIDTH_LOWEST
-    elif 'AVKANS' in ndi_src.ndi_name:
-        ndi_recv_create.bandwidth = Ndi.RECV_BANDWIDTH_HIGHEST
-    else:
-        ndi_recv_create.bandwidth = Ndi.RECV_BANDWIDTH_LOWEST
-
-    ndi_recv_create.allow_video_fields = False
-    ndi_recv = Ndi.recv_create_v3(ndi_recv_create)
+    def clear(self):
+        """ Destroy all the receivers """
+        self._evict(keep=0)
+
+
+receiver_pool = ReceiverPool()
+
+
+def recv_latest_video(receiver: PooledReceiver, timeout: float = 0.0):
+    """ Drain the frames already queued on a receiver, returning the newest video frame.
+        If there is none, wait up to timeout (seconds) for one to arrive, returning it as soon as
+        it does, or None if it doesn't. Returns False if the receiver has failed
+    """
+    ndi_recv = receiver.ndi_recv
+    backend = receiver.backend
+    deadline = time.monotonic() + timeout
+    wait_ms = 0
+    video = None
+    while True:
+        t, v = backend.recv_capture(ndi_recv, wait_ms)
+        if t != ndibackend.FRAME_NONE and not receiver.connected:
+            receiver.connected = True
+            capture_metrics.connected(receiver.name, time.monotonic() - receiver.created)
+        if t == ndibackend.FRAME_NONE:
+            if video is not None:
+                return video
+            # Nothing queued, block in NDI until a frame arrives or the deadline passes
+            wait_ms = int((deadline - time.monotonic()) * 1000)
+            if wait_ms <= 0:
+                return None
+            continue
+        if t == ndibackend.FRAME_ERROR:
+            if video is not None:
+                backend.recv_free_video(ndi_recv, video)
+            return False
+        if t == ndibackend.FRAME_VIDEO:
+            if video is not None:
+                backend.recv_free_video(ndi_recv, video)
+            video = v
+            if not receiver.first_frame:
+                receiver.first_frame = True
+                capture_metrics.first_frame(receiver.name, time.monotonic() - receiver.created)
+            # Keep draining, without waiting, in case a newer frame is queued
+            wait_ms = 0
+            continue
+        # Audio or metadata: don't let a source which only sends those (or whose video has stalled)
+        # hold the receiver past the deadline
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if video is not None:
+            if remaining_ms <= 0:
+                return video
+        else:
+            wait_ms = remaining_ms
+            if wait_ms <= 0:
+                return None
+
+
+@contextmanager
+def transient_receiver(ndi_src: Source):
+    """ Context manager, returns a PooledReceiver for the source (or None) which is destroyed on exit """
+    backend = ndibackend.get()
+    ndi_recv = recv_create(ndi_src, backend)
     if ndi_recv is None:
+        yield None
+        return
+    receiver = PooledReceiver(ndi_src.ndi_name, ndi_recv, backend)
+    try:
+        with receiver.lock:
+            yield receiver
+    finally:
+        receiver.destroy()
+
+
+def frame_array(v) -> np.ndarray:
+    """ Return a (yres, xres, 4) view of a BGRX/BGRA video frame, without copying it """
+    data = np.asarray(v.data)
+    if data.ndim == 3:
+        return data
+    stride = v.line_stride_in_bytes or v.xres * 4
+    return np.lib.stride_tricks.as_strided(data, shape=(v.yres, v.xres, 4), strides=(stride, 4, 1))
+
+
+def frame_to_image(v, imgsize: tuple[int, int] = None) -> Image:
+    """ Convert a BGRX/BGRA video frame to an RGB Image.
+        If imgsize is given the frame is decimated, by taking every n'th pixel of every n'th line
+        straight from the NDI buffer, to the smallest whole fraction of its size which still
+        covers imgsize. Only that small image is ever copied, the caller can free the frame as
+        soon as this returns.
+    """
+    arr = frame_array(v)
+    step = 1
+    if imgsize is not None:
+        step = max(1, min(v.xres // imgsize[0], v.yres // imgsize[1]))
+    # Reverse the channels, BGR -> RGB, dropping X/A
+    rgb = np.ascontiguousarray(arr[::step, ::step, 2::-1])
+    return Image.fromarray(rgb, "RGB")
+
+
+def getframe_ndi(ndi_src: Source, imgsize: tuple[int, int] = None,
+                 pool: ReceiverPool | None = receiver_pool):
+    """ Get one video frame as an Image, decimated towards imgsize if given.
+        The receiver comes from pool, or is created just for this frame if pool is None
+    """
+
+    if ndi_src is None:
         return None
 
-    tries = 0
-    while True:
-        t, v, _, _ = Ndi.recv_capture_v2(ndi_recv, 0)
-
-        if t == Ndi.FRAME_TYPE_VIDEO:
-            img = Image.frombytes("RGBA", (v.xres, v.yres), v.data, "raw")
-            Ndi.recv_free_video_v2(ndi_recv, v)
-            break
-        time.sleep(0.25)
-        tries = tries + 1
-        if tries > 10:
-            img = None
-            break
-
-    Ndi.recv_destroy(ndi_recv)
+    img = None
+    name = ndi_src.ndi_name
+    manager = pool.receiver(ndi_src) if pool is not None else transient_receiver(ndi_src)
+    with manager as receiver:
+        if receiver is None:
+            return None
+
+        v = recv_latest_video(receiver, capture_deadline(name))
+        if v is None:
+            capture_metrics.timeout(name)
+        elif v is not False:
+            try:
+                img = frame_to_image(v, imgsize)
+            finally:
+                receiver.backend.recv_free_video(receiver.ndi_recv, v)
+            capture_metrics.frame(name)
+
+    if v is False and pool is not None:
+        pool.discard(ndi_src.ndi_name)
     return img
 
 
 def getframe_blank(imgsize: tuple[int, int]) -> Image:
     """ return a blank image"""
-    img = Image.new("RGBA", size=imgsize, color="Black")
+    img = Image.new("RGB", size=imgsize, color="Black")
     return img
 
 
-def getframe_task(window: Sg.Window, ndi_src: Ndi.Source, imgsize: tuple[int, int]):
-    """ External function - call as a task lambda from the PySimpleGUI window manager """
+def viewer_data(img: Image, imgsize: tuple[int, int]) -> bytes:
+    """ Convert an image to data for the viewer """
+    # Already decimated to no more than twice imgsize, so this is cheap
+    img.thumbnail(imgsize, Image.BILINEAR)
+    bio = io.BytesIO()
+    img.save(bio, format=ViewerFormat)
+    data = bio.getvalue()
+    bio.close()
+    return data
+
+
+def getframe_task(window: Sg.Window, ndi_src: Source, imgsize: tuple[int, int], cache=None):
+    """ External function - call as a task lambda from the PySimpleGUI window manager
+        If a thumbnail cache is given, the new frame is also stored there
+    """
     try:
-        img = getframe_ndi(ndi_src)
+        img = getframe_ndi(ndi_src, imgsize)
         if img is None:
             img = getframe_blank(imgsize)
+        elif cache is not None:
+            data = viewer_data(img, imgsize)
+            cache.put(ndi_src.ndi_name, data)
+            window.write_event_value(('-THREAD-', 'NDI_IMAGE'), data)
+            return
 
         if img is not None:
-            img.thumbnail(imgsize)
-            bio = io.BytesIO()
-            img.save(bio, format="PNG")
-            window.write_event_value(('-THREAD-', 'NDI_IMAGE'), bio.getvalue())
-            bio.close()
+            window.write_event_value(('-THREAD-', 'NDI_IMAGE'), viewer_data(img, imgsize))
     except Exception as exc:
         print("getframe_task: exception ", exc)
 
+
+class LivePreview:
+    """ Stream frames from one source into the viewer at a limited rate.
+        At most one frame is in flight: the worker doesn't capture another frame until the GUI
+        has drawn the last one and called frame_drawn(), so it can never queue work on the
+        event loop faster than the loop can draw it. Frames are sent as ('-THREAD-', 'NDI_LIVE')
+        events with the value (generation, data), frames from an earlier generation are stale.
+    """
+    def __init__(self, window: Sg.Window, imgsize: tuple[int, int], fps: float = 4.0):
+        self.window = window
+        self.imgsize = imgsize
+        self.fps = fps
+        self.generation = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.drawn = threading.Event()
+
+    def rate_set(self, fps: float):
+        self.fps = min(max(fps, 0.5), 30.0)
+
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, ndi_src: Source):
+        """ Start streaming a source, replacing any source currently streaming """
+        self.stop()
+        if ndi_src is None:
+            return
+        self.generation += 1
+        self.stop_event = threading.Event()
+        self.drawn = threading.Event()
+        self.drawn.set()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(ndi_src, self.generation, self.stop_event, self.drawn),
+                                       name="LivePreview")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stop streaming. Doesn't wait for the worker, which may be in the middle of a capture """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.drawn.set()
+            self.thread = None
+            self.generation += 1
+
+    def frame_drawn(self):
+        """ Called from the GUI once a frame has been drawn """
+        self.drawn.set()
+
+    def _run(self, ndi_src: Source, generation: int, stop_event: threading.Event,
+             drawn: threading.Event):
+        next_frame = time.monotonic()
+        while not stop_event.is_set():
+            drawn.wait()
+            delay = next_frame - time.monotonic()
+            if delay > 0 and stop_event.wait(delay):
+                break
+            next_frame = time.monotonic() + 1.0 / self.fps
+
+            try:
+                img = getframe_ndi(ndi_src, self.imgsize)
+                if img is None or stop_event.is_set():
+                    continue
+                data = viewer_data(img, self.imgsize)
+            except Exception as exc:
+                print("LivePreview: exception ", exc)
+                continue
+
+            if stop_event.is_set():
+                break
+            drawn.clear()
+            self.window.write_event_value(('-THREAD-', 'NDI_LIVE'), (generation, data))
+
@@ -0,0 +1,423 @@
+#
+# NDI backends
+#
+# The rest of the program only uses NDI through the backend returned by get(): discovery (find_*),
+# routing (routing_*) and receiving video (recv_*). NDIlibBackend is the real thing; FakeBackend is
+# an in-process, deterministic stand-in, which can advertise thousands of sources, make them come
+# and go, and generate synthetic video frames, so that the program can be run, measured and tested
+# without NDI or any cameras (see benchmarks/ndi_bench.py).
+#
+# The backend is chosen the first time get() is called, unless use() has been called first.
+# Setting NDISELECTOR_BACKEND=fake (or fake:<number of sources>) in the environment runs the
+# program against a FakeBackend.
+#
+# NDI only reads the Discovery Server addresses from its configuration file, when the library is
+# loaded, so they must be given to configure() before get() is first called. NDIlibBackend writes
+# them into a copy of the user's NDI configuration, and points NDI_CONFIG_DIR at it.
+#
+import json
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+# An NDI source, as returned by find_get_current_sources(). Sources have ndi_name and url_address
+Source = Any
+
+# Receiver bandwidths
+BANDWIDTH_LOWEST = 'lowest'
+BANDWIDTH_HIGHEST = 'highest'
+
+# Frame types returned by recv_capture(). Audio and metadata frames are freed by the backend,
+# and returned as FRAME_OTHER
+FRAME_NONE = 'none'
+FRAME_VIDEO = 'video'
+FRAME_ERROR = 'error'
+FRAME_OTHER = 'other'
+
+
+class NDIBackend(ABC):
+    """ The NDI operations used by the program. Finders, routers and receivers are opaque handles.
+        Video frames have data (BGRX/BGRA pixels), xres, yres and line_stride_in_bytes
+    """
+    @abstractmethod
+    def find_create(self, show_local_sources: bool = True, groups: str = None, extra_ips: str = None):
+        """ Create a finder. groups and extra_ips are comma separated, None for the NDI defaults """
+
+    @abstractmethod
+    def find_destroy(self, finder):
+        ...
+
+    @abstractmethod
+    def find_wait_for_sources(self, finder, timeout_ms: int) -> bool:
+        """ Wait up to timeout_ms for the set of sources to change, returns True if it has """
+
+    @abstractmethod
+    def find_get_current_sources(self, finder) -> list:
+        ...
+
+    @abstractmethod
+    def routing_create(self, name: str):
+        """ Advertise a routed source called name """
+
+    @abstractmethod
+    def routing_change(self, router, source: Source):
+        ...
+
+    @abstractmethod
+    def routing_clear(self, router):
+        ...
+
+    @abstractmethod
+    def routing_destroy(self, router):
+        ...
+
+    @abstractmethod
+    def recv_create(self, source: Source, bandwidth: str = BANDWIDTH_LOWEST):
+        """ Create a receiver delivering BGRX/BGRA progressive video, or return None """
+
+    @abstractmethod
+    def recv_destroy(self, recv):
+        ...
+
+    @abstractmethod
+    def recv_capture(self, recv, timeout_ms: int) -> tuple:
+        """ Wait up to timeout_ms for a frame, returns (frame type, video frame or None).
+            A video frame must be given back with recv_free_video()
+        """
+
+    @abstractmethod
+    def recv_free_video(self, recv, video):
+        ...
+
+
+class NDIlibBackend(NDIBackend):
+    """ NDI, through the NDIlib (ndi-python) bindings """
+    ConfigName = 'ndi-config.v1.json'
+
+    def __init__(self, discovery_servers: str = None, config_dir: str = None):
+        if discovery_servers is not None and config_dir is not None:
+            self.discovery_config(discovery_servers, config_dir)
+        import NDIlib
+        self.ndi = NDIlib
+        self.bandwidths = {BANDWIDTH_LOWEST: NDIlib.RECV_BANDWIDTH_LOWEST,
+                           BANDWIDTH_HIGHEST: NDIlib.RECV_BANDWIDTH_HIGHEST}
+
+    @classmethod
+    def discovery_config(cls, discovery_servers: str, config_dir: str):
+        """ Write an NDI configuration using the Discovery Servers, based on the user's own
+            configuration if there is one, and tell NDI to use it """
+        user_dir = os.environ.get('NDI_CONFIG_DIR', os.path.join(os.path.expanduser('~'), '.ndi'))
+        try:
+            with open(os.path.join(user_dir, cls.ConfigName)) as f:
+                ndi_config = json.load(f)
+        except (OSError, ValueError):
+            ndi_config = {}
+        ndi_config.setdefault('ndi', {}).setdefault('networks', {})['discovery'] = discovery_servers
+        os.makedirs(config_dir, exist_ok=True)
+        with open(os.path.join(config_dir, cls.ConfigName), 'w') as f:
+            json.dump(ndi_config, f, indent=1)
+        os.environ['NDI_CONFIG_DIR'] = config_dir
+
+    def find_create(self, show_local_sources: bool = True, groups: str = None, extra_ips: str = None):
+        desc = self.ndi.FindCreate()
+        desc.show_local_sources = show_local_sources
+        if groups is not None:
+            desc.groups = groups
+        if extra_ips is not None:
+            desc.extra_ips = extra_ips
+        return self.ndi.find_create_v2(desc)
+
+    def find_destroy(self, finder):
+        self.ndi.find_destroy(finder)
+
+    def find_wait_for_sources(self, finder, timeout_ms: int) -> bool:
+        return self.ndi.find_wait_for_sources(finder, timeout_ms)
+
+    def find_get_current_sources(self, finder) -> list:
+        return self.ndi.find_get_current_sources(finder)
+
+    def routing_create(self, name: str):
+        desc = self.ndi.RoutingCreate()
+        desc.ndi_name = name
+        return self.ndi.routing_create(desc)
+
+    def routing_change(self, router, source: Source):
+        self.ndi.routing_change(router, source)
+
+    def routing_clear(self, router):
+        self.ndi.routing_clear(router)
+
+    def routing_destroy(self, router):
+        self.ndi.routing_destroy(router)
+
+    def recv_create(self, source: Source, bandwidth: str = BANDWIDTH_LOWEST):
+        desc = self.ndi.RecvCreateV3(source_to_connect_to=source)
+        desc.color_format = self.ndi.RECV_COLOR_FORMAT_BGRX_BGRA
+        desc.bandwidth = self.bandwidths[bandwidth]
+        desc.allow_video_fields = False
+        return self.ndi.recv_create_v3(desc)
+
+    def recv_destroy(self, recv):
+        self.ndi.recv_destroy(recv)
+
+    def recv_capture(self, recv, timeout_ms: int) -> tuple:
+        t, v, a, m = self.ndi.recv_capture_v2(recv, timeout_ms)
+        if t == self.ndi.FRAME_TYPE_VIDEO:
+            return FRAME_VIDEO, v
+        if t == self.ndi.FRAME_TYPE_NONE:
+            return FRAME_NONE, None
+        if t == self.ndi.FRAME_TYPE_ERROR:
+            return FRAME_ERROR, None
+        if t == self.ndi.FRAME_TYPE_AUDIO:
+            self.ndi.recv_free_audio_v2(recv, a)
+        elif t == self.ndi.FRAME_TYPE_METADATA:
+            self.ndi.recv_free_metadata(recv, m)
+        return FRAME_OTHER, None
+
+    def recv_free_video(self, recv, video):
+        self.ndi.recv_free_video_v2(recv, video)
+
+
+class FakeSource:
+    def __init__(self, ndi_name: str, url_address: str, groups: frozenset = frozenset({'public'})):
+        self.ndi_name = ndi_name
+        self.url_address = url_address
+        self.groups = groups
+
+    def __repr__(self):
+        return f"FakeSource({self.ndi_name!r})"
+
+
+class FakeFinder:
+    def __init__(self, show_local_sources: bool, groups: str | None):
+        self.show_local_sources = show_local_sources
+        self.groups = frozenset((groups or 'public').split(','))
+        # version of the source table last returned
+        self.version = -1
+
+
+class FakeRouter:
+    def __init__(self, name: str, source: FakeSource):
+        self.name = name
+        # the source advertised for this router
+        self.source = source
+        # the source being routed to it
+        self.routed = None
+
+
+class FakeVideoFrame:
+    def __init__(self, data, timestamp: float):
+        self.data = data
+        self.yres, self.xres = data.shape[:2]
+        self.line_stride_in_bytes = self.xres * 4
+        self.timestamp = timestamp
+
+
+class FakeReceiver:
+    def __init__(self, source: FakeSource, size: tuple):
+        self.source = source
+        self.size = size
+        self.created = time.monotonic()
+        # time the next frame is due
+        self.next_frame = self.created
+        self.frames = 0
+
+
+class FakeBackend(NDIBackend):
+    """ In-process stand-in for NDI. The sources are whatever the caller (or a benchmark) says is on
+        the network; sources_add()/sources_remove()/churn() change it, waking any waiting finders.
+        Receivers deliver synthetic frames at frame_rate, the full frame_size at the highest bandwidth,
+        or a 640x360 proxy at the lowest (like NDI's proxy stream). Routers are advertised as local
+        sources named "<host> (<router name>)", as NDI does. Sources are in the "public" group unless
+        sources_add() is given others, finders only see the groups they ask for.
+        Everything random (which sources churn removes, the frame patterns) comes from seed.
+    """
+    ProxySize = (640, 360)
+    # Frame patterns kept, at the full size they are a few MB each
+    PatternCache = 16
+
+    def __init__(self, sources: int = 0, seed: int = 0, frame_size: tuple = (1920, 1080),
+                 frame_rate: float = 30.0, host: str = "FAKEHOST"):
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.frame_size = frame_size
+        self.frame_rate = frame_rate
+        self.host = host
+        self.cond = threading.Condition()
+        # name -> FakeSource, in the order they appeared
+        self.sources = {}
+        self.local = set()
+        self.version = 0
+        self.next_id = 0
+        # (size, name) -> frame pixels, each source has its own pattern
+        self.patterns = OrderedDict()
+        self.counters = {'routing_changes': 0, 'frames': 0}
+        self.sources_add(sources)
+
+    # The simulated network
+    def _new_sources(self, count: int, groups: frozenset = frozenset({'public'})) -> list:
+        sources = []
+        for _ in range(count):
+            self.next_id += 1
+            sources.append(FakeSource(f"FAKE-{self.next_id:05d} (CAM {self.next_id})",
+                                      f"10.{self.next_id // 65536 % 256}.{self.next_id // 256 % 256}."
+                                      f"{self.next_id % 256}:5961", groups))
+        return sources
+
+    def _advertise(self, sources: list, gone: list = ()):
+        """ Add and remove sources as a single change, waking the finders """
+        with self.cond:
+            for name in gone:
+                self.sources.pop(name, None)
+                self.local.discard(name)
+            for source in sources:
+                self.sources[source.ndi_name] = source
+            self.version += 1
+            self.cond.notify_all()
+
+    def sources_add(self, count: int = 1, groups: str = 'public') -> list:
+        """ Advertise count new sources, in the given groups (comma separated), returns their names """
+        sources = self._new_sources(count, frozenset(groups.split(',')))
+        self._advertise(sources)
+        return [source.ndi_name for source in sources]
+
+    def sources_remove(self, names: list):
+        """ Stop advertising sources """
+        self._advertise([], names)
+
+    def churn(self, added: int, removed: int) -> tuple:
+        """ Remove <removed> randomly chosen (non local) sources and add <added> new ones, as a single
+            change. Returns (added names, removed names)
+        """
+        with self.cond:
+            candidates = [name for name in self.sources if name not in self.local]
+        gone = self.random.sample(candidates, min(removed, len(candidates)))
+        sources = self._new_sources(added)
+        self._advertise(sources, gone)
+        return [source.ndi_name for source in sources], gone
+
+    # Discovery
+    def find_create(self, show_local_sources: bool = True, groups: str = None, extra_ips: str = None):
+        return FakeFinder(show_local_sources, groups)
+
+    def find_destroy(self, finder):
+        pass
+
+    def find_wait_for_sources(self, finder, timeout_ms: int) -> bool:
+        with self.cond:
+            self.cond.wait_for(lambda: finder.version != self.version, timeout_ms / 1000.0)
+            return finder.version != self.version
+
+    def find_get_current_sources(self, finder) -> list:
+        with self.cond:
+            finder.version = self.version
+            return [source for name, source in self.sources.items()
+                    if (finder.show_local_sources or name not in self.local) and source.groups & finder.groups]
+
+    # Routing
+    def routing_create(self, name: str):
+        router = FakeRouter(name, FakeSource(f"{self.host} ({name})", "127.0.0.1:5961"))
+        with self.cond:
+            self.local.add(router.source.ndi_name)
+        self._advertise([router.source])
+        return router
+
+    def routing_change(self, router, source: Source):
+        router.routed = source
+        self.counters['routing_changes'] += 1
+
+    def routing_clear(self, router):
+        router.routed = None
+        self.counters['routing_changes'] += 1
+
+    def routing_destroy(self, router):
+        self.sources_remove([router.source.ndi_name])
+
+    # Receiving
+    def recv_create(self, source: Source, bandwidth: str = BANDWIDTH_LOWEST):
+        size = self.frame_size if bandwidth == BANDWIDTH_HIGHEST else self.ProxySize
+        return FakeReceiver(source, size)
+
+    def recv_destroy(self, recv):
+        pass
+
+    def pattern(self, size: tuple, name: str):
+        """ Return the frame pixels for a source, a colour gradient which differs between sources """
+        key = (size, name)
+        data = self.patterns.get(key)
+        if data is None:
+            import numpy as np
+            xres, yres = size
+            rng = random.Random(f"{self.seed}:{name}")
+            base = np.array([rng.randrange(256) for _ in range(3)] + [255], dtype=np.uint16)
+            ramp_x = np.linspace(0, 255, xres, dtype=np.uint16)[None, :, None]
+            ramp_y = np.linspace(0, 255, yres, dtype=np.uint16)[:, None, None]
+            data = ((base + ramp_x * np.array([1, 0, 0, 0], dtype=np.uint16) +
+                     ramp_y * np.array([0, 1, 0, 0], dtype=np.uint16)) % 256).astype(np.uint8)
+            data.flags.writeable = False
+            self.patterns[key] = data
+            while len(self.patterns) > self.PatternCache:
+                self.patterns.popitem(last=False)
+        return data
+
+    def recv_capture(self, recv, timeout_ms: int) -> tuple:
+        if recv.source.ndi_name not in self.sources:
+            # gone away, NDI waits for it to come back
+            time.sleep(timeout_ms / 1000.0)
+            return FRAME_NONE, None
+        now = time.monotonic()
+        if recv.next_frame > now:
+            if recv.next_frame - now > timeout_ms / 1000.0:
+                time.sleep(timeout_ms / 1000.0)
+                return FRAME_NONE, None
+            time.sleep(recv.next_frame - now)
+            now = recv.next_frame
+        # Deliver the newest frame which has arrived, older ones are dropped (like a full receiver queue)
+        interval = 1.0 / self.frame_rate
+        recv.next_frame = recv.created + (int((now - recv.created) / interval) + 1) * interval
+        recv.frames += 1
+        with self.cond:
+            self.counters['frames'] += 1
+        return FRAME_VIDEO, FakeVideoFrame(self.pattern(recv.size, recv.source.ndi_name), now)
+
+    def recv_free_video(self, recv, video):
+        pass
+
+
+_backend: NDIBackend | None = None
+_backend_lock = threading.Lock()
+# Discovery Servers for the NDIlib backend, see configure()
+_discovery_servers = None
+_config_dir = None
+
+
+def configure(discovery_servers: str | None, config_dir: str):
+    """ Use NDI Discovery Servers (comma separated addresses), instead of mDNS. Must be called before
+        the backend is created. config_dir is where the NDI configuration file is written """
+    global _discovery_servers, _config_dir
+    _discovery_servers = discovery_servers
+    _config_dir = config_dir
+
+
+def use(backend: NDIBackend):
+    """ Set the backend, before anything which uses NDI is created """
+    global _backend
+    _backend = backend
+
+
+def get() -> NDIBackend:
+    """ Return the backend, creating the default one if use() hasn't been called """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            choice = os.environ.get('NDISELECTOR_BACKEND', 'ndilib')
+            if choice.startswith('fake'):
+                _, _, count = choice.partition(':')
+                _backend = FakeBackend(sources=int(count or 20))
+            else:
+                _backend = NDIlibBackend(_discovery_servers, _config_dir)
+        return _backend
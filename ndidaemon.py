@@ -0,0 +1,263 @@
+#
+# Headless NDI Camera Selector
+#
+# Runs the NDI routers and the VISCA relay as a service, without PySimpleGUI or any of the
+# preview/image modules, using the same settings file (and saved camera state) as the GUI.
+# Routing and PTZ addresses are controlled through a JSON API on 127.0.0.1:
+#
+#   GET  /cameras                   cameras, with their source, PTZ address and PTZ state
+#   PUT  /cameras                   {"count": n}, add or remove cameras at the end of the list
+#   GET  /cameras/<n>
+#   PUT  /cameras/<n>               {"source": "<NDI source name>"}, "None" clears the camera
+#   GET  /sources                   NDI sources currently known, with their PTZ addresses, and how long
+#                                   after startup each NDI finder (mDNS, extra IPs...) first reported them
+#   PUT  /ptz                       {"source": "<NDI source name>", "ptz": "<host>"}, "" resets the PTZ
+#   GET  /stats                     VISCA relay counters for each camera
+#   GET  /stats/companion           Companion notification counters (null if Companion isn't enabled)
+#   GET  /presets                   presets, name -> {camera number: {"source": name, "ptz": host}}
+#   PUT  /presets/<name>            save a preset, from the body, or from the current cameras if there is no body
+#   DELETE /presets/<name>
+#   POST /presets/<name>/recall     set the cameras in a preset, returns what changed and how long it took
+#
+# Example:
+#   python ndidaemon.py --port 10080
+#   curl -X PUT -d '{"source": "BIRDDOG-1 (CAM)"}' http://127.0.0.1:10080/cameras/1
+#
+import argparse
+import signal
+import threading
+import time
+import config
+import ndirouter
+import resolver
+import controlapi
+import ndibackend
+from controlapi import ApiError
+from ndisources import NDISourceList, CameraList, ndi_None, DiscoveryWait, preset_valid, relays_create, \
+    relay_options_apply
+
+# How long a PUT /ptz waits for the PTZ hostname to resolve (seconds)
+ResolveWait = 5.0
+
+
+class Daemon:
+    def __init__(self, cfg: config.Config):
+        self.config = cfg
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        ndibackend.configure(cfg.discovery_servers(), cfg.settings_dir())
+
+        count = cfg.camera_count()
+        self.ptz_resolver = resolver.Resolver()
+        viscalist, self.notifier = relays_create(cfg, count, self.ptz_resolver)
+        self.cameras = CameraList(count=count, cam_name=cfg.cam_name(),
+                                  routerlist=ndirouter.NDIRouterList(count, cfg.cam_name()),
+                                  viscalist=viscalist)
+
+        self.ndi_sources = NDISourceList(cfg.cam_name(), finders=cfg.discovery_finders())
+
+        # saved cameras are set as their sources are discovered
+        ptz, camera_list = cfg.load_camera_state()
+        self.ndi_sources.src_load(ptz)
+        self.cameras.pending_set(camera_list)
+
+    def routes(self) -> list:
+        return [("GET", "/cameras", self.get_cameras),
+                ("PUT", "/cameras", self.put_cameras),
+                ("GET", r"/cameras/(\d+)", self.get_camera),
+                ("PUT", r"/cameras/(\d+)", self.put_camera),
+                ("GET", "/sources", self.get_sources),
+                ("PUT", "/ptz", self.put_ptz),
+                ("GET", "/stats", self.get_stats),
+                ("GET", "/stats/companion", self.get_companion_stats),
+                ("GET", "/presets", self.get_presets),
+                ("PUT", "/presets/([^/]+)", self.put_preset),
+                ("DELETE", "/presets/([^/]+)", self.delete_preset),
+                ("POST", "/presets/([^/]+)/recall", self.recall_preset)]
+
+    def save_camera_state(self):
+        self.config.save_camera_state(self.ndi_sources.src_save(), self.cameras.saved_names())
+
+    def camera_index(self, match) -> int:
+        idx = int(match.group(1)) - 1
+        if idx < 0 or idx >= self.cameras.max():
+            raise ApiError(404, f"no camera {match.group(1)}")
+        return idx
+
+    def camera_info(self, idx: int, ptz_states: list = None) -> dict:
+        """ ptz_states is from cameras.ptz_states(), when listing every camera """
+        src = self.cameras.cam_source_get(idx)
+        if src is ndi_None:
+            ptz_state = None
+        elif ptz_states is None:
+            ptz_state = self.cameras.ptz_state(idx)
+        else:
+            ptz_state = ptz_states[idx] if idx < len(ptz_states) else None
+        return {"camera": idx + 1,
+                "name": self.cameras.cam_name(idx).rstrip(':'),
+                "source": src.name_get(),
+                "ptz": src.ptz_get() if src is not ndi_None else None,
+                "ptz_state": ptz_state}
+
+    def cameras_info(self) -> list:
+        ptz_states = self.cameras.ptz_states()
+        return [self.camera_info(idx, ptz_states) for idx in range(self.cameras.max())]
+
+    def get_cameras(self, match, body):
+        with self.lock:
+            return self.cameras_info()
+
+    def put_cameras(self, match, body):
+        count = body.get("count") if isinstance(body, dict) else None
+        if not isinstance(count, int) or not 1 <= count <= config.MaxCameraCount:
+            raise ApiError(400, f'expected {{"count": <1 to {config.MaxCameraCount}>}}')
+        with self.lock:
+            self.cameras.resize(count)
+            self.config.camera_count_set(count)
+            relay_options_apply(self.cameras.viscalist, self.config)
+            self.save_camera_state()
+            return self.cameras_info()
+
+    def get_camera(self, match, body):
+        with self.lock:
+            return self.camera_info(self.camera_index(match))
+
+    def put_camera(self, match, body):
+        if not isinstance(body, dict) or not isinstance(body.get("source"), str):
+            raise ApiError(400, 'expected {"source": "<NDI source name>"}')
+        with self.lock:
+            idx = self.camera_index(match)
+            src = self.ndi_sources.find(body["source"])
+            if src is None:
+                raise ApiError(404, "no such NDI source: " + body["source"])
+            self.cameras.cam_source_set(idx, src)
+            self.save_camera_state()
+            return self.camera_info(idx)
+
+    def get_sources(self, match, body):
+        with self.lock:
+            sources = [self.ndi_sources.find(name) for name in self.ndi_sources.srclist()[1:]]
+            discovery = self.ndi_sources.discovery_stats()
+            return [{"name": src.name_get(), "ptz": src.ptz_get(),
+                     "discovery_ms": {label: round(ms, 1) for label, ms in discovery.get(src.name_get(), {}).items()}}
+                    for src in sources]
+
+    def put_ptz(self, match, body):
+        if not isinstance(body, dict) or not isinstance(body.get("source"), str) \
+                or not isinstance(body.get("ptz"), str):
+            raise ApiError(400, 'expected {"source": "<NDI source name>", "ptz": "<host>"}')
+        ptz_str = body["ptz"]
+        with self.lock:
+            src = self.ndi_sources.find(body["source"])
+            if src is None or not src.dynamic():
+                raise ApiError(404, "no such NDI source: " + body["source"])
+
+        # Make sure PTZ host name is known, empty string means reset PTZ name to default
+        if ptz_str != '':
+            done = threading.Event()
+            result = []
+            self.ptz_resolver.resolve(ptz_str, lambda host, address: (result.append(address), done.set()))
+            if not done.wait(ResolveWait) or result[0] is None:
+                raise ApiError(404, "PTZ not found: " + ptz_str)
+
+        with self.lock:
+            src.ptz_set(ptz_str)
+            cameras = []
+            for idx in range(self.cameras.max()):
+                if self.cameras.cam_source_get(idx) is src:
+                    self.cameras.cam_source_set(idx, src)
+                    cameras.append(self.camera_info(idx))
+            self.save_camera_state()
+            return {"source": src.name_get(), "ptz": src.ptz_get(), "cameras": cameras}
+
+    def get_stats(self, match, body):
+        with self.lock:
+            stats = self.cameras.relay_stats()
+        return [dict(stats[idx], camera=idx + 1) for idx in range(len(stats))]
+
+    def get_companion_stats(self, match, body):
+        return None if self.notifier is None else self.notifier.stats()
+
+    def get_presets(self, match, body):
+        with self.lock:
+            return self.config.presets()
+
+    def put_preset(self, match, body):
+        if body is not None and not preset_valid(body):
+            raise ApiError(400, 'expected {"<camera number>": {"source": "<NDI source name>", "ptz": "<host>"}}')
+        with self.lock:
+            preset = self.cameras.preset() if body is None else body
+            self.config.preset_set(match.group(1), preset)
+            return preset
+
+    def delete_preset(self, match, body):
+        with self.lock:
+            if match.group(1) not in self.config.presets():
+                raise ApiError(404, "no such preset: " + match.group(1))
+            self.config.preset_delete(match.group(1))
+            return {}
+
+    def recall_preset(self, match, body):
+        with self.lock:
+            preset = self.config.presets().get(match.group(1))
+            if preset is None:
+                raise ApiError(404, "no such preset: " + match.group(1))
+            result = self.cameras.recall(preset, self.ndi_sources)
+            self.save_camera_state()
+        result["changed"] = [idx + 1 for idx in result["changed"]]
+        result["ptz"] = [idx + 1 for idx in result["ptz"]]
+        return result
+
+    def run(self):
+        """ Watch for NDI sources appearing/disappearing, and restore saved routes as their sources appear.
+            NDI is waited on without holding the lock, so API requests are never held up by discovery
+        """
+        while not self.stop_event.is_set():
+            changed = self.ndi_sources.wait(DiscoveryWait)
+            with self.lock:
+                in_use = set(self.cameras.source_names())
+                diff = self.ndi_sources.update(in_use=in_use, changed=changed)
+                if diff.added:
+                    self.cameras.pending_apply(self.ndi_sources)
+                if diff.updated:
+                    self.cameras.sources_updated(diff.updated, self.ndi_sources)
+
+    def close(self):
+        self.stop_event.set()
+        self.cameras.viscalist.close()
+        if self.notifier is not None:
+            self.notifier.close()
+        self.ptz_resolver.close()
+        with self.lock:
+            self.ndi_sources.delete()
+        self.config.close()
+
+
+def main():
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(description=f"{config.ProgName} - headless service")
+    parser.add_argument("--settings", help="settings file (default: the GUI's settings file)")
+    parser.add_argument("--port", type=int, help="control API port (default: the -APIPORT- setting)")
+    args = parser.parse_args()
+
+    cfg = config.Config(config.JsonSettings(args.settings))
+    port = args.port if args.port is not None else cfg.api_port()
+
+    daemon = Daemon(cfg)
+    # Stop cleanly (saving the camera state) when the service is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop_event.set())
+    server = controlapi.ControlServer(daemon.routes(), port)
+    print(f"{config.ProgName}: {cfg.camera_count()} cameras, control API on "
+          f"http://127.0.0.1:{port}/, started in {(time.perf_counter() - start) * 1000:.0f}ms", flush=True)
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,41 @@
 #
 # Library for NDI Router instances
 #
-import NDIlib as Ndi
+import ndibackend
+from ndibackend import NDIBackend, Source
 
 class NDIRoutingInstance(dict):
     """ Manipulate a single routing instance"""
-    def __init__(self, name: str):
-        create_desc = Ndi.RoutingCreate()
-        create_desc.ndi_name = name
-        dict.__init__(self, name=name, active=False, ndi=Ndi.routing_create(create_desc))
+    def __init__(self, name: str, backend: NDIBackend):
+        dict.__init__(self, name=name, active=False, ndi=backend.routing_create(name))
+        self.backend = backend
 
-    def set_routing(self, ndi_source: Ndi.Source | None):
+    def set_routing(self, ndi_source: Source | None):
         if ndi_source is None:
-            Ndi.routing_clear(self["ndi"])
+            self.backend.routing_clear(self["ndi"])
         else:
-            Ndi.routing_change(self["ndi"], ndi_source)
+            self.backend.routing_change(self["ndi"], ndi_source)
+
+    def destroy(self):
+        """ Stop advertising the routed source """
+        self.backend.routing_destroy(self["ndi"])
 
 class NDIRouterList:
     """ Manipulate the list of NDI Router instances"""
-    def __init__(self, count, cam_name):
+    def __init__(self, count, cam_name, backend: NDIBackend = None):
+        self.cam_name = cam_name
+        self.backend = backend if backend is not None else ndibackend.get()
         self.router_list = []
-        for x in range(count):
-            self.router_list.insert(x, NDIRoutingInstance(cam_name + str(x+1)))
-            self.router_list[x].set_routing(None)
+        self.resize(count)
+
+    def resize(self, count):
+        """ Add or remove routing instances at the end of the list, the others are left alone """
+        while len(self.router_list) < count:
+            router = NDIRoutingInstance(self.cam_name + str(len(self.router_list) + 1), self.backend)
+            router.set_routing(None)
+            self.router_list.append(router)
+        while len(self.router_list) > count:
+            self.router_list.pop().destroy()
 
-    def set_routing(self, index, ndi_source: Ndi.Source | None):
+    def set_routing(self, index, ndi_source: Source | None):
         self.router_list[index].set_routing(ndi_source)
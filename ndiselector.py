@@ -1,251 +1,397 @@
-from os import path
+# The frozen executable is also the VISCA relay process (see relayprocess.worker_command), which
+# must not set up the GUI, so that is checked before anything else
 import sys
+if __name__ == "__main__" and sys.argv[1:2] == ['--visca-relay-process']:
+    import relayprocess
+    relayprocess.worker_main(sys.argv[2:])
+    sys.exit(0)
+
+# The startup profiler goes first, so that it times the imports below
+import startup
+profiler = startup.StartupProfiler()
+
+from os import path
 import PySimpleGUI as Sg
-import NDIlib as Ndi
-import time
-import re
 import ndirouter
 import viscarelay
-import ndi_image
-import socket
+import relayprocess
+import sourceindex
+import resolver
 from config import ProgName
 import config
-import threading
 import companion
-from typing import List, Dict
+import controlapi
+import ndibackend
+from concurrent.futures import ThreadPoolExecutor
+from ndisources import NDISource, NDISourceList, CameraList, ndi_None, DiscoveryWait, relays_create, \
+    relay_options_apply, relay_companion_set
+from typing import Dict
 Debug = False
 
-config = config.Config()
-bitfocus_info = config.bitfocus_info()
-if bitfocus_info is not None:
-    bitfocus = companion.Companion(target=bitfocus_info[0],
-                                   page=bitfocus_info[1],
-                                   row=0)
-else:
-    bitfocus = None
-
+with profiler.phase('config'):
+    config = config.Config()
 camera_count = config.camera_count()
 
 # Constants
-ViscaPort = 52381
 ViewerSize = (480, 270)
+# The Cameras frame scrolls if there are more cameras than this
+CameraRowsShown = 8
+CameraRowHeight = 26
+
+# PTZ hostnames are resolved in the background
+ptz_resolver = resolver.Resolver()
+# NDI source name -> PTZ hostname being resolved for it by 'Set PTZ'
+ptz_pending: Dict[str, str] = {}
+
+# Sorted, filtered, list of the sources shown in the listbox
+source_index = sourceindex.SourceIndex()
+
+# The following are created by the startup phases, see startup_begin()
+# ndi_image and thumbnails are imported in the background, they pull in PIL and numpy
+ndi_image = None
+thumbnails = None
+# List of cameras and NDI sources
+cameras: CameraList = None
+ndi_sources: NDISourceList = None
+# Recent frames from each source, shown as soon as a source is selected
+thumbnail_cache = None
+# Errors from the startup phases, shown once the window is up
+startup_errors = []
+# Sends camera switches to BitFocus Companion, if enabled
+notifier: companion.CompanionNotifier = None
+# Rows built in the Cameras frame, and how many of them are shown. Rows for removed cameras are hidden
+camera_rows = 0
+camera_rows_shown = 0
+# NDI Discovery Servers in use, changes take effect on restart
+discovery_servers = None
+# VISCA relay running in its own process (see relayprocess), changes take effect on restart
+relay_process = False
+# Background thumbnail fetcher and control API server, if enabled
+prefetcher = None
+api_server: controlapi.ControlServer = None
+
+
+def relay_phase() -> viscarelay.ViscaRelayList | relayprocess.ViscaRelayProcess:
+    """ Startup: Companion interface and the VISCA relay sockets, in the relay process if configured """
+    global notifier
+    with profiler.phase('relays'):
+        viscalist, notifier = relays_create(config, camera_count, ptz_resolver, startup_errors.append)
+        return viscalist
+
+
+def router_phase() -> ndirouter.NDIRouterList:
+    """ Startup: NDI routing instances """
+    with profiler.phase('routers'):
+        return ndirouter.NDIRouterList(camera_count, config.cam_name())
+
+
+def finder_phase() -> NDISourceList:
+    """ Startup: NDI finders """
+    with profiler.phase('finder'):
+        return NDISourceList(config.cam_name(), finders=config.discovery_finders())
+
+
+def preview_phase():
+    """ Startup: image modules used by the viewer """
+    global ndi_image, thumbnails, thumbnail_cache
+    with profiler.phase('preview'):
+        import ndi_image
+        import thumbnails
+        ndi_image.receiver_pool.resize(config.receiver_pool_size())
+        ndi_image.capture_deadlines.update(config.capture_deadlines())
+        thumbnail_cache = thumbnails.ThumbnailCache()
+
+
+def startup_begin() -> list:
+    """ Start the startup phases which don't need the GUI, they run in parallel with building
+        the window. Returns the futures, to be passed to startup_end() """
+    global discovery_servers, relay_process
+    discovery_servers = config.discovery_servers()
+    relay_process = config.relay_process()
+    ndibackend.configure(discovery_servers, config.settings_dir())
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Startup")
+    futures = [executor.submit(phase) for phase in (relay_phase, router_phase, finder_phase, preview_phase)]
+    executor.shutdown(wait=False)
+    return futures
+
+
+def startup_end(futures: list):
+    """ Wait for the startup phases, and set up the cameras and the sources list.
+        Saved cameras are set as their sources are discovered """
+    global cameras, ndi_sources
+
+    with profiler.phase('wait for phases'):
+        viscalist, routerlist, finder, _ = [future.result() for future in futures]
+    cameras = CameraList(count=camera_count, cam_name=config.cam_name(),
+                         routerlist=routerlist, viscalist=viscalist)
+    ndi_sources = finder
+    load_camera_state()
+    for error in startup_errors:
+        Sg.popup_error(error)
 
-class NDISource(dict):
-    """ Single NDI Source instance
-        active sources are type 'dynamic'
-    """
-    def __init__(self, name: str, srctype: str, lastseen: float = 0.0, ptz_name=None):
-        if ptz_name is None:
-            ptz_name = name.split(' ')[0]  # Assume hostname is the first part of string
-        dict.__init__(self, name=name, srctype=srctype, lastseen=lastseen,
-                      ndi_source=None, ptz_name=ptz_name)
-
-    def ptz_set(self, ptz_name):
-        if ptz_name == '':
-            ptz_name = self['name'].split(' ')[0]
-        if 'dynamic' == self['srctype']:
-            self['ptz_name'] = ptz_name
-
-    def ptz_get(self):
-        return self['ptz_name']
-
-    def name_get(self):
-        return self['name']
 
-    def ndi_source_get(self):
-        return self['ndi_source']
+def ndi_sources_clear(win):
+    """ Clear the list of NDI sources, as a result of the 'Refresh' menu item """
+    global ndi_sources, ndi_None, cameras
 
-    def local(self):
-        return self['srctype'] == 'local'
+    # Keep the cameras, to be set again as the sources are rediscovered (the PTZ addresses are kept
+    # by ndi_sources.refresh())
+    camera_names = cameras.saved_names()
 
-    def dynamic(self):
-        return self['srctype'] == 'dynamic'
+    listbox_apply(win['--NDILIST--'], source_index.clear())
+    for num in range(cameras.max()):
+        cameras.cam_source_set(num, ndi_None)
+        camera_row_update(win, num)
 
-    def stale(self):
-        # test whether a source has gone stale
-        # defined as no advertisement seem in 1 minute
-        return (self.dynamic() and
-                (time.monotonic() - self["lastseen"]) > 60.0)
+    # Disconnect the preview receivers, the sources may have gone away
+    ndi_image.receiver_pool.clear()
 
-ndi_None = NDISource("None", "static")
+    # New finder and empty source table. Changes from the old finder still in flight are
+    # ignored by generation
+    ndi_sources.refresh()
+    cameras.pending_set(camera_names)
 
 
-class NDISourceList:
-    """ Manipulate the cache of known NDI Sources
+def ndi_finders_change(win, finders: list):
+    """ Discover the sources again with new finders (the discovery settings have changed).
+        The cameras stay routed, and are only re-routed if their source comes back with a different address
     """
-    def __init__(self):
-        desc = Ndi.FindCreate()
-        desc.show_local_sources = True
-        self.ndi_find = Ndi.find_create_v2(desc)
-        self.cache = {"None": ndi_None}
-
-    def delete(self):
-        """" Cleanup before re-initing the list """
-        Ndi.find_destroy(self.ndi_find)
-
-    def update(self) -> bool:
-        """ Update the list of dynamic sources, returns True if changed """
-        changed = False
-
-        if not Ndi.find_wait_for_sources(self.ndi_find, 0):
-            return changed
-
-        sources = Ndi.find_get_current_sources(self.ndi_find)
-        for i, s in enumerate(sources):
-            # VMix
-            if re.search("Remote Connection", s.ndi_name):
-                continue
-            # Filter out sources advertised by this app
-            if re.search(config.cam_name(), s.ndi_name):
-                continue
-
-            if s.ndi_name in self.cache:
-                self.cache[s.ndi_name]["lastseen"] = time.monotonic()
-            else:
-                self.cache[s.ndi_name] = NDISource(s.ndi_name, "dynamic", time.monotonic())
-                changed = True
-
-            self.cache[s.ndi_name]["ndi_source"] = s
-
-        return changed
-
-    def find(self, name: str):
-        """ Find a source by name """
-        return self.cache.get(name)
-
-    def srclist(self) -> list:
-        """ Return a sorted list of dynamic sources, with "None" at the top """
-        src_list = []
-        for key in self.cache:
-            src = self.cache[key]
-            if src.dynamic():
-                src_list.insert(-1, src.name_get())
-        src_list.sort()
-        src_list.insert(0, self.cache["None"].name_get())
-        return src_list
-
-    def src_save(self) -> list:
-        """ return list of tuples (name, ptz) """
-        srclist = []
-        idx = 0
-        for key in self.cache:
-            src = self.cache[key]
-            value = (src.name_get(), src.ptz_get())
-            srclist.insert(idx, value)
-            idx = idx + 1
-        return srclist
-
-    def src_load(self, srcptzlist: list):
-        """ update ptz values from srclist """
-        if srcptzlist is not None:
-            for value in srcptzlist:
-                if value[0] in self.cache:
-                    src = self.cache[value[0]]
-                    src.ptz_set(value[1])
-
-class CameraList:
-    """ List of active cameras. """
-    def __init__(self, count, routerlist: ndirouter.NDIRouterList = None,
-                 viscalist: viscarelay.ViscaRelayList = None):
-        self.camera_list : List[Dict] = []
-        self.max_camera = count
-        self.routerlist = routerlist
-        self.viscalist = viscalist
-
-        for idx in range(count):
-            tmpdict = {"name": config.cam_name() + str(idx + 1) + ':',
-                       "ndi_source": ndi_None}
-            self.camera_list.insert(idx, tmpdict)
-
-    def max(self):
-        return self.max_camera
-
-    def cam_name(self, cam_num) -> str:
-        return self.camera_list[cam_num]["name"]
-
-    def cam_source_get(self, cam_num: int) -> NDISource:
-        return self.camera_list[cam_num]["ndi_source"]
-
-    def cam_source_set(self, cam_num: int, src: NDISource) -> bool:
-        old_src = self.camera_list[cam_num]["ndi_source"]
-        self.camera_list[cam_num]["ndi_source"] = src
-        if src != old_src:
-            self.routerlist.set_routing(cam_num, src.ndi_source_get())
-        if src != ndi_None:
-            self.viscalist.ptz_set(cam_num, src.ptz_get())
-        return src != old_src
+    listbox_apply(win['--NDILIST--'], source_index.clear())
+    ndi_image.receiver_pool.clear()
+    ndi_sources.refresh(finders)
+    cameras.pending_set(cameras.saved_names())
 
-# List of cameras and NDI sources
-cameras: CameraList = CameraList(count=camera_count,
-                                 routerlist=ndirouter.NDIRouterList(camera_count,
-                                                                    config.cam_name()),
-                                 viscalist=viscarelay.ViscaRelayList(camera_count,
-                                                                     bitfocus,
-                                                                     config.relay_port_base(),
-                                                                     ViscaPort))
-ndi_sources: NDISourceList = NDISourceList()
-ndi_sources_lock = threading.Lock()
-
-def ndi_sources_clear(win):
-    """ Initalize/Clear the list of NDI sources.
-        This is called at startup and as a result of the 'Refresh' menu item """
-    global ndi_sources, ndi_sources_lock, ndi_None, cameras
 
-    win['--NDILIST--'].update([])
-    for num in range(cameras.max()):
-        cameras.cam_source_set(num, ndi_None)
-        win['--CAMSRC'+str(num)].update(ndi_None.name_get())
-        win['--CAMPTZ'+str(num)].update(ndi_None.ptz_get())
-
-    with ndi_sources_lock:
-        if ndi_sources is not None:
-            ndi_sources.delete()
-
-        ndi_sources = NDISourceList()
+def listbox_apply(element: Sg.Listbox, ops: list):
+    """ Apply SourceIndex operations to the sources listbox, which always has "None" as its first entry.
+        Edits the Tk listbox in place, so the selection and scroll position are kept
+    """
+    widget = element.Widget
+    values = element.Values
+    for op in ops:
+        idx = op[1] + 1
+        if op[0] == 'insert':
+            widget.insert(idx, op[2])
+            values.insert(idx, op[2])
+        else:
+            widget.delete(idx)
+            del values[idx]
+
+
+def camera_row(x: int) -> list:
+    """ Return the Cameras frame row for camera x """
+    return [Sg.Text(config.cam_name() + str(x + 1) + ':', font=('Courier', 11, 'bold'), size=6),
+            Sg.Text(ndi_None.name_get(), font=('Courier', 11, 'bold'), size=30, key='--CAMSRC' + str(x)),
+            Sg.Text(ndi_None.ptz_get(), font=('Courier', 11, 'italic'), size=28, key='--CAMPTZ' + str(x)),
+            Sg.Text('', font=('Courier', 9), size=28, key='--CAMSTATS' + str(x),
+                    tooltip='VISCA packets from controller/camera, '
+                            '99th percentile camera response time, dropped packets')]
+
+
+def camera_rows_resize(win, count: int):
+    """ Show a row for each of count cameras, adding rows to the Cameras frame if needed """
+    global camera_rows, camera_rows_shown
+
+    # A hidden row is packed again at the end of the frame, so the hidden rows are shown
+    # (in order) before any new ones are added
+    for x in range(count, camera_rows_shown):
+        win['--CAMSRC' + str(x)].hide_row()
+    for x in range(camera_rows_shown, min(count, camera_rows)):
+        win['--CAMSRC' + str(x)].unhide_row()
+    if count > camera_rows:
+        win.extend_layout(win['--CAMCOL--'], [camera_row(x) for x in range(camera_rows, count)])
+        camera_rows = count
+    camera_rows_shown = count
+    win['--CAMCOL--'].contents_changed()
+
+
+def config_apply(win):
+    """ Apply the settings saved by the Configure dialog, without restarting. Cameras are added
+        or removed at the end of the list, the others (and their VISCA relays) carry on undisturbed
+    """
+    global notifier, prefetcher, api_server
+
+    if config.discovery_finders() != ndi_sources.finder_specs:
+        live_preview.stop()
+        if prefetcher is not None:
+            prefetcher.reset()
+        ndi_finders_change(win, config.discovery_finders())
+    if config.discovery_servers() != discovery_servers:
+        Sg.popup("The NDI Discovery Servers will be used when the program is restarted", keep_on_top=True)
+    if config.relay_process() != relay_process:
+        Sg.popup("The VISCA relay process setting will be used when the program is restarted", keep_on_top=True)
+
+    count = config.camera_count()
+    if count != cameras.max():
+        cameras.resize(count)
+        camera_rows_resize(win, count)
+        for x in range(count):
+            camera_row_update(win, x)
+        save_camera_state()
+
+    relay_options_apply(cameras.viscalist, config)
+
+    ndi_image.receiver_pool.resize(config.receiver_pool_size())
+
+    if config.prefetch_enabled() and prefetcher is None:
+        prefetcher = thumbnails.ThumbnailPrefetcher(thumbnail_cache,
+                                                    lambda: ndi_sources.preview_sources(),
+                                                    ViewerSize)
+    elif not config.prefetch_enabled() and prefetcher is not None:
+        prefetcher.close()
+        prefetcher = None
+
+    old_notifier = notifier
+    notifier = relay_companion_set(cameras.viscalist, config.bitfocus_info(), Sg.popup_error)
+    if old_notifier is not None:
+        old_notifier.close()
+
+    if api_server is not None and (not config.api_enabled() or api_server.address()[1] != config.api_port()):
+        api_server.close()
+        api_server = None
+    if config.api_enabled() and api_server is None:
+        api_server_start(win)
+
+
+def api_server_start(win):
+    """ Start the control API server """
+    global api_server
+    try:
+        api_server = controlapi.ControlServer(api_routes(win), config.api_port())
+    except OSError as exc:
+        Sg.popup_error(f"Control API: can't listen on port {config.api_port()}: {exc}")
+
+
+def camera_row_update(win, cam_num: int, ptz_states: list = None):
+    """ Update the Cameras frame entry for a camera. ptz_states is from cameras.ptz_states(),
+        when updating every camera """
+    ndi = cameras.cam_source_get(cam_num)
+    ptz_text = ndi.ptz_get()
+    if ndi.name_get() in ptz_pending:
+        ptz_text = ptz_pending[ndi.name_get()] + ' (resolving)'
+    elif ndi is not ndi_None:
+        if ptz_states is None:
+            state = cameras.ptz_state(cam_num)
+        else:
+            state = ptz_states[cam_num] if cam_num < len(ptz_states) else None
+        if state == 'resolving':
+            ptz_text = ptz_text + ' (resolving)'
+        elif state == 'failed':
+            ptz_text = ptz_text + ' (not found)'
+    win['--CAMSRC' + str(cam_num)].update(ndi.name_get())
+    win['--CAMPTZ' + str(cam_num)].update(ptz_text)
+
+
+def ptz_apply(win, ndi: NDISource, ptz_str: str):
+    """ Set the PTZ address for an NDI source, and for any camera using that source """
+    ndi.ptz_set(ptz_str)
 
-    # Set a one-shot timer to load the saved camera configuration after giving enough time
-    # for the active NDI sources to show up. In practice, they seem to show up within
-    # about 1 second
-    (win.timer_start(frequency_ms=2500, key='-LOAD-STATE-TIMER-', repeating=False))
+    for x in range(cameras.max()):
+        if cameras.cam_source_get(x) is ndi:
+            cameras.cam_source_set(x, ndi)
+            camera_row_update(win, x)
+    save_camera_state()
 
 
 def save_camera_state():
     """ Save the current list of selected cameras and associated PTZ addresses"""
-    ndi_list = ndi_sources.src_save()
-
-    camera_name_list = []
-    for idx in range(cameras.max()):
-        camera_name_list.insert(idx, cameras.cam_source_get(idx).name_get())
-    config.save_camera_state((ndi_list, camera_name_list))
+    config.save_camera_state(ndi_sources.src_save(), cameras.saved_names())
 
 
 def load_camera_state():
-    """ Reload the selected cameras and the associated PTZ addresses from the
-        saved configuration state """
-    ndi_list, camera_list = config.load_camera_state()
-
-    ndi_sources.src_load(ndi_list)
-
-    if camera_list is not None:
-        for idx in range(len(camera_list)):
-            src = ndi_sources.find(camera_list[idx])
-            if src is not None and idx < cameras.max():
-                cameras.cam_source_set(idx, src)
+    """ Load the selected cameras and the associated PTZ addresses from the
+        saved state, at startup. Cameras are set when their source is discovered,
+        see cameras.pending_apply() """
+    ptz, camera_list = config.load_camera_state()
+
+    ndi_sources.src_load(ptz)
+    cameras.pending_set(camera_list)
+
+
+def preset_recall(win, name: str):
+    """ Recall a preset, and show what changed and how long it took """
+    preset = config.presets().get(name)
+    if preset is None:
+        win['--PRESETSTATUS--'].update(f'No preset "{name}"')
+        return
+    result = cameras.recall(preset, ndi_sources)
+    for x in sorted(set(result['changed']) | set(result['ptz'])):
+        camera_row_update(win, x)
+    if result['changed'] or result['ptz']:
+        save_camera_state()
+    text = (f"{name}: {len(result['changed'])} switched in {result['cut_ms']:.1f}ms, "
+            f"total {result['total_ms']:.1f}ms")
+    if result['missing']:
+        text = text + ', missing ' + ', '.join(result['missing'])
+    win['--PRESETSTATUS--'].update(text)
+
+
+def api_routes(win) -> list:
+    """ Control API routes for the GUI, presets can be recalled e.g. from Companion.
+        Recalls are passed to the GUI thread as PRESET_RECALL events """
+    def recall(match, body):
+        if match.group(1) not in config.presets():
+            raise controlapi.ApiError(404, "no such preset: " + match.group(1))
+        win.write_event_value(('-THREAD-', 'PRESET_RECALL'), match.group(1))
+        return {"recall": match.group(1)}
+
+    return [("GET", "/presets", lambda match, body: config.presets()),
+            ("POST", "/presets/([^/]+)/recall", recall)]
+
+
+def relay_stats_text(stats: dict) -> str:
+    """ Format the VISCA relay counters for one camera for display """
+    p99 = stats['response_p99_ms']
+    if p99 is None:
+        response = '-'
+    elif p99 == float('inf'):
+        response = '>1s'
+    else:
+        response = f'<{p99:g}ms'
+    text = f"{stats['ctl_in']}/{stats['cam_in']} rt {response} drop {stats['drops']}"
+    if stats['superseded']:
+        text = text + f" sup {stats['superseded']}"
+    if stats['inquiry_hits'] or stats['inquiry_misses']:
+        text = text + f" inq {stats['inquiry_hits']}/{stats['inquiry_misses']}"
+    return text
+
+
+def statistics_text() -> str:
+    """ Format the preview timings and discovery times for each NDI source, and the Companion counters """
+    lines = [f"{'NDI Source':40} {'connect':>8} {'1st frame':>9} {'frames':>6} {'timeouts':>8}"]
+    for name, entry in sorted(ndi_image.capture_metrics.snapshot().items()):
+        connect = '-' if entry['connect_ms'] is None else f"{entry['connect_ms']:.0f}ms"
+        first_frame = '-' if entry['first_frame_ms'] is None else f"{entry['first_frame_ms']:.0f}ms"
+        lines.append(f"{name[:40]:40} {connect:>8} {first_frame:>9} {entry['frames']:>6} {entry['timeouts']:>8}")
+
+    # How long after discovery started each finder first reported each source
+    labels = ndi_sources.finder_labels()
+    lines.extend(['', f"{'NDI Discovery':40} " + ' '.join(f"{label[:16]:>16}" for label in labels)])
+    for name, seen in sorted(ndi_sources.discovery_stats().items()):
+        times = ['-' if label not in seen else f"{seen[label]:.0f}ms" for label in labels]
+        lines.append(f"{name[:40]:40} " + ' '.join(f"{t:>16}" for t in times))
+    stats = notifier.stats() if notifier is not None else None
+    if stats is not None:
+        latency = '-' if stats['latency_avg_ms'] is None else f"{stats['latency_avg_ms']:.1f}ms"
+        lines.extend(['', f"Companion: {stats['sent']} sent, {stats['failed']} failed, "
+                          f"{stats['coalesced']} coalesced, send time {latency} (max {stats['latency_max_ms']:.1f}ms)"])
+        if stats['last_error'] is not None:
+            lines.append(f"Companion: last error {stats['last_error']}")
+    return '\n'.join(lines)
 
 
 # background thread to update NDI sources list
 #
 def update_ndi_thread(win: Sg.Window):
-    """ Periodic background thread to watch for new NDI sources on the network"""
-    global ndi_sources, ndi_sources_lock
-
-    time.sleep(1)
+    """ Background thread to watch for NDI sources appearing/disappearing on the network.
+        Blocks in NDI until the set of sources changes (or DiscoveryWait passes, to evict stale sources).
+        Each change is published as a new snapshot of the source table, which the GUI reads without locking
+    """
     while True:
-        with ndi_sources_lock:
-            if ndi_sources.update():
-                win.write_event_value(('-THREAD-', 'NDICHANGE'), 'NDICHANGE')
-
-        time.sleep(2)
+        in_use = set(cameras.source_names())
+        diff = ndi_sources.update(DiscoveryWait, in_use)
+        if diff:
+            win.write_event_value(('-THREAD-', 'NDICHANGE'), diff)
 
 
 if __name__ == "__main__":
@@ -257,58 +403,100 @@ if __name__ == "__main__":
         import faulthandler
         faulthandler.enable()
 
+    # NDI and the VISCA relay start up in the background, while the window is built
+    startup_futures = startup_begin()
+
     #
     # All the main window stuff here
     #
-    frame_layout = [[]]
-    for x in range(cameras.max()):
-        ndi_src = cameras.cam_source_get(x)
-        frame_layout.insert(x,
-                            [Sg.Text(cameras.cam_name(x), font=('Courier', 11, 'bold'), size=6),
-                             Sg.Text(ndi_src.name_get(), font=('Courier', 11, 'bold'), size=30, key='--CAMSRC' + str(x)),
-                             Sg.Text(ndi_src.ptz_get(), font=('Courier', 11, 'italic'), size=20, key='--CAMPTZ' + str(x))])
-
-    sources_layout = [[Sg.Listbox(ndi_sources.srclist(), size=(54, 7), key='--NDILIST--', enable_events=True,
-                                  tooltip='Click on NDI source to select')],
-                      [
-                        Sg.InputText(size=3, key='CAM_INPUT',
-                                     do_not_clear=False, tooltip='Enter camera number to set'),
-                        Sg.Button('Set Camera',
-                                  tooltip='Set Camera <n> to selected NDI Source'),
-                        Sg.InputText(size=10, key='PTZ_INPUT', do_not_clear=False,
-                                     tooltip='Enter hostname/address of PTZ for selected NDI source'),
-                        Sg.Button('Set PTZ',
-                                    tooltip='Set the PTZ hostname/address for selected NDI Source to input value'),
-                        ]
-                      ]
-    viewer_layout = [[Sg.Image(size=ViewerSize, key="--VIEWER--")]]
-
-    column1_layout = [[Sg.Frame('Cameras', frame_layout, key="--CAMFRAME--",
-                                tooltip='Cameras, and associated PTZ controllers, active on the NDI switch')],
-                      [Sg.Frame('Sources', sources_layout)]]
-
-    column2_layout = [[Sg.Frame('Viewer', viewer_layout)]]
-
-    menu_layout = Sg.Menu([['Menu', ['Credits', 'Refresh', 'Configure', 'Exit']]])
-    if Debug:
-        debug_layout = [Sg.Multiline(autoscroll=True, size=(80, 5), reroute_stdout=True)]
-        layout = [[menu_layout], [Sg.Column(column1_layout), Sg.Column(column2_layout)], [debug_layout]]
+    with profiler.phase('window'):
+        camera_rows = camera_rows_shown = camera_count
+        frame_layout = [[Sg.Column([camera_row(x) for x in range(camera_count)], key='--CAMCOL--',
+                                   scrollable=True, vertical_scroll_only=True,
+                                   size=(None, CameraRowsShown * CameraRowHeight))]]
+
+        sources_layout = [[Sg.Text('Filter'),
+                           Sg.Input(size=30, key='--FILTER--', enable_events=True,
+                                    tooltip='Only show NDI sources whose name, host or group contains this text')],
+                          [Sg.Listbox([ndi_None.name_get()], size=(54, 7), key='--NDILIST--', enable_events=True,
+                                      tooltip='Click on NDI source to select')],
+                          [
+                            Sg.InputText(size=3, key='CAM_INPUT',
+                                         do_not_clear=False, tooltip='Enter camera number to set'),
+                            Sg.Button('Set Camera',
+                                      tooltip='Set Camera <n> to selected NDI Source'),
+                            Sg.InputText(size=10, key='PTZ_INPUT', do_not_clear=False,
+                                         tooltip='Enter hostname/address of PTZ for selected NDI source'),
+                            Sg.Button('Set PTZ',
+                                        tooltip='Set the PTZ hostname/address for selected NDI Source to input value'),
+                            ]
+                          ]
+        viewer_layout = [[Sg.Image(size=ViewerSize, key="--VIEWER--")],
+                         [Sg.Checkbox('Live', key='--LIVE--', enable_events=True,
+                                      tooltip='Keep updating the viewer from the selected NDI source'),
+                          Sg.Spin(list(range(1, 11)), initial_value=config.live_fps(), size=3,
+                                  key='--LIVEFPS--', enable_events=True,
+                                  tooltip='Live viewer frames per second'),
+                          Sg.Text('fps')]]
+
+        column1_layout = [[Sg.Frame('Cameras', frame_layout, key="--CAMFRAME--",
+                                    tooltip='Cameras, and associated PTZ controllers, active on the NDI switch')],
+                          [Sg.Frame('Sources', sources_layout)]]
+
+        presets_layout = [[Sg.Combo(config.preset_names(), size=24, key='--PRESET--',
+                                    tooltip='Preset name. Ctrl+1 to Ctrl+9 recall the first 9 presets'),
+                           Sg.Button('Recall', tooltip='Set the cameras saved in the preset'),
+                           Sg.Button('Save Preset', tooltip='Save the current cameras and PTZ addresses as a preset'),
+                           Sg.Button('Delete Preset')],
+                          [Sg.Text('', size=56, key='--PRESETSTATUS--')]]
+
+        column2_layout = [[Sg.Frame('Viewer', viewer_layout)],
+                          [Sg.Frame('Presets', presets_layout)]]
+
+        menu_layout = Sg.Menu([['Menu', ['Credits', 'Refresh', 'Configure', 'Statistics', 'Exit']]])
+        if Debug:
+            debug_layout = [Sg.Multiline(autoscroll=True, size=(80, 5), reroute_stdout=True)]
+            layout = [[menu_layout], [Sg.Column(column1_layout), Sg.Column(column2_layout)], [debug_layout]]
+        else:
+            layout = [[menu_layout], [Sg.Column(column1_layout), Sg.Column(column2_layout)]]
+        # Create the Window
+        window = Sg.Window(ProgName, layout, finalize=True,   enable_close_attempted_event=True,
+                           icon=path.abspath(path.join(path.dirname(__file__), 'NDI-Camera-Selector.ico')))
+
+        window['PTZ_INPUT'].bind("<Return>", '_Set')
+        window['CAM_INPUT'].bind('<Return>', '_Set')
+        for n in range(1, 10):
+            window.bind(f'<Control-Key-{n}>', f'PRESET_KEY{n}')
+
+    startup_end(startup_futures)
+    if isinstance(cameras.viscalist, relayprocess.ViscaRelayProcess):
+        # Relay process failures and restarts are reported from other threads, show them in the event loop
+        cameras.viscalist.on_error = lambda msg: window.write_event_value(('-THREAD-', 'RELAY_ERROR'), msg)
+
+    live_preview = ndi_image.LivePreview(window, ViewerSize, config.live_fps())
+
+    if config.prefetch_enabled():
+        prefetcher = thumbnails.ThumbnailPrefetcher(thumbnail_cache,
+                                                    lambda: ndi_sources.preview_sources(),
+                                                    ViewerSize)
     else:
-        layout = [[menu_layout], [Sg.Column(column1_layout), Sg.Column(column2_layout)]]
-    # Create the Window
-    window = Sg.Window(ProgName, layout, finalize=True,   enable_close_attempted_event=True,
-                       icon=path.abspath(path.join(path.dirname(__file__), 'NDI-Camera-Selector.ico')))
-
-    window['PTZ_INPUT'].bind("<Return>", '_Set')
-    window['CAM_INPUT'].bind('<Return>', '_Set')
+        prefetcher = None
 
     update_thread = window.start_thread(lambda: update_ndi_thread(window),
                                         ('-THREAD-', '-THREAD ENDED-'))
 
+    if config.api_enabled():
+        api_server_start(window)
+
     # Event Loop to process "events" and get the "values" of the inputs
 
-    # clear/refresh the sources list
-    ndi_sources_clear(window)
+    # periodically refresh the VISCA relay counters
+    window.timer_start(frequency_ms=1000, key='-STATS-TIMER-', repeating=True)
+
+    # Startup time is shown by the Statistics menu item, or printed with --profile-startup
+    profiler.finish()
+    if '--profile-startup' in sys.argv:
+        print(profiler.report(), flush=True)
 
     while True:
         event, values = window.read()
@@ -324,34 +512,134 @@ if __name__ == "__main__":
                          line_width=80)
 
         elif event == 'Refresh':
+            live_preview.stop()
+            if prefetcher is not None:
+                prefetcher.reset()
             ndi_sources_clear(window)
 
         elif event == 'Configure':
-            config.configure()
+            if config.configure():
+                config_apply(window)
+
+        elif event == 'Statistics':
+            Sg.popup_scrolled(statistics_text() + '\n\n' + profiler.report(), title="Statistics",
+                              font=('Courier', 10),
+                              size=(80, 20), keep_on_top=True, non_blocking=True)
 
         elif event[0] == '-THREAD-':
             if event[1] == 'NDICHANGE':
-                window['--NDILIST--'].update(ndi_sources.srclist())
+                diff = values[event]
+                if diff.generation != ndi_sources.generation:
+                    # From before a Refresh
+                    continue
+                ops = []
+                for name in diff.removed:
+                    ops.extend(source_index.remove(name))
+                for name in diff.added:
+                    src = ndi_sources.find(name)
+                    ops.extend(source_index.add(name, src.groups_get() if src is not None else ''))
+                listbox_apply(window['--NDILIST--'], ops)
+                if diff.added:
+                    for x in cameras.pending_apply(ndi_sources):
+                        camera_row_update(window, x)
+                if diff.updated:
+                    for x in cameras.sources_updated(diff.updated, ndi_sources):
+                        camera_row_update(window, x)
+            elif event[1] == 'RELAY_ERROR':
+                Sg.popup_error(values[event], non_blocking=True)
             elif event[1] == 'NDI_IMAGE':
                 window['--VIEWER--'].update(values[event])
-
-        elif event == '--NDILIST--':
-            # User selected a camera, try to grab an image
+            elif event[1] == 'NDI_LIVE':
+                generation, data = values[event]
+                if generation == live_preview.generation:
+                    window['--VIEWER--'].update(data)
+                    live_preview.frame_drawn()
+            elif event[1] == 'PRESET_RECALL':
+                preset_recall(window, values[event])
+            elif event[1] == 'PTZ_RESOLVED':
+                ndi_name, ptz_str, ptz_address = values[event]
+                if ptz_pending.get(ndi_name) != ptz_str:
+                    # superseded by a later 'Set PTZ'
+                    continue
+                del ptz_pending[ndi_name]
+                ndi = ndi_sources.find(ndi_name)
+                if ndi is None:
+                    continue
+                if ptz_address is None:
+                    for x in range(cameras.max()):
+                        if cameras.cam_source_get(x) is ndi:
+                            camera_row_update(window, x)
+                    Sg.popup_error("PTZ not found: " + ptz_str)
+                else:
+                    ptz_apply(window, ndi, ptz_str)
+
+        elif event == 'Recall':
+            preset_recall(window, values['--PRESET--'])
+
+        elif isinstance(event, str) and event.startswith('PRESET_KEY'):
+            names = config.preset_names()
+            n = int(event[len('PRESET_KEY'):])
+            if n <= len(names):
+                window['--PRESET--'].update(value=names[n - 1])
+                preset_recall(window, names[n - 1])
+
+        elif event == 'Save Preset':
+            name = values['--PRESET--'].strip()
+            if name == '':
+                Sg.popup_error("Enter a name for the preset")
+                continue
+            config.preset_set(name, cameras.preset())
+            window['--PRESET--'].update(value=name, values=config.preset_names())
+            window['--PRESETSTATUS--'].update(f'Saved "{name}"')
+
+        elif event == 'Delete Preset':
+            name = values['--PRESET--']
+            if name in config.presets() and \
+                    Sg.popup_ok_cancel(f'Delete preset "{name}"?', keep_on_top=True) == 'OK':
+                config.preset_delete(name)
+                window['--PRESET--'].update(value='', values=config.preset_names())
+
+        elif event == '--FILTER--':
+            listbox_apply(window['--NDILIST--'], source_index.set_filter(values['--FILTER--']))
+
+        elif event == '--NDILIST--' or event == '--LIVE--':
+            # User selected a camera, or toggled live mode, try to grab an image or start streaming
             try:
                 ndi = ndi_sources.find(values['--NDILIST--'][0])
             except IndexError:
                 ndi = None
-            if ndi is not None:
-                ndi_source = ndi.ndi_source_get()
-                window.start_thread(lambda: ndi_image.getframe_task(window, ndi_source, ViewerSize),
+            if ndi is None:
+                live_preview.stop()
+                continue
+            ndi_source = ndi.ndi_source_get()
+            # Show the cached thumbnail straight away, while a fresh frame is fetched
+            thumbnail = thumbnail_cache.get(ndi.name_get())
+            if thumbnail is not None:
+                window['--VIEWER--'].update(thumbnail)
+            if values['--LIVE--'] and ndi_source is not None:
+                live_preview.start(ndi_source)
+            else:
+                live_preview.stop()
+                window.start_thread(lambda: ndi_image.getframe_task(window, ndi_source, ViewerSize,
+                                                                    thumbnail_cache),
                                     ('-THREAD-', '-THREAD ENDED-'))
 
-        elif event == '-LOAD-STATE-TIMER-':
-            load_camera_state()
+        elif event == '--LIVEFPS--':
+            try:
+                live_preview.rate_set(float(values['--LIVEFPS--']))
+            except ValueError:
+                continue
+            config.live_fps_set(live_preview.fps)
+
+        elif event == '-STATS-TIMER-':
+            # One call for the stats and one for the PTZ states of every camera, as the relay
+            # may be in its own process
+            relay_stats = cameras.relay_stats()
+            ptz_states = cameras.ptz_states()
             for x in range(cameras.max()):
-                ndi = cameras.cam_source_get(x)
-                window['--CAMSRC' + str(x)].update(ndi.name_get())
-                window['--CAMPTZ' + str(x)].update(ndi.ptz_get())
+                camera_row_update(window, x, ptz_states)
+                if x < len(relay_stats):
+                    window['--CAMSTATS' + str(x)].update(relay_stats_text(relay_stats[x]))
 
         elif (event == 'Set PTZ') or (event == 'PTZ_INPUT_Set'):
             try:
@@ -359,25 +647,28 @@ if __name__ == "__main__":
             except IndexError:
                 Sg.popup_error("no NDI source selected")
                 continue
+            if ndi is None:
+                Sg.popup_error("NDI source has gone away")
+                continue
             if not ndi.dynamic():
                 Sg.popup_error("Can't set PTZ for " + ndi.name_get())
                 continue
 
             ptz_str = values['PTZ_INPUT']
-            try:
-                # Make sure PTZ host name is known, empty string means reset PTZ name to default
-                if not ptz_str == '':
-                    socket.gethostbyname(ptz_str)
-            except socket.gaierror:
-                Sg.popup_error("PTZ not found: " + ptz_str)
+            # Make sure PTZ host name is known, empty string means reset PTZ name to default
+            # The name is resolved in the background, the result comes back as a PTZ_RESOLVED event
+            if ptz_str == '':
+                ptz_apply(window, ndi, ptz_str)
             else:
-                ndi.ptz_set(ptz_str)
-
+                ndi_name = ndi.name_get()
+                ptz_pending[ndi_name] = ptz_str
                 for x in range(cameras.max()):
                     if cameras.cam_source_get(x) is ndi:
-                        window['--CAMPTZ' + str(x)].update(ndi.ptz_get())
-                        cameras.cam_source_set(x, ndi)
-                save_camera_state()
+                        camera_row_update(window, x)
+                ptz_resolver.resolve(ptz_str,
+                                     lambda host, address, name=ndi_name:
+                                     window.write_event_value(('-THREAD-', 'PTZ_RESOLVED'),
+                                                              (name, host, address)))
 
         elif event == 'Set Camera' or event == 'CAM_INPUT_Set':
             camnumstr = values['CAM_INPUT']
@@ -398,12 +689,15 @@ if __name__ == "__main__":
                 continue
 
             ndi = ndi_sources.find(ndi_str)
+            if ndi is None:
+                Sg.popup_error("NDI source has gone away: " + ndi_str)
+                continue
 
             cameras.cam_source_set(camnum, ndi)
-            window['--CAMSRC'+str(camnum)].update(ndi.name_get())
-            window['--CAMPTZ'+str(camnum)].update(ndi.ptz_get())
+            camera_row_update(window, camnum)
             save_camera_state()
 
     window.close()
+    config.close()
 
     sys.exit(0)
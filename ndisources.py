@@ -0,0 +1,555 @@
+#
+# NDI sources and camera slots
+#
+# The source cache, NDI discovery and the list of camera slots, without any GUI, so that they
+# are shared by the GUI (ndiselector.py) and the headless service (ndidaemon.py)
+#
+import threading
+import time
+import re
+from types import MappingProxyType
+import companion
+import ndibackend
+import ndirouter
+import relayprocess
+import viscarelay
+import viscarewrite
+from typing import List, Dict
+
+# Constants
+ViscaPort = 52381
+# How long the discovery thread waits for NDI to report a change (ms)
+DiscoveryWait = 500
+# Sources which haven't been advertised for this long (seconds) are removed
+StaleAge = 60.0
+# With several finders, how long each is waited on in turn (ms)
+FinderSlice = 50
+
+class NDISource(dict):
+    """ Single NDI Source instance
+        active sources are type 'dynamic'
+    """
+    def __init__(self, name: str, srctype: str, lastseen: float = 0.0, ptz_name=None):
+        if ptz_name is None:
+            ptz_name = name.split(' ')[0]  # Assume hostname is the first part of string
+        dict.__init__(self, name=name, srctype=srctype, lastseen=lastseen,
+                      ndi_source=None, ptz_name=ptz_name, groups='')
+
+    def ptz_set(self, ptz_name):
+        if ptz_name == '':
+            ptz_name = self.default_ptz()
+        if 'dynamic' == self['srctype']:
+            self['ptz_name'] = ptz_name
+
+    def default_ptz(self):
+        return self['name'].split(' ')[0]  # Assume hostname is the first part of string
+
+    def ptz_get(self):
+        return self['ptz_name']
+
+    def name_get(self):
+        return self['name']
+
+    def ndi_source_get(self):
+        return self['ndi_source']
+
+    def url_get(self):
+        """ Address of the NDI source, or None if it hasn't been discovered """
+        return None if self['ndi_source'] is None else self['ndi_source'].url_address
+
+    def groups_get(self):
+        """ NDI groups the source was found in, comma separated, '' for the default group """
+        return self['groups']
+
+    def local(self):
+        return self['srctype'] == 'local'
+
+    def dynamic(self):
+        return self['srctype'] == 'dynamic'
+
+    def stale(self):
+        # test whether a source has gone stale
+        # defined as no advertisement seen for StaleAge
+        return (self.dynamic() and
+                (time.monotonic() - self["lastseen"]) > StaleAge)
+
+ndi_None = NDISource("None", "static")
+
+
+class SourceDiff:
+    """ Changes to the source list from one discovery pass (lists of source names).
+        generation is the generation of the snapshot the changes lead to """
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.added = []
+        self.removed = []
+        self.updated = []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.updated)
+
+
+class SourceSnapshot:
+    """ The source table at one point in time. A snapshot is never changed once it has been
+        published, discovery builds a new one, so readers need no lock.
+        (The NDISource entries are shared between snapshots; discovery replaces an entry's
+        NDI source, and Set PTZ its PTZ name, each with a single assignment)
+    """
+    __slots__ = ('generation', 'sources', 'present', 'retired_ptz', 'names')
+
+    def __init__(self, generation: int, sources: dict, present: frozenset, retired_ptz: dict):
+        self.generation = generation
+        self.sources = MappingProxyType(sources)
+        # names of the sources currently advertised
+        self.present = present
+        # PTZ names for sources which aren't in the table (evicted, or not seen yet)
+        self.retired_ptz = MappingProxyType(retired_ptz)
+        # sorted names of the dynamic sources
+        self.names = tuple(sorted(name for name, src in sources.items() if src.dynamic()))
+
+
+class Finder:
+    """ One NDI finder, with the sources it reported last, and how long after the finder was created
+        each source was first reported (ms). Only used by the discovery thread, apart from first_seen,
+        which is updated under the NDISourceList write_lock
+    """
+    def __init__(self, backend: ndibackend.NDIBackend, label: str, groups: str = None, extra_ips: str = None):
+        self.label = label
+        self.groups = groups
+        self.ndi_find = backend.find_create(show_local_sources=True, groups=groups, extra_ips=extra_ips)
+        self.created = time.monotonic()
+        self.found = []
+        self.changed = False
+        self.first_seen: Dict[str, float] = {}
+
+
+class NDISourceList:
+    """ Manipulate the cache of known NDI Sources
+        Sources are discovered by one or more finders (e.g. mDNS, and extra IPs), see Config.discovery_finders().
+        Their results are merged, a source reported by several finders is only listed once.
+        The discovery thread calls wait() and update(), which publish a new SourceSnapshot when
+        anything changes. Everything else reads the current snapshot, without locking and without
+        calling into NDI. Writers (update, src_load, refresh) are serialized by write_lock, which
+        is never held during an NDI call.
+    """
+    def __init__(self, cam_name: str, backend: ndibackend.NDIBackend = None, finders: list = None):
+        self.backend = backend if backend is not None else ndibackend.get()
+        # (label, groups, extra IPs) for each finder
+        self.finder_specs = finders if finders is not None else [('mDNS', None, None)]
+        self.write_lock = threading.Lock()
+        self.finders = self.finders_create()
+        # finders replaced by refresh(), destroyed by the discovery thread once it is done with them
+        self.retired_finders = []
+        self.waited_finders = []
+        self.snapshot = SourceSnapshot(0, {"None": ndi_None}, frozenset(), {})
+        # VMix remote connections, and the sources advertised by this app
+        self.filter = re.compile("Remote Connection|" + re.escape(cam_name))
+
+    def finders_create(self) -> list:
+        return [Finder(self.backend, label, groups, extra_ips) for label, groups, extra_ips in self.finder_specs]
+
+    @property
+    def generation(self) -> int:
+        return self.snapshot.generation
+
+    def delete(self):
+        """" Cleanup at exit """
+        with self.write_lock:
+            for finder in self.retired_finders + self.finders:
+                self.backend.find_destroy(finder.ndi_find)
+            self.retired_finders = []
+
+    def refresh(self, finders: list = None):
+        """ Start again with new finders (with different settings if finders is given) and an empty table,
+            keeping the PTZ names. The old finders are destroyed by the discovery thread, which may be
+            waiting on them
+        """
+        if finders is not None:
+            self.finder_specs = finders
+        new_finders = self.finders_create()
+        with self.write_lock:
+            snap = self.snapshot
+            self.retired_finders.extend(self.finders)
+            self.finders = new_finders
+            self.snapshot = SourceSnapshot(snap.generation + 1, {"None": ndi_None}, frozenset(),
+                                           self._ptz_overrides(snap))
+
+    def wait(self, timeout_ms: int) -> bool:
+        """ Wait up to timeout_ms for the set of advertised sources to change.
+            With several finders, each is waited on in turn, for FinderSlice at a time.
+            Only called from the discovery thread """
+        with self.write_lock:
+            retired, self.retired_finders = self.retired_finders, []
+            self.waited_finders = self.finders
+        for finder in retired:
+            self.backend.find_destroy(finder.ndi_find)
+
+        finders = self.waited_finders
+        if len(finders) == 1:
+            finders[0].changed = self.backend.find_wait_for_sources(finders[0].ndi_find, timeout_ms)
+            return finders[0].changed
+
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        while True:
+            for finder in finders:
+                remaining_ms = max(0, int((deadline - time.monotonic()) * 1000))
+                if self.backend.find_wait_for_sources(finder.ndi_find, min(remaining_ms, FinderSlice)):
+                    finder.changed = True
+            if any(finder.changed for finder in finders) or time.monotonic() >= deadline:
+                return any(finder.changed for finder in finders)
+
+    def update(self, timeout_ms: int = 0, in_use: set = None, changed: bool = None) -> SourceDiff:
+        """ Wait up to timeout_ms for the set of advertised sources to change, then update the list
+            of dynamic sources. Sources which have gone stale are evicted, unless their name is in in_use.
+            changed is the result of an earlier wait(), for callers which wait without holding a lock.
+            Publishes a new snapshot if anything changed, and returns the changes
+        """
+        if changed is None:
+            changed = self.wait(timeout_ms)
+        finders = self.waited_finders
+        found = None
+        if changed:
+            for finder in finders:
+                if finder.changed:
+                    finder.found = self.backend.find_get_current_sources(finder.ndi_find)
+                    finder.changed = False
+            # Merge, the first finder to report a source wins. NDI doesn't say which groups a source
+            # is in, so record the groups that finder was looking in
+            found = {}
+            for finder in finders:
+                for s in finder.found:
+                    if s.ndi_name not in found:
+                        found[s.ndi_name] = (s, finder.groups or '')
+        now = time.monotonic()
+
+        with self.write_lock:
+            snap = self.snapshot
+            diff = SourceDiff(snap.generation)
+            if finders is not self.finders:
+                # refreshed while waiting
+                return diff
+
+            sources = dict(snap.sources)
+            retired_ptz = dict(snap.retired_ptz)
+            present = snap.present
+            if found is not None:
+                for finder in finders:
+                    for s in finder.found:
+                        if s.ndi_name not in finder.first_seen:
+                            finder.first_seen[s.ndi_name] = (now - finder.created) * 1000.0
+                present = set()
+                for name, (s, groups) in found.items():
+                    if self.filter.search(name):
+                        continue
+                    present.add(name)
+
+                    src = sources.get(name)
+                    if src is None:
+                        src = NDISource(name, "dynamic", now)
+                        ptz_name = retired_ptz.pop(name, None)
+                        if ptz_name is not None:
+                            src.ptz_set(ptz_name)
+                        sources[name] = src
+                        diff.added.append(name)
+                    elif src.ndi_source_get() is not None and \
+                            src.ndi_source_get().url_address != s.url_address:
+                        diff.updated.append(name)
+                    src["ndi_source"] = s
+                    src["groups"] = groups
+                present = frozenset(present)
+
+            for name in present:
+                sources[name]["lastseen"] = now
+
+            # Evict sources which are no longer advertised, once they have gone stale
+            if len(sources) - 1 > len(present):
+                for name, src in list(sources.items()):
+                    if name in present or not src.stale() or (in_use is not None and name in in_use):
+                        continue
+                    if src.ptz_get() != src.default_ptz():
+                        retired_ptz[name] = src.ptz_get()
+                    del sources[name]
+                    diff.removed.append(name)
+
+            if diff.added or diff.removed or present != snap.present:
+                self.snapshot = SourceSnapshot(snap.generation, sources, present, retired_ptz)
+        return diff
+
+    def discovery_stats(self) -> dict:
+        """ Return, for each source in the table, how long after discovery started (ms) each finder
+            first reported it, as {source name: {finder label: ms}} """
+        with self.write_lock:
+            finders = list(self.finders)
+            names = list(self.snapshot.names)
+            return {name: {finder.label: finder.first_seen[name] for finder in finders if name in finder.first_seen}
+                    for name in names}
+
+    def finder_labels(self) -> list:
+        return [finder.label for finder in self.finders]
+
+    def find(self, name: str):
+        """ Find a source by name """
+        return self.snapshot.sources.get(name)
+
+    def srclist(self) -> list:
+        """ Return a sorted list of dynamic sources, with "None" at the top """
+        return [ndi_None.name_get()] + list(self.snapshot.names)
+
+    def preview_sources(self) -> list:
+        """ Return a list of (name, NDI source) for the dynamic sources, for the thumbnail prefetcher """
+        snap = self.snapshot
+        return [(name, snap.sources[name].ndi_source_get()) for name in snap.names]
+
+    @staticmethod
+    def _ptz_overrides(snap: SourceSnapshot) -> dict:
+        ptz = dict(snap.retired_ptz)
+        for name, src in snap.sources.items():
+            if src.dynamic() and src.ptz_get() != src.default_ptz():
+                ptz[name] = src.ptz_get()
+        return ptz
+
+    def src_save(self) -> dict:
+        """ Return the PTZ names which aren't the default, as a dict of name -> ptz,
+            including those for sources which have gone away """
+        return self._ptz_overrides(self.snapshot)
+
+    def src_load(self, ptz: dict):
+        """ Update PTZ names from a dict of name -> ptz. PTZ names for sources which haven't
+            been seen yet are applied when they are discovered """
+        if ptz is None:
+            return
+        with self.write_lock:
+            snap = self.snapshot
+            retired_ptz = dict(snap.retired_ptz)
+            for name, ptz_name in ptz.items():
+                src = snap.sources.get(name)
+                if src is not None:
+                    src.ptz_set(ptz_name)
+                elif ptz_name != name.split(' ')[0]:
+                    retired_ptz[name] = ptz_name
+            self.snapshot = SourceSnapshot(snap.generation, dict(snap.sources), snap.present, retired_ptz)
+
+
+def preset_valid(preset) -> bool:
+    """ Check a preset (e.g. from the control API) has the form returned by CameraList.preset() """
+    if not isinstance(preset, dict):
+        return False
+    for camnum, entry in preset.items():
+        if not camnum.isdigit() or not isinstance(entry, dict) or not isinstance(entry.get("source"), str):
+            return False
+        if not isinstance(entry.get("ptz", ""), (str, type(None))):
+            return False
+    return True
+
+
+class CameraList:
+    """ List of active cameras. """
+    def __init__(self, count, cam_name: str, routerlist: ndirouter.NDIRouterList = None,
+                 viscalist: viscarelay.ViscaRelayList = None):
+        self.camera_list : List[Dict] = []
+        self.max_camera = 0
+        self.prefix = cam_name
+        self.routerlist = routerlist
+        self.viscalist = viscalist
+        # camera index -> name of a saved source which hasn't been discovered yet
+        self.pending: Dict[int, str] = {}
+        self.resize(count)
+
+    def resize(self, count: int):
+        """ Add or remove cameras at the end of the list, with their routers and relays.
+            The other cameras are left alone """
+        if self.routerlist is not None:
+            self.routerlist.resize(count)
+        if self.viscalist is not None:
+            self.viscalist.resize(count)
+        while len(self.camera_list) < count:
+            self.camera_list.append({"name": self.prefix + str(len(self.camera_list) + 1) + ':',
+                                     "ndi_source": ndi_None})
+        del self.camera_list[count:]
+        self.pending = {idx: name for idx, name in self.pending.items() if idx < count}
+        self.max_camera = count
+
+    def max(self):
+        return self.max_camera
+
+    def cam_name(self, cam_num) -> str:
+        return self.camera_list[cam_num]["name"]
+
+    def cam_source_get(self, cam_num: int) -> NDISource:
+        return self.camera_list[cam_num]["ndi_source"]
+
+    def cam_source_set(self, cam_num: int, src: NDISource) -> bool:
+        self.pending.pop(cam_num, None)
+        old_src = self.camera_list[cam_num]["ndi_source"]
+        self.camera_list[cam_num]["ndi_source"] = src
+        if src != old_src:
+            self.routerlist.set_routing(cam_num, src.ndi_source_get())
+            self.viscalist.model_set(cam_num, viscarewrite.camera_model(src.name_get()))
+        if src != ndi_None:
+            self.viscalist.ptz_set(cam_num, src.ptz_get())
+        return src != old_src
+
+    def preset(self) -> dict:
+        """ Return a preset for the current cameras: camera number (1-N, as a string, so the preset
+            can be saved as JSON) -> {"source": name, "ptz": PTZ name} """
+        preset = {}
+        for idx, cam in enumerate(self.camera_list):
+            src = cam["ndi_source"]
+            if src is not ndi_None:
+                preset[str(idx + 1)] = {"source": src.name_get(), "ptz": src.ptz_get()}
+        return preset
+
+    def recall(self, preset: dict, source_list: NDISourceList) -> dict:
+        """ Set the cameras in a preset. Only the cameras whose source changes are re-routed, and
+            only the relays whose PTZ changes are updated. All the routing changes are made
+            back to back, before any other work, so downstream switchers see a near simultaneous cut.
+            Returns {"changed": camera indexes re-routed, "ptz": camera indexes whose relay PTZ was set,
+                     "missing": source names not found, "cut_ms": time taken by the routing changes,
+                     "total_ms": time taken by the recall}
+        """
+        start = time.perf_counter()
+        routes = []
+        missing = []
+        ptz_changed = set()
+        for camnum, entry in preset.items():
+            idx = int(camnum) - 1
+            src = source_list.find(entry["source"])
+            if src is None or not 0 <= idx < self.max_camera:
+                missing.append(entry["source"])
+                continue
+            ptz_name = entry.get("ptz")
+            if ptz_name and src.dynamic() and ptz_name != src.ptz_get():
+                src.ptz_set(ptz_name)
+                ptz_changed.add(src.name_get())
+            if src is not self.camera_list[idx]["ndi_source"]:
+                routes.append((idx, src))
+
+        cut_start = time.perf_counter()
+        for idx, src in routes:
+            self.routerlist.set_routing(idx, src.ndi_source_get())
+        cut_end = time.perf_counter()
+
+        changed = []
+        for idx, src in routes:
+            self.pending.pop(idx, None)
+            self.camera_list[idx]["ndi_source"] = src
+            self.viscalist.model_set(idx, viscarewrite.camera_model(src.name_get()))
+            changed.append(idx)
+        ptz = []
+        for idx, cam in enumerate(self.camera_list):
+            src = cam["ndi_source"]
+            if src is not ndi_None and (idx in changed or src.name_get() in ptz_changed):
+                self.viscalist.ptz_set(idx, src.ptz_get())
+                ptz.append(idx)
+
+        return {"changed": changed, "ptz": ptz, "missing": missing,
+                "cut_ms": (cut_end - cut_start) * 1000, "total_ms": (time.perf_counter() - start) * 1000}
+
+    def pending_set(self, camera_names: list):
+        """ Remember the saved source name for each camera, the cameras are set as the sources
+            are discovered, by pending_apply() """
+        self.pending = {}
+        if camera_names is not None:
+            for idx, name in enumerate(camera_names[:self.max_camera]):
+                if name != ndi_None.name_get():
+                    self.pending[idx] = name
+
+    def pending_apply(self, source_list: NDISourceList) -> list:
+        """ Set the cameras whose saved source has been discovered, returns the camera indexes set.
+            A camera still routed to the source (e.g. after the finders were changed) is only
+            re-routed if the source has come back with a different address
+        """
+        changed = []
+        for idx, name in list(self.pending.items()):
+            src = source_list.find(name)
+            if src is None:
+                continue
+            old_src = self.camera_list[idx]["ndi_source"]
+            if old_src.name_get() == name and old_src.url_get() == src.url_get():
+                self.pending.pop(idx)
+                self.camera_list[idx]["ndi_source"] = src
+                if src.ptz_get() != old_src.ptz_get():
+                    self.viscalist.ptz_set(idx, src.ptz_get())
+            else:
+                self.cam_source_set(idx, src)
+            changed.append(idx)
+        return changed
+
+    def sources_updated(self, names: list, source_list: NDISourceList) -> list:
+        """ Re-route the cameras using a source which is now at a different address (SourceDiff.updated),
+            returns the camera indexes re-routed
+        """
+        changed = []
+        for idx, cam in enumerate(self.camera_list):
+            if cam["ndi_source"] is ndi_None or cam["ndi_source"].name_get() not in names:
+                continue
+            src = source_list.find(cam["ndi_source"].name_get())
+            if src is None:
+                continue
+            cam["ndi_source"] = src
+            self.routerlist.set_routing(idx, src.ndi_source_get())
+            changed.append(idx)
+        return changed
+
+    def source_names(self) -> list:
+        """ Return the name of the source selected for each camera """
+        return [cam["ndi_source"].name_get() for cam in self.camera_list]
+
+    def saved_names(self) -> list:
+        """ Return the source name to save for each camera, including saved sources not discovered yet """
+        return [self.pending.get(idx, cam["ndi_source"].name_get()) for idx, cam in enumerate(self.camera_list)]
+
+    def ptz_state(self, cam_num: int):
+        """ Return the resolution state of the PTZ address for a camera """
+        return self.viscalist.ptz_state(cam_num)
+
+    def ptz_states(self) -> list:
+        """ Return the resolution state of the PTZ address for each camera, in one call to the relays """
+        return self.viscalist.ptz_states()
+
+    def relay_stats(self) -> list:
+        """ Return the VISCA relay counters for each camera """
+        return self.viscalist.stats()
+
+
+# VISCA relay setup from the settings, shared by the GUI and the headless service.
+# cfg is a config.Config
+
+def relays_create(cfg, count: int, ptz_resolver=None, on_error=print) -> tuple:
+    """ Create the VISCA relays for count cameras (in their own process if configured), with the
+        Companion notifier and the per camera options. Returns (relay list, notifier or None).
+        on_error also gets the relay process failures and restarts
+    """
+    if cfg.relay_process():
+        viscalist = relayprocess.ViscaRelayProcess(count, cfg.relay_port_base(), ViscaPort, on_error)
+    else:
+        viscalist = viscarelay.ViscaRelayList(count, None, cfg.relay_port_base(), ViscaPort, ptz_resolver)
+    notifier = relay_companion_set(viscalist, cfg.bitfocus_info(), on_error)
+    relay_options_apply(viscalist, cfg)
+    return viscalist, notifier
+
+
+def relay_companion_set(viscalist, bitfocus_info, on_error=print):
+    """ Give the relays a notifier for Companion (bitfocus_info is [target, page]), or none (None).
+        Returns the new notifier, or None. The caller closes the previous notifier
+    """
+    if isinstance(viscalist, relayprocess.ViscaRelayProcess):
+        # The relay process runs the notifier
+        return viscalist.companion_set(bitfocus_info, on_error)
+    notifier = None
+    if bitfocus_info is not None:
+        bitfocus = companion.Companion(target=bitfocus_info[0], page=bitfocus_info[1], row=0, on_error=on_error)
+        notifier = companion.CompanionNotifier(bitfocus)
+    viscalist.notifier_set(notifier)
+    return notifier
+
+
+def relay_options_apply(viscalist, cfg):
+    """ Set drive command coalescing and the inquiry cache for every camera. A camera's inquiry cache
+        is only reset if its setting has changed
+    """
+    coalesce = cfg.coalesce_slots()
+    inquiry_cache = cfg.inquiry_cache_slots()
+    for idx in range(cfg.camera_count()):
+        viscalist.coalesce_set(idx, idx in coalesce)
+        viscalist.inquiry_cache_set(idx, cfg.inquiry_ttl() if idx in inquiry_cache else None)
@@ -0,0 +1,370 @@
+#
+# Runs the VISCA relay (viscarelay.ViscaRelayList) in a worker process, so joystick traffic doesn't
+# share the GIL with the GUI event loop, the preview image work and NDI discovery.
+#
+# The relay process is started from this file (or, for the frozen executable, from the executable
+# with WorkerFlag, which ndiselector checks before it imports anything else), so it only imports the
+# relay modules, never the GUI. It connects back to the main process over a multiprocessing.connection
+# socket on 127.0.0.1, authenticated with a key passed in its environment.
+#
+# Each call is a (method, args) request, answered with ('ok', result) or ('error', exception). Only
+# the control calls cross the connection (PTZ target changes, camera models, Companion settings,
+# stats), the VISCA packets never do.
+#
+# If the relay process dies or stops answering it is restarted, and given the settings again (PTZ
+# addresses, camera models, options, Companion). The restart runs on a background thread, so the
+# caller (the GUI event loop) isn't held up; until the new process is in use, calls return None, and
+# stats() and ptz_states() return empty lists.
+#
+# The relay process has its own PTZ hostname resolver and runs the Companion notifier itself.
+# Camera model rules are looked up in the relay process, so only the rules viscarewrite registers
+# when it is imported apply there; rules passed to model_set() are sent across with the call.
+#
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Connection, answer_challenge, deliver_challenge
+import companion
+import viscarelay
+
+# Command line flag which runs the relay process, see worker_command()
+WorkerFlag = '--visca-relay-process'
+# Environment variable holding the connection key
+AuthKeyVar = 'NDISELECTOR_RELAY_KEY'
+# How long to wait (seconds) for the relay process to start, to answer a call, and to stop
+StartWait = 10.0
+CallWait = 2.0
+StopWait = 5.0
+# Don't restart the relay process more often than this (seconds)
+RestartInterval = 5.0
+
+
+class RemoteNotifier:
+    """ Stands in for the CompanionNotifier run by the relay process, for its counters """
+    def __init__(self, relays):
+        self.relays = relays
+
+    def stats(self) -> dict | None:
+        return self.relays.call('companion_stats')
+
+    def close(self):
+        """ Nothing to do, the relay process closes its notifier when it's replaced, or when it stops """
+        pass
+
+
+class RelayWorker:
+    """ The relay process end: the relay list and the Companion notifier, driven by the requests
+        from the main process
+    """
+    # ViscaRelayList methods the main process can call
+    relay_methods = ('resize', 'ptz_set', 'model_set', 'coalesce_set', 'inquiry_cache_set',
+                     'ptz_state', 'ptz_states', 'stats')
+
+    def __init__(self, count: int, baseport: int, viscaport: int):
+        self.relays = viscarelay.ViscaRelayList(count, None, baseport, viscaport)
+        self.notifier = None
+
+    def companion_set(self, bitfocus_info) -> list:
+        """ Start a notifier for Companion ([target, page]), or stop it (None). Returns the errors
+            the user should see
+        """
+        errors = []
+        old_notifier = self.notifier
+        if bitfocus_info is None:
+            self.notifier = None
+        else:
+            bitfocus = companion.Companion(target=bitfocus_info[0], page=bitfocus_info[1], row=0,
+                                           on_error=errors.append)
+            self.notifier = companion.CompanionNotifier(bitfocus)
+        self.relays.notifier_set(self.notifier)
+        if old_notifier is not None:
+            old_notifier.close()
+        return errors
+
+    def companion_stats(self) -> dict | None:
+        return None if self.notifier is None else self.notifier.stats()
+
+    def handler(self, method: str):
+        if method in self.relay_methods:
+            return getattr(self.relays, method)
+        if method in ('companion_set', 'companion_stats'):
+            return getattr(self, method)
+        raise ValueError(f"unknown relay request: {method}")
+
+    def close(self):
+        self.relays.close()
+        self.relays.resolver.close()
+        if self.notifier is not None:
+            self.notifier.close()
+
+
+def worker_command() -> list:
+    """ Command line which starts the relay process """
+    if getattr(sys, 'frozen', False):
+        return [sys.executable, WorkerFlag]
+    return [sys.executable, os.path.abspath(__file__), WorkerFlag]
+
+
+def worker_main(argv: list):
+    """ Relay process: connect to the main process, open the relay ports, then answer requests until
+        told to stop, or until the main process goes away. argv is [port, count, baseport, viscaport]
+    """
+    (port, count, baseport, viscaport) = (int(arg) for arg in argv)
+    conn = Client(('127.0.0.1', port), authkey=bytes.fromhex(os.environ[AuthKeyVar]))
+    try:
+        worker = RelayWorker(count, baseport, viscaport)
+    except Exception as exc:
+        conn.send(('error', exc))
+        return
+    conn.send(('ok', None))
+
+    while True:
+        try:
+            (method, args) = conn.recv()
+        except (EOFError, OSError):
+            break
+        if method == 'close':
+            break
+        try:
+            conn.send(('ok', worker.handler(method)(*args)))
+        except Exception as exc:
+            conn.send(('error', exc))
+
+    worker.close()
+    try:
+        conn.send(('ok', None))
+    except OSError:
+        pass
+
+
+def error_text(exc: Exception) -> str:
+    return str(exc) or type(exc).__name__
+
+
+def process_stop(process, conn):
+    """ Kill a relay process, if it is still running """
+    if conn is not None:
+        conn.close()
+    if process is not None:
+        process.kill()
+        process.wait(StopWait)
+
+
+def reply(conn, timeout: float = CallWait):
+    """ Wait for the answer to a request, raise the exception if it failed """
+    if not conn.poll(timeout):
+        raise TimeoutError("VISCA relay process isn't answering")
+    (status, result) = conn.recv()
+    if status == 'error':
+        raise result
+    return result
+
+
+def remote_call(conn, method: str, *args):
+    conn.send((method, args))
+    return reply(conn)
+
+
+class ViscaRelayProcess:
+    """ Same interface as viscarelay.ViscaRelayList, with the relay running in a worker process.
+        Companion is set with companion_set() rather than notifier_set().
+        The settings of each slot are kept here too, to be given to a restarted relay process.
+        Failures and restarts are reported to on_error, which may be called from the restart thread
+    """
+    def __init__(self, count: int, baseport: int, viscaport: int, on_error=print):
+        self.baseport = baseport
+        self.viscaport = viscaport
+        self.on_error = on_error
+        # Held for each call to the relay process, and while changing the settings below
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.restarts = 0
+        self.restarting = False
+        self.closed = False
+        # per slot: PTZ address, (model, rules), coalesce, inquiry cache TTL
+        self.slots = [self.slot_new() for _ in range(count)]
+        self.bitfocus_info = None
+        # Set when the settings change during a restart, so they are given to the new process again
+        self.changed = False
+        # Errors opening the relay ports are raised here, as they would be by ViscaRelayList
+        (self.process, self.conn) = self.spawn(count)
+
+    @staticmethod
+    def slot_new() -> dict:
+        return {"ptz": None, "model": (None, None), "coalesce": False, "ttl": None}
+
+    def spawn(self, count: int) -> tuple:
+        """ Start a relay process, and wait for it to open the relay ports. Returns (process, connection) """
+        authkey = secrets.token_bytes(32)
+        server = socket.create_server(('127.0.0.1', 0))
+        server.settimeout(StartWait)
+        process = None
+        try:
+            args = [server.getsockname()[1], count, self.baseport, self.viscaport]
+            process = subprocess.Popen(worker_command() + [str(arg) for arg in args],
+                                       env=dict(os.environ, **{AuthKeyVar: authkey.hex()}),
+                                       creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+            sock, _ = server.accept()
+        except OSError:
+            process_stop(process, None)
+            raise
+        finally:
+            server.close()
+        sock.setblocking(True)
+        conn = Connection(sock.detach())
+        try:
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+            reply(conn, StartWait)
+        except Exception:
+            process_stop(process, conn)
+            raise
+        return process, conn
+
+    def restart_begin(self):
+        """ Restart the relay process on a background thread, unless that is already happening or
+            it was started less than RestartInterval ago. Called with the lock held
+        """
+        if self.restarting or self.closed or time.monotonic() - self.started < RestartInterval:
+            return
+        self.restarting = True
+        self.started = time.monotonic()
+        self.restarts += 1
+        threading.Thread(target=self.restart, name="VISCA relay restart", daemon=True).start()
+
+    def restart(self):
+        """ Restart thread: start a new relay process and give it the settings, then put it in use """
+        process = conn = None
+        try:
+            with self.lock:
+                count = len(self.slots)
+            (process, conn) = self.spawn(count)
+            while True:
+                with self.lock:
+                    slots = [dict(slot) for slot in self.slots]
+                    bitfocus_info = self.bitfocus_info
+                    self.changed = False
+                if len(slots) != count:
+                    remote_call(conn, 'resize', len(slots))
+                    count = len(slots)
+                for error in remote_call(conn, 'companion_set', bitfocus_info):
+                    self.on_error(error)
+                for idx, slot in enumerate(slots):
+                    if slot["ptz"] is not None:
+                        remote_call(conn, 'ptz_set', idx, slot["ptz"])
+                    remote_call(conn, 'model_set', idx, *slot["model"])
+                    remote_call(conn, 'coalesce_set', idx, slot["coalesce"])
+                    remote_call(conn, 'inquiry_cache_set', idx, slot["ttl"])
+                with self.lock:
+                    if self.closed:
+                        process_stop(process, conn)
+                        self.restarting = False
+                        return
+                    if not self.changed:
+                        (self.process, self.conn) = (process, conn)
+                        self.restarting = False
+                        break
+        except Exception as exc:
+            process_stop(process, conn)
+            with self.lock:
+                self.restarting = False
+            self.on_error(f"VISCA relay process didn't restart: {error_text(exc)}")
+            return
+        self.on_error("VISCA relay process restarted")
+
+    def failed(self, message: str):
+        """ The relay process has failed: report it, and stop it. Called with the lock held """
+        self.on_error(message)
+        process_stop(self.process, self.conn)
+        (self.process, self.conn) = (None, None)
+
+    def call(self, method: str, *args):
+        """ Call a method in the relay process, and return its result, or None if the relay process
+            has failed. A failed relay process is restarted in the background, calls return None
+            straight away until the new one is in use
+        """
+        with self.lock:
+            if self.conn is None:
+                self.restart_begin()
+                return None
+            try:
+                return remote_call(self.conn, method, *args)
+            except Exception as exc:
+                self.failed(f"VISCA relay process failed: {error_text(exc)}")
+                return None
+
+    def setting_set(self, index: int, key: str, value):
+        """ Record a slot setting, to be given to a restarted relay process """
+        with self.lock:
+            self.slots[index][key] = value
+            self.changed = True
+
+    def resize(self, count: int):
+        with self.lock:
+            del self.slots[count:]
+            while len(self.slots) < count:
+                self.slots.append(self.slot_new())
+            self.changed = True
+        self.call('resize', count)
+
+    def companion_set(self, bitfocus_info, on_error=print) -> RemoteNotifier | None:
+        """ Start the Companion notifier in the relay process for bitfocus_info ([target, page]),
+            or stop it (None). Returns a RemoteNotifier for its counters, or None
+        """
+        with self.lock:
+            self.bitfocus_info = bitfocus_info
+            self.changed = True
+        for error in self.call('companion_set', bitfocus_info) or []:
+            on_error(error)
+        return None if bitfocus_info is None else RemoteNotifier(self)
+
+    def ptz_set(self, index: int, ptz: str):
+        self.setting_set(index, "ptz", ptz)
+        self.call('ptz_set', index, ptz)
+
+    def model_set(self, index: int, model: str = None, rules: list = None):
+        self.setting_set(index, "model", (model, rules))
+        self.call('model_set', index, model, rules)
+
+    def coalesce_set(self, index: int, enabled: bool):
+        self.setting_set(index, "coalesce", enabled)
+        self.call('coalesce_set', index, enabled)
+
+    def inquiry_cache_set(self, index: int, ttl: float | None):
+        if self.slots[index]["ttl"] == ttl:
+            return
+        self.setting_set(index, "ttl", ttl)
+        self.call('inquiry_cache_set', index, ttl)
+
+    def ptz_state(self, index: int):
+        return self.call('ptz_state', index)
+
+    def ptz_states(self) -> list:
+        return self.call('ptz_states') or []
+
+    def stats(self) -> list:
+        return self.call('stats') or []
+
+    def close(self):
+        """ Stop the relay process, once it has released the relay ports """
+        with self.lock:
+            self.closed = True
+            if self.conn is None:
+                return
+            try:
+                self.conn.send(('close', ()))
+                reply(self.conn, StopWait)
+                self.process.wait(StopWait)
+            except Exception:
+                pass
+            process_stop(self.process, self.conn)
+            (self.process, self.conn) = (None, None)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == [WorkerFlag]:
+        worker_main(sys.argv[2:])
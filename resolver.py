@@ -0,0 +1,138 @@
+#
+# Asynchronous, cached hostname resolution for PTZ addresses
+#
+# Lookups run on a small worker pool so a slow or missing DNS/mDNS answer never blocks the
+# GUI or the VISCA relay. Results are cached with a TTL, and hosts which are being watched
+# (e.g. the PTZ target of a relay slot) are refreshed in the background so that address
+# changes (DHCP renewals) are picked up.
+#
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How long a successful/failed lookup is cached (seconds)
+ResolveTTL = 60.0
+ResolveFailTTL = 5.0
+
+
+class Resolver:
+    def __init__(self, ttl: float = ResolveTTL, fail_ttl: float = ResolveFailTTL, workers: int = 4):
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self.lock = threading.Lock()
+        # host -> (address or None, expiry time)
+        self.cache = {}
+        # host -> list of callbacks waiting for a lookup in progress
+        self.pending = {}
+        # host -> list of callbacks to be told when the address changes
+        self.watches = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Resolver")
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.refresh_thread, name="ResolverRefresh")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def numeric(host: str):
+        """ Return the address if host is already a dotted IPv4 address, otherwise None """
+        try:
+            socket.inet_aton(host)
+        except OSError:
+            return None
+        return host if host.count('.') == 3 else None
+
+    def lookup(self, host: str):
+        """ Return the cached address for host, without blocking. Returns None if the host is
+            unknown, or has not been resolved yet
+        """
+        address = self.numeric(host)
+        if address is not None:
+            return address
+        with self.lock:
+            entry = self.cache.get(host)
+        return None if entry is None else entry[0]
+
+    def resolve(self, host: str, callback):
+        """ Resolve host in the background, calling callback(host, address) when done.
+            address is None if the host could not be resolved. The callback is called immediately,
+            from the calling thread, if the answer is already known; otherwise from a worker thread
+        """
+        address = self.numeric(host)
+        if address is not None:
+            callback(host, address)
+            return
+
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry is None or entry[1] < time.monotonic():
+                # lookup needed
+                entry = None
+                waiting = self.pending.get(host)
+                if waiting is None:
+                    self.pending[host] = [callback]
+                    self.executor.submit(self._lookup_task, host)
+                else:
+                    waiting.append(callback)
+        if entry is not None:
+            callback(host, entry[0])
+
+    def watch(self, host: str, callback):
+        """ Resolve host, and call callback(host, address) again whenever the address changes """
+        with self.lock:
+            self.watches.setdefault(host, []).append(callback)
+        self.resolve(host, callback)
+
+    def unwatch(self, host: str, callback):
+        with self.lock:
+            callbacks = self.watches.get(host)
+            if callbacks is not None and callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self.watches[host]
+
+    def _lookup_task(self, host: str):
+        try:
+            address = socket.gethostbyname(host)
+        except (socket.gaierror, UnicodeError):
+            address = None
+
+        now = time.monotonic()
+        with self.lock:
+            old = self.cache.get(host)
+            ttl = self.ttl if address is not None else self.fail_ttl
+            self.cache[host] = (address, now + ttl)
+            waiting = self.pending.pop(host, [])
+            watchers = list(self.watches.get(host, []))
+
+        for callback in waiting:
+            self._notify(callback, host, address)
+
+        # Tell watchers which didn't just get the answer about a changed address
+        if old is not None and old[0] != address and address is not None:
+            for callback in watchers:
+                if callback not in waiting:
+                    self._notify(callback, host, address)
+
+    @staticmethod
+    def _notify(callback, host, address):
+        try:
+            callback(host, address)
+        except Exception as exc:
+            print("Resolver: callback exception ", exc)
+
+    def refresh_thread(self):
+        """ Re-resolve watched hosts as their cache entries expire """
+        while not self.stop_event.wait(1.0):
+            now = time.monotonic()
+            with self.lock:
+                for host in self.watches:
+                    entry = self.cache.get(host)
+                    if host in self.pending or (entry is not None and entry[1] > now):
+                        continue
+                    self.pending[host] = []
+                    self.executor.submit(self._lookup_task, host)
+
+    def close(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,94 @@
+#
+# Sorted index of NDI source names for the sources listbox
+#
+# The index is kept sorted as sources are added and removed, and tracks the subset matching
+# the type-ahead filter. Every change returns a list of edit operations for the listbox:
+#   ('insert', index, name) / ('delete', index)
+# with indexes into the visible list, to be applied in order, so the listbox never has to
+# be rebuilt (and doesn't lose its selection or flicker) as sources come and go.
+#
+from bisect import bisect_left
+
+
+class SourceIndex:
+    def __init__(self):
+        # sorted (key, name), for all sources and for those matching the filter
+        self.entries = []
+        self.visible = []
+        # name -> (key, text searched by the filter)
+        self.info = {}
+        self.filter_text = ''
+
+    @staticmethod
+    def sort_key(name: str):
+        return name.casefold(), name
+
+    def matches(self, name: str) -> bool:
+        return self.filter_text == '' or self.filter_text in self.info[name][1]
+
+    def add(self, name: str, group: str = '') -> list:
+        """ Add a source, returns the listbox operations """
+        if name in self.info:
+            return []
+        key = self.sort_key(name)
+        host = name.split(' ')[0]
+        self.info[name] = (key, ' '.join((name, host, group)).casefold())
+        entry = (key, name)
+        self.entries.insert(bisect_left(self.entries, entry), entry)
+        if not self.matches(name):
+            return []
+        idx = bisect_left(self.visible, entry)
+        self.visible.insert(idx, entry)
+        return [('insert', idx, name)]
+
+    def remove(self, name: str) -> list:
+        """ Remove a source, returns the listbox operations """
+        info = self.info.pop(name, None)
+        if info is None:
+            return []
+        entry = (info[0], name)
+        del self.entries[bisect_left(self.entries, entry)]
+        idx = bisect_left(self.visible, entry)
+        if idx < len(self.visible) and self.visible[idx] == entry:
+            del self.visible[idx]
+            return [('delete', idx)]
+        return []
+
+    def set_filter(self, text: str) -> list:
+        """ Change the filter, returns the listbox operations to go from the old to the new visible list """
+        self.filter_text = text.strip().casefold()
+        old = self.visible
+        new = [entry for entry in self.entries if self.matches(entry[1])]
+        self.visible = new
+
+        # Merge the two sorted lists, deleting entries which are no longer visible
+        # and inserting new ones, tracking the position in the listbox as it changes
+        ops = []
+        i = j = pos = 0
+        while i < len(old) or j < len(new):
+            if j >= len(new) or (i < len(old) and old[i] < new[j]):
+                ops.append(('delete', pos))
+                i += 1
+            elif i >= len(old) or new[j] < old[i]:
+                ops.append(('insert', pos, new[j][1]))
+                j += 1
+                pos += 1
+            else:
+                i += 1
+                j += 1
+                pos += 1
+        return ops
+
+    def clear(self) -> list:
+        ops = [('delete', 0)] * len(self.visible)
+        self.entries = []
+        self.visible = []
+        self.info = {}
+        return ops
+
+    def names(self) -> list:
+        """ Return the visible names, in order """
+        return [entry[1] for entry in self.visible]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,71 @@
+#
+# Startup profiler
+#
+# Records how long each startup phase takes (phases may run in parallel, on different threads),
+# and how long each module takes the first time it is imported. Import times include the modules
+# imported by that module, so the report lists the top level cost of each import.
+#
+# The profiler must be created before the imports it should measure, and finish() called once
+# startup is done, which stops timing imports.
+#
+import builtins
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.finished = None
+        # (name, thread name, start offset, duration)
+        self.phases = []
+        # module name -> seconds, for the first import of the module
+        self.imports = {}
+        self.lock = threading.Lock()
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        t0 = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self.imports.setdefault(name, time.perf_counter() - t0)
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Time a startup phase """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            with self.lock:
+                self.phases.append((name, threading.current_thread().name, t0 - self.start, t1 - t0))
+
+    def finish(self):
+        """ Startup is done, stop timing imports """
+        if self.finished is None:
+            self.finished = time.perf_counter() - self.start
+            if builtins.__import__ == self._timed_import:
+                builtins.__import__ = self._import
+
+    def report(self, imports: int = 10) -> str:
+        """ Return the phase times, and the <imports> slowest imports, as text """
+        total = self.finished if self.finished is not None else time.perf_counter() - self.start
+        lines = [f"Startup {total * 1000:.0f}ms",
+                 f"{'phase':24} {'thread':16} {'start':>8} {'time':>8}"]
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[2])
+        for name, thread, start, duration in phases:
+            lines.append(f"{name[:24]:24} {thread[:16]:16} {start * 1000:>6.0f}ms {duration * 1000:>6.0f}ms")
+
+        lines.append(f"{'import':41} {'time':>8}")
+        slowest = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)[:imports]
+        for name, duration in slowest:
+            lines.append(f"{name[:41]:41} {duration * 1000:>6.0f}ms")
+        return '\n'.join(lines)
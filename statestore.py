@@ -0,0 +1,110 @@
+#
+# Persistent camera state: the source selected for each camera, and the PTZ address of every
+# source which has been given one other than its default
+#
+# Saves are debounced and written by a background thread, so a burst of Set Camera/Set PTZ
+# changes costs one write, and the GUI thread never waits on the disk. The file is written to a
+# temporary name and renamed over the old one, so a crash never leaves a partial file.
+#
+# The state used to be kept in the settings file, as the -CAMSTATE- entry; it is read from there
+# if the state file doesn't exist yet.
+#
+import json
+import os
+import threading
+import time
+
+# Seconds without a change before the state is written, and the longest a change can wait
+StateDebounce = 0.5
+StateMaxDelay = 2.0
+
+StateVersion = 1
+
+
+class CameraStateStore:
+    def __init__(self, filename: str, legacy_settings=None,
+                 debounce: float = StateDebounce, max_delay: float = StateMaxDelay):
+        self.filename = filename
+        self.legacy_settings = legacy_settings
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        # state waiting to be written, the time it is due, and the latest time it can be put off to
+        self.pending = None
+        self.due = 0.0
+        self.deadline = 0.0
+        self.closing = False
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, name="CameraState")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self) -> tuple:
+        """ Return (source name -> PTZ address, list of camera source names) """
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            return dict(state.get('ptz', {})), list(state.get('cameras', []))
+        except FileNotFoundError:
+            return self.load_legacy()
+        except (OSError, ValueError, AttributeError) as exc:
+            print("CameraStateStore: can't read ", self.filename, exc)
+            return {}, []
+
+    def load_legacy(self) -> tuple:
+        """ Convert the -CAMSTATE- (list of (name, ptz) for every source, camera names) settings entry """
+        if self.legacy_settings is None:
+            return {}, []
+        ndi_list, camera_list = self.legacy_settings.get("-CAMSTATE-", (None, None))
+        ptz = {}
+        for name, ptz_name in ndi_list or []:
+            if name != "None" and ptz_name != name.split(' ')[0]:
+                ptz[name] = ptz_name
+        return ptz, list(camera_list or [])
+
+    def save(self, ptz: dict, cameras: list):
+        """ Queue the state to be written """
+        state = {'version': StateVersion, 'cameras': list(cameras), 'ptz': dict(ptz)}
+        now = time.monotonic()
+        with self.cond:
+            if self.pending is None:
+                self.deadline = now + self.max_delay
+            self.pending = state
+            self.due = min(now + self.debounce, self.deadline)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closing:
+                    self.cond.wait()
+                while self.pending is not None and not self.closing:
+                    delay = self.due - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                state = self.pending
+                self.pending = None
+                if state is None:
+                    return
+            self.write(state)
+
+    def write(self, state: dict):
+        tmpname = self.filename + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            with open(tmpname, 'w') as f:
+                json.dump(state, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, self.filename)
+            self.writes += 1
+        except OSError as exc:
+            print("CameraStateStore: can't write ", self.filename, exc)
+
+    def close(self):
+        """ Write any queued state, and stop the writer thread """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join()
@@ -0,0 +1,137 @@
+#
+# Thumbnail cache and background prefetch for the NDI sources on the network
+#
+# The prefetcher grabs a frame from every known source, with a small worker pool and
+# a limit on how many grabs are started per second, so that the viewer can show a
+# (slightly old) thumbnail as soon as a source is selected.
+#
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import ndi_image
+
+# Cache limits: total size of the viewer data (bytes), and age. Viewer data is uncompressed PPM,
+# so a viewer sized thumbnail is several hundred KB
+ThumbnailCacheBytes = 16 * 1024 * 1024
+ThumbnailMaxAge = 600.0
+
+# Prefetch: worker threads, grabs started per second, and how often each source is refreshed
+PrefetchWorkers = 2
+PrefetchRate = 1.0
+PrefetchInterval = 60.0
+
+
+class ThumbnailCache:
+    """ Viewer data for each source name, evicted by total size (least recently stored first) and by age """
+    def __init__(self, maxbytes: int = ThumbnailCacheBytes, maxage: float = ThumbnailMaxAge):
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def put(self, name: str, data: bytes):
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.nbytes -= len(old[0])
+            self.entries[name] = (data, time.monotonic())
+            self.nbytes += len(data)
+            # Always keep the newest entry, even if it is bigger than the limit on its own
+            while self.nbytes > self.maxbytes and len(self.entries) > 1:
+                _, (old_data, _) = self.entries.popitem(last=False)
+                self.nbytes -= len(old_data)
+
+    def get(self, name: str):
+        """ Return the cached data for a source, or None """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.maxage:
+                del self.entries[name]
+                self.nbytes -= len(entry[0])
+                return None
+            return entry[0]
+
+    def age(self, name: str):
+        """ Return the age of the cached data for a source, or None """
+        with self.lock:
+            entry = self.entries.get(name)
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+class ThumbnailPrefetcher:
+    """ Background thread which keeps the thumbnail cache filled for every source.
+        sources is a function returning a list of (name, NDI source) for the current sources.
+        Grabs use their own short lived receivers, rather than the viewer's receiver pool.
+    """
+    def __init__(self, cache: ThumbnailCache, sources, imgsize: tuple[int, int],
+                 workers: int = PrefetchWorkers, rate: float = PrefetchRate,
+                 interval: float = PrefetchInterval):
+        self.cache = cache
+        self.sources = sources
+        self.imgsize = imgsize
+        self.workers = workers
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        # name -> time the next grab is due
+        self.due = {}
+        self.inflight = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Thumbnail")
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="ThumbnailPrefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """ Start at most <rate> grabs per second, and never more than <workers> at once """
+        while not self.stop_event.wait(1.0 / self.rate):
+            with self.lock:
+                if len(self.inflight) >= self.workers:
+                    continue
+
+            try:
+                sources = self.sources()
+            except Exception as exc:
+                print("ThumbnailPrefetcher: exception ", exc)
+                continue
+
+            now = time.monotonic()
+            with self.lock:
+                for name, ndi_src in sources:
+                    if ndi_src is None or name in self.inflight or self.due.get(name, 0.0) > now:
+                        continue
+                    # Spread the refreshes out, so they don't all come due together
+                    self.due[name] = now + self.interval * random.uniform(0.8, 1.2)
+                    self.inflight.add(name)
+                    self.executor.submit(self._grab, name, ndi_src)
+                    break
+
+    def _grab(self, name: str, ndi_src):
+        try:
+            img = ndi_image.getframe_ndi(ndi_src, self.imgsize, pool=None)
+            if img is not None and not self.stop_event.is_set():
+                self.cache.put(name, ndi_image.viewer_data(img, self.imgsize))
+        except Exception as exc:
+            print("ThumbnailPrefetcher: exception ", exc)
+        finally:
+            with self.lock:
+                self.inflight.discard(name)
+
+    def reset(self):
+        """ Forget the schedule, e.g. after the source list has been cleared """
+        with self.lock:
+            self.due.clear()
+
+    def close(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
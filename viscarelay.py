@@ -1,111 +1,697 @@
 #
 # Code to handle ViscaRelay instances
 #
+# All relay sockets are serviced from a single event loop (ViscaRelayEngine), rather than
+# one polling thread per camera slot. Packets are forwarded as soon as the kernel reports the
+# socket readable, and an idle slot costs nothing.
+#
 import socket
 import threading
 import struct
+import selectors
 import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+import resolver
+import viscarewrite
 
-# Workaround for bug in PTZ Controller INQUIRY commands
+# Workaround for bug in PTZ Controller INQUIRY commands (applied to every slot)
 Fix_INQUIRY = True
-last_relay = -1
+if Fix_INQUIRY:
+    viscarewrite.register_rule(viscarewrite.InquiryInCommandRule())
+
+# Largest VISCA over IP packet relayed
+RelayBufferSize = 1024
+
+# Maximum number of packets read from one socket before servicing the others
+RelayBurst = 32
+
+# VISCA over IP header: payload type, payload length, sequence number
+VISCA_HEADER = struct.Struct("!HHL")
+
+# Reply routing: number of outstanding sequence numbers remembered per slot, and for how long
+ReplyRouteSize = 256
+ReplyRouteAge = 5.0
+
+# Drive command coalescing: header plus the first 4 bytes of the VISCA payload
+VISCA_DRIVE = struct.Struct("!HHLBBBB")
+# Drive axes, a stop command for an axis is reported as the negated axis
+AXIS_PANTILT = 1
+AXIS_ZOOM = 2
+AXIS_FOCUS = 3
+# How long to wait for the camera to answer a command before sending the next one regardless
+CoalesceTimeout = 0.2
+# How often the engine checks for coalescing timeouts, while commands are queued
+EngineTick = 0.05
+# ACK and COMPLETION sent to the controller on behalf of the camera for a superseded command
+ACK_PAYLOAD = bytes((0x90, 0x41, 0xff))
+COMPLETION_PAYLOAD = bytes((0x90, 0x51, 0xff))
+
+# Inquiry cache: default time an inquiry reply is reused for (seconds), and the number of replies
+# and of inquiries waiting for a reply remembered per slot
+InquiryTTL = 0.1
+InquiryCacheSize = 64
+
+# Upper bounds (seconds) of the camera response time histogram buckets, plus an overflow bucket
+ResponseBuckets = (0.001, 0.002, 0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500, 1.0)
+
+
+class ReplyRouteTable:
+    """ Map the sequence number of each controller packet to the controller which sent it, so
+        that camera replies (ACK, COMPLETION, INQUIRY reply) go back to the right controller when
+        several controllers drive the same slot.
+        Bounded in size, entries older than maxage are evicted. If two controllers happen to use
+        the same sequence number at the same time the most recent sender wins.
+        Each entry is [controller address, time sent, replied]
+    """
+    def __init__(self, size: int = ReplyRouteSize, maxage: float = ReplyRouteAge):
+        self.size = size
+        self.maxage = maxage
+        self.routes = OrderedDict()
+
+    def add(self, seq: int, address, now: float):
+        routes = self.routes
+        if seq in routes:
+            routes.move_to_end(seq)
+        routes[seq] = [address, now, False]
+        # Entries are kept in order of last use, so the oldest are at the front
+        while routes:
+            oldest = next(iter(routes.values()))
+            if len(routes) > self.size or now - oldest[1] > self.maxage:
+                routes.popitem(last=False)
+            else:
+                break
+
+    def lookup(self, seq: int, now: float):
+        """ Return the entry for a sequence number, or None """
+        entry = self.routes.get(seq)
+        if entry is None or now - entry[1] > self.maxage:
+            return None
+        return entry
+
+    def clear(self):
+        self.routes.clear()
+
+
+class InquiryCache:
+    """ Recent camera replies to inquiries for one slot, so that controllers and tally tools which keep
+        polling the camera (power, zoom position, pan/tilt position...) are answered by the relay,
+        and the camera is left to get on with the commands.
+        Replies are keyed by camera address and inquiry payload, and reused for ttl seconds.
+        Any command sent to the camera clears the cache, and forgets the inquiries in flight,
+        whose replies may describe the camera before the command. Only used from the engine thread
+    """
+    def __init__(self, ttl: float = InquiryTTL, size: int = InquiryCacheSize):
+        self.ttl = ttl
+        self.size = size
+        # (camera address, inquiry payload) -> (reply payload, time received)
+        self.replies = OrderedDict()
+        # (controller address, sequence number) -> (camera address, inquiry payload), for inquiries sent
+        # to the camera. None if another controller has the same sequence number in flight: the camera
+        # replies can't be told apart, so neither is kept
+        self.inflight = OrderedDict()
+        # sequence number -> controller address, for the inquiries in flight
+        self.senders = {}
+
+    def lookup(self, key: tuple, now: float):
+        """ Return the reply payload for an inquiry, or None if there isn't a fresh one """
+        entry = self.replies.get(key)
+        if entry is None or now - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def sent(self, address, seq: int, key: tuple):
+        """ An inquiry from the controller at address has been sent to the camera """
+        other = self.senders.get(seq)
+        if other is not None and other != address and (other, seq) in self.inflight:
+            self.inflight[(other, seq)] = None
+            key = None
+        self.senders[seq] = address
+        self.inflight[(address, seq)] = key
+        if len(self.inflight) > self.size:
+            ((old_address, old_seq), _) = self.inflight.popitem(last=False)
+            if self.senders.get(old_seq) == old_address:
+                del self.senders[old_seq]
+
+    def reply(self, address, seq: int, payload: bytes, now: float):
+        """ The camera has replied to the controller at address, keep the reply if it answers
+            an inquiry (90 5x ... FF) """
+        key = self.inflight.pop((address, seq), None)
+        if self.senders.get(seq) == address:
+            del self.senders[seq]
+        if key is None or len(payload) < 3 or (payload[1] & 0xf0) != 0x50:
+            return
+        self.replies[key] = (payload, now)
+        self.replies.move_to_end(key)
+        if len(self.replies) > self.size:
+            self.replies.popitem(last=False)
+
+    def clear(self):
+        self.replies.clear()
+        self.inflight.clear()
+        self.senders.clear()
+
+
+def drive_axis(buffer, length: int) -> int:
+    """ Classify a VISCA over IP packet. Returns the axis (AXIS_*) for a Pan-tiltDrive, Zoom or Focus
+        drive command, the negated axis for the stop command of that axis, or 0 for anything else
+    """
+    if length < 14:
+        return 0
+    (vtype, _, _, b0, b1, b2, b3) = VISCA_DRIVE.unpack_from(buffer)
+    if vtype != viscarewrite.VISCA_COMMAND or (b0 & 0xf0) != 0x80 or b1 != 0x01:
+        return 0
+    if b2 == 0x06 and b3 == 0x01 and length >= 17:
+        # 8x 01 06 01 VV WW XX YY FF, stop is XX YY = 03 03
+        return -AXIS_PANTILT if buffer[14] == 0x03 and buffer[15] == 0x03 else AXIS_PANTILT
+    if b2 == 0x04 and (b3 == 0x07 or b3 == 0x08):
+        # 8x 01 04 07 pp FF (zoom) or 8x 01 04 08 pp FF (focus), stop is pp = 00
+        axis = AXIS_ZOOM if b3 == 0x07 else AXIS_FOCUS
+        return -axis if buffer[12] == 0x00 else axis
+    return 0
+
+
+class RelayStats:
+    """ Counters for one relay slot, updated from the relay hot path.
+        All storage is allocated up front; recording a packet only updates existing
+        attributes and histogram buckets.
+    """
+    def __init__(self):
+        self.ctl_in = 0          # packets received from controllers
+        self.ctl_out = 0         # packets sent to controllers
+        self.cam_in = 0          # packets received from the camera
+        self.cam_out = 0         # packets sent to the camera
+        self.drops = 0           # packets with no destination, or which could not be sent
+        self.resets = 0          # ConnectionResetErrors
+        self.rewrites = {}       # rule name -> packets rewritten by that rule
+        self.superseded = 0      # drive commands replaced by a newer command before being sent
+        self.queue_depth = 0     # commands waiting for the camera to answer the previous command
+        self.queue_max = 0
+        self.ack_timeouts = 0    # commands the camera never answered while coalescing
+        self.inquiry_hits = 0    # inquiries answered from the inquiry cache
+        self.inquiry_misses = 0  # inquiries sent to the camera while the inquiry cache is enabled
+        self.response_hist = array('L', [0] * (len(ResponseBuckets) + 1))
+
+    def response(self, seconds: float):
+        """ Record the time from a controller packet to the first camera reply """
+        self.response_hist[bisect_left(ResponseBuckets, seconds)] += 1
+
+    def response_percentile(self, q: float):
+        """ Estimate a response time percentile (in ms) from the histogram, the upper bound of the
+            bucket it falls in. Returns None if there are no samples, or inf for the overflow bucket
+        """
+        total = sum(self.response_hist)
+        if total == 0:
+            return None
+        target = q * total
+        count = 0
+        for idx, n in enumerate(self.response_hist):
+            count += n
+            if count >= target:
+                break
+        if idx >= len(ResponseBuckets):
+            return float('inf')
+        return ResponseBuckets[idx] * 1000.0
+
+    def snapshot(self) -> dict:
+        return {"ctl_in": self.ctl_in, "ctl_out": self.ctl_out,
+                "cam_in": self.cam_in, "cam_out": self.cam_out,
+                "drops": self.drops, "resets": self.resets,
+                "inquiry_fixes": self.rewrites.get(viscarewrite.InquiryInCommandRule.name, 0),
+                "rewrites": dict(self.rewrites),
+                "superseded": self.superseded,
+                "queue_depth": self.queue_depth,
+                "queue_max": self.queue_max,
+                "ack_timeouts": self.ack_timeouts,
+                "inquiry_hits": self.inquiry_hits,
+                "inquiry_misses": self.inquiry_misses,
+                "response_buckets_ms": [b * 1000.0 for b in ResponseBuckets],
+                "response_hist": list(self.response_hist),
+                "response_p50_ms": self.response_percentile(0.5),
+                "response_p99_ms": self.response_percentile(0.99)}
+
 
 class ViscaRelayInstance:
     def ptz_set(self, ptz: str):
-        """ Set a new ptz destination """
-        try:
-            ptz_address = socket.gethostbyname(ptz)
+        """ Set a new ptz destination. The name is resolved in the background, packets continue
+            to go to the previous destination until the new address is known
+        """
+        if ptz == self.ptz_name:
+            return
+        if self.ptz_name is not None:
+            self.resolver.unwatch(self.ptz_name, self._ptz_resolved)
+        self.ptz_name = ptz
+        self.ptz_state = 'resolving'
+        self.resolver.watch(ptz, self._ptz_resolved)
+
+    def _ptz_resolved(self, ptz: str, ptz_address):
+        """ Resolver callback, the address for a ptz name is known (or has changed) """
+        if ptz != self.ptz_name:
+            return
+        if ptz_address is None:
+            self.ptz_state = 'failed'
+        else:
+            # Single assignment, so the relay loop sees either the old or new destination
             self.ptz_sockaddr = (ptz_address, self.ptz_port)
-        except socket.gaierror:
-            pass
+            self.ptz_state = 'ok'
 
-    def relaythread(self):
-        """ Loop:
-            - receive packet
-            - if packet src socket == ViscaPort then it's from the camera -> Forward back to the last sockaddr
-              seen from the controller
+    def rules_set(self, model: str = None, rules: list = None):
+        """ Set the camera model, and any extra rewrite rules, for this slot """
+        to_camera, to_controller = viscarewrite.rules_for(model, rules)
+        for rule in to_camera + to_controller:
+            self.stats.rewrites.setdefault(rule.name, 0)
+        self.model = model
+        # Single assignment each, picked up by the relay loop on the next packet
+        self.rules_to_camera = to_camera
+        self.rules_to_controller = to_controller
+
+    def relay(self, length: int, address):
+        """ Relay a single packet, held in the first <length> bytes of the receive buffer:
+            - if packet src socket == ViscaPort then it's from the camera -> Forward back to the controller
+              which sent the matching sequence number, or failing that the last sockaddr seen from a controller
             - otherwise, forward to the current sockaddr for the camera
         """
-        global last_relay
+        stats = self.stats
+        buffer = self.buffer
 
-        s = self.socket
-        self.recv_sockaddr = None
+        if address == self.ptz_sockaddr:
+            # Packet is a response from the camera
+            stats.cam_in += 1
+            to_camera = False
+            dst_sockaddr = None
+            for rule in self.rules_to_controller:
+                if rule.apply(buffer, length):
+                    stats.rewrites[rule.name] += 1
+            if length >= VISCA_HEADER.size:
+                (vtype, _, seq) = VISCA_HEADER.unpack_from(buffer)
+                now = time.monotonic()
+                if seq == self.awaiting:
+                    # Camera has answered the command in flight, it can take the next one
+                    self.awaiting = None
+                    self.send_next(now)
+                route = self.reply_routes.lookup(seq, now)
+                if route is not None:
+                    dst_sockaddr = route[0]
+                    if not route[2]:
+                        route[2] = True
+                        stats.response(now - route[1])
+                    cache = self.inquiry_cache
+                    if cache is not None and vtype == viscarewrite.VISCA_REPLY:
+                        cache.reply(dst_sockaddr, seq, bytes(self.view[VISCA_HEADER.size:length]), now)
+            if dst_sockaddr is None:
+                dst_sockaddr = self.recv_sockaddr
+            # We don't clear the route here because it is possible to get multiple packets in response
+            # eg: CMD-> ACK, REPLY
+        else:
+            # Packet is a (probably) from a controller. Save address for later reply
+            stats.ctl_in += 1
+            to_camera = True
+            self.recv_sockaddr = address
+            # forward packet to the camera
+            dst_sockaddr = self.ptz_sockaddr
+
+            # If the Bitfocus Companion interface is configured, and the controller
+            # has switched to a new relay destination, try to trigger a switch
+            # to the appropriate camera in the preview window
+            # This assumes only one controller is active at once and that
+            # the controller only talks to one camera at a time
+            # The notifier sends the switch from its own thread
+            #
+            if self.notifier is not None:
+                self.notifier.switch(self.relay_num + 1)
+
+            # Controller/camera quirks, e.g. Fix_INQUIRY
+            for rule in self.rules_to_camera:
+                if rule.apply(buffer, length):
+                    stats.rewrites[rule.name] += 1
+
+            if length >= VISCA_HEADER.size:
+                (vtype, _, seq) = VISCA_HEADER.unpack_from(buffer)
+                now = time.monotonic()
+                cache = self.inquiry_cache
+                if cache is not None and dst_sockaddr is not None:
+                    if vtype == viscarewrite.VISCA_INQUIRY:
+                        key = (dst_sockaddr, bytes(self.view[VISCA_HEADER.size:length]))
+                        payload = cache.lookup(key, now)
+                        if payload is not None:
+                            stats.inquiry_hits += 1
+                            self.answer_inquiry(seq, payload, address)
+                            return
+                        stats.inquiry_misses += 1
+                        cache.sent(address, seq, key)
+                    elif vtype == viscarewrite.VISCA_COMMAND:
+                        cache.clear()
+                self.reply_routes.add(seq, address, now)
+                if self.coalesce and vtype == viscarewrite.VISCA_COMMAND and dst_sockaddr is not None:
+                    if not self.coalesce_command(length, seq, now):
+                        # Queued until the camera has answered the command in flight
+                        return
+
+        if dst_sockaddr is None:
+            stats.drops += 1
+            return
+        try:
+            self.socket.sendto(self.view[:length], dst_sockaddr)
+        except BlockingIOError:
+            # Send buffer full, drop the packet
+            stats.drops += 1
+            return
+        except ConnectionResetError:
+            # Destination unreachable
+            stats.resets += 1
+            stats.drops += 1
+            return
+        if to_camera:
+            stats.cam_out += 1
+        else:
+            stats.ctl_out += 1
+
+    def coalesce_set(self, enabled: bool):
+        """ Enable/disable drive command coalescing. While the camera has not answered the command
+            in flight, commands are queued, and a newer drive command replaces a queued drive
+            command for the same axis. Stop commands and other commands are always sent, in order.
+        """
+        self.coalesce = enabled
+
+    def coalesce_command(self, length: int, seq: int, now: float) -> bool:
+        """ Coalescing for a command from a controller, held in the receive buffer.
+            Returns True if it should be sent to the camera now, False if it has been queued
+        """
+        if self.awaiting is not None and now - self.awaiting_since > CoalesceTimeout:
+            # Camera never answered, stop waiting for it
+            self.stats.ack_timeouts += 1
+            self.awaiting = None
+            self.send_next(now)
+
+        if self.awaiting is None:
+            self.awaiting = seq
+            self.awaiting_since = now
+            return True
+
+        stats = self.stats
+        pending = self.pending
+        axis = drive_axis(self.buffer, length)
+        if axis > 0:
+            # Find the latest queued drive command for this axis and replace it, unless a stop or a
+            # non-drive command is queued after it: those are always sent, in order
+            for entry in reversed(pending):
+                if entry[0] <= 0:
+                    break
+                if entry[0] == axis:
+                    superseded_seq = entry[1]
+                    entry[1] = seq
+                    entry[2] = bytes(self.view[:length])
+                    stats.superseded += 1
+                    self.answer_superseded(superseded_seq, now)
+                    return False
 
-        while True:
-            time.sleep(0.001)
+        pending.append([axis, seq, bytes(self.view[:length])])
+        stats.queue_depth = len(pending)
+        if stats.queue_depth > stats.queue_max:
+            stats.queue_max = stats.queue_depth
+        self.engine.ticking.add(self)
+        return False
+
+    def inquiry_cache_set(self, ttl: float | None):
+        """ Enable the inquiry cache, reusing replies for ttl seconds, or disable it (None).
+            The cached replies are kept if the setting hasn't changed
+        """
+        cache = self.inquiry_cache
+        if (cache.ttl if cache is not None else None) == ttl:
+            return
+        # Single assignment, picked up by the relay loop on the next packet
+        self.inquiry_cache = InquiryCache(ttl) if ttl is not None else None
+
+    def answer_inquiry(self, seq: int, payload: bytes, address):
+        """ Answer an inquiry from the cache, with the sequence number of the inquiry """
+        try:
+            self.socket.sendto(VISCA_HEADER.pack(viscarewrite.VISCA_REPLY, len(payload), seq) + payload, address)
+            self.stats.ctl_out += 1
+        except (BlockingIOError, ConnectionResetError):
+            self.stats.drops += 1
+
+    def answer_superseded(self, seq: int, now: float):
+        """ Send ACK and COMPLETION for a command which will never reach the camera, so the
+            controller does not retransmit it
+        """
+        route = self.reply_routes.lookup(seq, now)
+        if route is None:
+            return
+        route[2] = True
+        for payload in (ACK_PAYLOAD, COMPLETION_PAYLOAD):
             try:
-                buffer, address = s.recvfrom(1024)
-                if address == self.ptz_sockaddr:
-                    # Packet is a response from the camera
-                    dst_sockaddr = self.recv_sockaddr
-                    # We don't clear the sockaddr here because it is possible to get multiple packets in response
-                    # eg: CMD-> ACK, REPLY
-                else:
-                    # Packet is a (probably) from a controller. Save address for later reply
-                    self.recv_sockaddr = address
-                    # forward packet to the camera
-                    dst_sockaddr = self.ptz_sockaddr
-
-                    # If the Bitfocus Companion interface is configured, and the controller
-                    # has switched to a new relay destination, try to trigger a switch
-                    # to the appropriate camera in the preview window
-                    # This assumes only one controller is active at once and that
-                    # the controller only talks to one camera at a time
-                    #
-                    if self.bitfocus is not None and self.relay_num != last_relay:
-                        self.bitfocus.pushbutton(column=self.relay_num+1)
-                        last_relay = self.relay_num
-
-                    # Patch around bug in AVKANS controller, it encapsulates INQUIRY commands
-                    # in Visca CMD packets
-                    if Fix_INQUIRY and len(buffer) > 10:
-                        fmt= "!HHL"
-                        (vcmd, vlen, seq)= struct.unpack_from(fmt, buffer)
-                        payload = buffer[struct.calcsize(fmt):]
-                        cmd = 0
-                        if len(payload) > 2:
-                            (cmd)= struct.unpack_from("!H", payload)
-
-                        if cmd[0] == 0x8109 and vcmd == 0x0100:
-                            vcmd = 0x0110
-                            buffer = struct.pack('!HHL', vcmd, vlen, seq) + payload
-
-                if dst_sockaddr is not None:
-                    s.sendto(buffer, dst_sockaddr)
+                self.socket.sendto(VISCA_HEADER.pack(viscarewrite.VISCA_REPLY, len(payload), seq) + payload,
+                                   route[0])
+                self.stats.ctl_out += 1
+            except (BlockingIOError, ConnectionResetError):
+                self.stats.drops += 1
+
+    def send_next(self, now: float):
+        """ Send the next queued command to the camera """
+        pending = self.pending
+        if not pending:
+            return
+        (_, seq, packet) = pending.popleft()
+        self.stats.queue_depth = len(pending)
+        self.awaiting = seq
+        self.awaiting_since = now
+        try:
+            self.socket.sendto(packet, self.ptz_sockaddr)
+            self.stats.cam_out += 1
+        except (BlockingIOError, ConnectionResetError, TypeError):
+            # TypeError - no ptz destination
+            self.stats.drops += 1
+
+    def tick(self, now: float):
+        """ Called periodically by the engine while commands are queued """
+        if self.awaiting is not None and now - self.awaiting_since > CoalesceTimeout:
+            self.stats.ack_timeouts += 1
+            self.awaiting = None
+            self.send_next(now)
+        if not self.pending:
+            self.engine.ticking.discard(self)
+
+    def service(self):
+        """ Called from the engine when the socket is readable.
+            Drain the socket (up to RelayBurst packets) and relay each packet
+        """
+        s = self.socket
+        buffer = self.buffer
+        for _ in range(RelayBurst):
+            try:
+                length, address = s.recvfrom_into(buffer)
+            except BlockingIOError:
+                return
             except ConnectionResetError:
-                pass
+                # Windows reports ICMP port unreachable from an earlier send on the next receive
+                self.stats.resets += 1
+                continue
+            self.relay(length, address)
 
-            # Loop forever
+    def close(self):
+        if self.ptz_name is not None:
+            self.resolver.unwatch(self.ptz_name, self._ptz_resolved)
+        self.socket.close()
 
-    def __init__(self, rcv_port: int, ptz_port: int, bitfocus, relay_num):
+    def __init__(self, rcv_port: int, ptz_port: int, notifier, relay_num, ptz_resolver: resolver.Resolver):
         """ Init:
             - create and bind socket for input.
             - create send sockaddr for sending to camera
-            - create task to perform relay
             - packets to be relayed from controller will be from a random socket
             - response packets from camera will be from port 52381
             - forward packets back to controller
+            The relay itself is performed by the ViscaRelayEngine the instance is registered with
         """
         self.relay_num = relay_num
-        self.bitfocus = bitfocus
+        self.notifier = notifier
+        self.resolver = ptz_resolver
         self.rcv_port = rcv_port
         self.ptz_port = ptz_port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         address = ("", rcv_port)
         self.socket.bind(address)
+        self.socket.setblocking(False)
+        # Packets are received into, and rewritten in, a preallocated buffer
+        self.buffer = bytearray(RelayBufferSize)
+        self.view = memoryview(self.buffer)
         self.recv_sockaddr = None
+        self.reply_routes = ReplyRouteTable()
+        self.stats = RelayStats()
+        self.ptz_name = None
+        self.ptz_state = None
         self.ptz_sockaddr = None
-        self.thread = threading.Thread(target=self.relaythread)
+        self.model = None
+        self.rules_to_camera = ()
+        self.rules_to_controller = ()
+        self.rules_set()
+        # Drive command coalescing, only used from the engine thread
+        self.engine = None
+        self.coalesce = False
+        self.awaiting = None
+        self.awaiting_since = 0.0
+        self.pending = deque()
+        # Inquiry cache, if enabled, only used from the engine thread
+        self.inquiry_cache = None
+
+
+class ViscaRelayEngine:
+    """ Single event loop which services the sockets for every ViscaRelayInstance.
+        Instances are added/removed through a request queue which is processed by the loop
+        thread, so the selector is only ever touched from one thread.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.requests = []
+        self.requests_lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.running = True
+        # Instances with queued (coalesced) commands, which need periodic attention
+        self.ticking = set()
+        self.thread = threading.Thread(target=self.run, name="ViscaRelayEngine")
         self.thread.daemon = True
         self.thread.start()
 
+    def _request(self, op: str, instance: ViscaRelayInstance | None) -> threading.Event:
+        """ Queue a request for the loop thread, returns an Event which is set once it has been done """
+        done = threading.Event()
+        with self.requests_lock:
+            self.requests.append((op, instance, done))
+        self.wakeup()
+        return done
+
+    def wakeup(self):
+        """ Force the loop out of select() """
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # Wakeup already pending
+            pass
+
+    def register(self, instance: ViscaRelayInstance):
+        self._request('register', instance)
+
+    def unregister(self, instance: ViscaRelayInstance, wait: bool = False):
+        """ Stop servicing an instance, and close its socket. If wait is set, wait until the socket
+            is closed, e.g. so the port can be bound again straight away
+        """
+        done = self._request('unregister', instance)
+        if wait:
+            done.wait(1.0)
+
+    def stop(self):
+        """ Stop the loop, closing every registered socket """
+        self._request('stop', None)
+        self.thread.join()
+
+    def _process_requests(self):
+        try:
+            while self.wakeup_recv.recv(256):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.requests_lock:
+            requests = self.requests
+            self.requests = []
+
+        for op, instance, done in requests:
+            if op == 'register':
+                instance.engine = self
+                self.selector.register(instance.socket, selectors.EVENT_READ, instance)
+            elif op == 'unregister':
+                self.ticking.discard(instance)
+                self.selector.unregister(instance.socket)
+                instance.close()
+            elif op == 'stop':
+                self.running = False
+            done.set()
+
+    def run(self):
+        """ Loop until stopped, relaying packets for whichever sockets are readable """
+        while self.running:
+            for key, _ in self.selector.select(EngineTick if self.ticking else None):
+                if key.data is None:
+                    self._process_requests()
+                else:
+                    key.data.service()
+            if self.ticking:
+                now = time.monotonic()
+                for instance in list(self.ticking):
+                    instance.tick(now)
+
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
 
 class ViscaRelayList:
-    def __init__(self, count: int, bitfocus, baseport: int, viscaport: int):
+    def __init__(self, count: int, notifier, baseport: int, viscaport: int,
+                 ptz_resolver: resolver.Resolver = None):
+        """ notifier is a companion.CompanionNotifier, or None """
+        if ptz_resolver is None:
+            ptz_resolver = resolver.Resolver()
+        self.resolver = ptz_resolver
+        self.engine = ViscaRelayEngine()
+        self.notifier = notifier
+        self.baseport = baseport
+        self.viscaport = viscaport
         self.relaylist = []
-        for x in range(count):
-            self.relaylist.insert(x, ViscaRelayInstance(baseport, viscaport, bitfocus, x))
-            baseport = baseport + 1
+        self.resize(count)
+
+    def resize(self, count: int):
+        """ Add or remove slots at the end of the list. Slot N always listens on baseport + N,
+            and the other slots keep running undisturbed
+        """
+        while len(self.relaylist) < count:
+            x = len(self.relaylist)
+            relay = ViscaRelayInstance(self.baseport + x, self.viscaport, self.notifier, x, self.resolver)
+            self.relaylist.append(relay)
+            self.engine.register(relay)
+        while len(self.relaylist) > count:
+            self.engine.unregister(self.relaylist.pop(), wait=True)
+
+    def notifier_set(self, notifier):
+        """ Change the Companion notifier (or None) for every slot """
+        self.notifier = notifier
+        for relay in self.relaylist:
+            relay.notifier = notifier
 
     def ptz_set(self, index: int, ptz: str):
         self.relaylist[index].ptz_set(ptz)
+
+    def model_set(self, index: int, model: str = None, rules: list = None):
+        """ Set the camera model (see viscarewrite.camera_model), and any extra rewrite
+            rules, for a slot
+        """
+        self.relaylist[index].rules_set(model, rules)
+
+    def coalesce_set(self, index: int, enabled: bool):
+        """ Enable/disable drive command coalescing for a slot """
+        self.relaylist[index].coalesce_set(enabled)
+
+    def inquiry_cache_set(self, index: int, ttl: float | None):
+        """ Enable the inquiry cache for a slot, reusing camera replies for ttl seconds, or disable it (None) """
+        self.relaylist[index].inquiry_cache_set(ttl)
+
+    def ptz_state(self, index: int):
+        """ Return the state of the ptz address for a slot: None (not set), 'resolving', 'ok' or 'failed' """
+        return self.relaylist[index].ptz_state
+
+    def ptz_states(self) -> list:
+        """ Return the state of the ptz address for every slot """
+        return [relay.ptz_state for relay in self.relaylist]
+
+    def stats(self) -> list:
+        """ Return a snapshot of the counters for every relay slot """
+        return [relay.stats.snapshot() for relay in self.relaylist]
+
+    def close(self):
+        """ Shut down the relay engine and release all the relay ports """
+        self.engine.stop()
@@ -0,0 +1,86 @@
+#
+# VISCA packet rewrite rules, used by the relay to work around controller and camera quirks
+#
+# Rules edit the relay's receive buffer in place, using precompiled structs, so a rule costs
+# an unpack and a compare on the hot path and never allocates a new packet.
+#
+# Rules can be registered for every slot, for a camera model (matched against the NDI source
+# name, e.g. "AVKANS", "BIRDDOG") or set directly on a single relay slot.
+#
+import struct
+
+# Direction of the packets a rule applies to
+TO_CAMERA = 'to_camera'
+TO_CONTROLLER = 'to_controller'
+
+# VISCA over IP payload types
+VISCA_COMMAND = 0x0100
+VISCA_INQUIRY = 0x0110
+VISCA_REPLY = 0x0111
+
+# Payload type, payload length, sequence number, first two bytes of the VISCA payload
+VISCA_HEADER_CMD = struct.Struct("!HHLH")
+VISCA_TYPE = struct.Struct("!H")
+
+
+class RewriteRule:
+    """ Base class for a rewrite rule.
+        apply() is called with the relay's receive buffer and the packet length, it should edit
+        the buffer in place and return True if the packet was changed
+    """
+    name = 'rule'
+    direction = TO_CAMERA
+
+    def apply(self, buffer: bytearray, length: int) -> bool:
+        return False
+
+
+class InquiryInCommandRule(RewriteRule):
+    """ Patch around bug in AVKANS controller, it encapsulates INQUIRY commands (8x 09 ...)
+        in Visca CMD packets
+    """
+    name = 'inquiry_in_command'
+    direction = TO_CAMERA
+
+    def apply(self, buffer: bytearray, length: int) -> bool:
+        if length <= 10:
+            return False
+        (vtype, _, _, cmd) = VISCA_HEADER_CMD.unpack_from(buffer)
+        if cmd == 0x8109 and vtype == VISCA_COMMAND:
+            VISCA_TYPE.pack_into(buffer, 0, VISCA_INQUIRY)
+            return True
+        return False
+
+
+# Rules applied to every slot
+global_rules = []
+# camera model -> rules applied to slots showing a source of that model
+model_rules = {}
+
+
+def register_rule(rule: RewriteRule, model: str = None):
+    """ Register a rule for every slot, or for a camera model """
+    if model is None:
+        global_rules.append(rule)
+    else:
+        model_rules.setdefault(model.upper(), []).append(rule)
+
+
+def camera_model(name: str):
+    """ Return the camera model with registered rules which matches an NDI source name, or None """
+    name = name.upper()
+    for model in model_rules:
+        if model in name:
+            return model
+    return None
+
+
+def rules_for(model: str = None, slot_rules: list = None) -> tuple:
+    """ Return the (to camera, to controller) rule tuples for a slot """
+    rules = list(global_rules)
+    if model is not None:
+        rules.extend(model_rules.get(model.upper(), []))
+    if slot_rules is not None:
+        rules.extend(slot_rules)
+    return (tuple(r for r in rules if r.direction == TO_CAMERA),
+            tuple(r for r in rules if r.direction == TO_CONTROLLER))